@@ -0,0 +1,181 @@
+import asyncio
+import random
+import time
+from collections import Counter
+
+from model import build_messages, sampling_params
+
+# HTTP statuses worth retrying (timeouts, conflicts, rate limits, server errors)
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+def is_retryable(e):
+    import openai
+    if isinstance(e, (asyncio.TimeoutError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in RETRYABLE_STATUS or e.status_code >= 500
+    return False
+
+def retry_after_seconds(e):
+    # Honour a Retry-After header (seconds) when the server sends one
+    response = getattr(e, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def estimate_tokens(messages, max_tokens):
+    # Rough budget for the TPM limiter: ~4 characters per token plus the completion allowance
+    return sum(len(m["content"]) for m in messages) // 4 + max_tokens
+
+
+class TokenBucket():
+    """
+    Async token bucket refilled continuously at rate_per_minute, holding at most one minute of budget.
+    Amounts larger than the capacity are still granted once the bucket is full, so they cannot deadlock.
+    """
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        async with self.lock:
+            needed = min(amount, self.capacity)
+            while True:
+                self._refill()
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((needed - self.tokens) / self.rate)
+
+    def refund(self, amount):
+        # Give back over-estimated budget (or charge more when amount is negative)
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AsyncAPIRunner():
+    """
+    Sends chat-completion requests concurrently with:
+      - at most `concurrency` requests in flight
+      - optional requests-per-minute and tokens-per-minute token buckets
+      - exponential backoff with full jitter on retryable errors (429/5xx/timeouts/connection errors)
+      - a per-request timeout
+    Failed requests are returned with an "error" instead of silently becoming empty predictions.
+    Request, retry and error counts (by exception type) are kept in self.stats.
+    """
+    def __init__(self, client, model_name, args, concurrency=8, rpm=None, tpm=None,
+                 max_retries=5, backoff_base=1.0, backoff_max=60.0, request_timeout=60.0, cache=None):
+        self.client = client
+        self.model_name = model_name
+        self.args = args
+        self.cache = cache  # optional ResponseCache, checked before any rate limiting
+        self.concurrency = concurrency
+        self.request_limiter = TokenBucket(rpm) if rpm else None
+        self.token_limiter = TokenBucket(tpm) if tpm else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.request_timeout = request_timeout
+        self.stats = Counter()
+        # perf_counter() when the first request was sent (None while every result came from the cache)
+        self.first_request_at = None
+
+    def sampling_params(self):
+        return sampling_params(self.args)
+
+    async def _create(self, messages):
+        if self.first_request_at is None:
+            self.first_request_at = time.perf_counter()
+        return await asyncio.wait_for(
+            self.client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                timeout=self.request_timeout,
+                **self.sampling_params(),
+            ),
+            timeout=self.request_timeout,
+        )
+
+    async def generate(self, prompt):
+        started = time.perf_counter()
+        messages = build_messages(prompt)
+        result = {"pred": "", "error": None, "attempts": 0, "usage": None, "cached": False, "latency": 0.0}
+
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(self.model_name, str(self.client.base_url), messages, self.sampling_params())
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                result.update(pred=cached, cached=True, latency=time.perf_counter() - started)
+                return result
+
+        estimate = estimate_tokens(messages, self.args.max_new_tokens)
+
+        for attempt in range(self.max_retries + 1):
+            if self.request_limiter:
+                await self.request_limiter.acquire(1)
+            if self.token_limiter:
+                await self.token_limiter.acquire(estimate)
+
+            result["attempts"] = attempt + 1
+            self.stats["requests"] += 1
+            if attempt:
+                self.stats["retries"] += 1
+            try:
+                response = await self._create(messages)
+            except Exception as e:
+                result["error"] = f"{type(e).__name__}: {e}"
+                self.stats[f"error:{type(e).__name__}"] += 1
+                if not is_retryable(e) or attempt == self.max_retries:
+                    self.stats["failed"] += 1
+                    result["latency"] = time.perf_counter() - started
+                    return result
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                await asyncio.sleep(delay)
+                continue
+
+            usage = getattr(response, 'usage', None)
+            if usage is not None:
+                result["usage"] = {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+                if self.token_limiter:
+                    self.token_limiter.refund(estimate - (usage.prompt_tokens or 0) - (usage.completion_tokens or 0))
+            result["pred"] = (response.choices[0].message.content or "").strip()
+            result["error"] = None
+            if cache_key is not None:
+                self.cache.put(cache_key, result["pred"])
+            result["latency"] = time.perf_counter() - started
+            return result
+        return result
+
+    async def run(self, jobs, on_result):
+        """
+        jobs: iterable of (idx, prompt). on_result(idx, result) is called as each request finishes,
+        in completion order.
+        """
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+
+        async def worker():
+            while True:
+                try:
+                    idx, prompt = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                on_result(idx, await self.generate(prompt))
+
+        await asyncio.gather(*(worker() for _ in range(max(1, self.concurrency))))
+
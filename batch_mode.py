@@ -0,0 +1,285 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from model import build_messages, sampling_params
+from output_io import iter_json_records, write_records
+
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+# OpenAI Batch API limit on requests per input file
+MAX_BATCH_REQUESTS = 50000
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+def batch_request(idx, prompt, args):
+    # One line of an OpenAI Batch input file: the same messages and sampling params as get_pred_api
+    return {
+        "custom_id": str(idx),
+        "method": "POST",
+        "url": CHAT_COMPLETIONS_URL,
+        "body": {"model": args.model_name, "messages": build_messages(prompt), **sampling_params(args)},
+    }
+
+def write_batch_requests(path, prompts, args):
+    """
+    prompts: {idx: prompt}. Writes the Batch input JSONL in idx order and returns the request count.
+    """
+    if len(prompts) > MAX_BATCH_REQUESTS:
+        print(f"Warning: {len(prompts)} requests exceed the Batch API limit of {MAX_BATCH_REQUESTS} per file; "
+              f"split the run with --num_shards.")
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for idx in sorted(prompts):
+            f.write(json.dumps(batch_request(idx, prompts[idx], args), ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+    return len(prompts)
+
+def parse_batch_result(line):
+    """
+    One line of a Batch output (or error) file -> (idx, pred, usage, error).
+    """
+    idx = int(line["custom_id"])
+    if line.get("error"):
+        error = line["error"]
+        return idx, "", None, f"{error.get('code')}: {error.get('message')}"
+    response = line.get("response") or {}
+    body = response.get("body") or {}
+    if response.get("status_code") != 200:
+        message = (body.get("error") or {}).get("message", "")
+        return idx, "", None, f"HTTP {response.get('status_code')}: {message}"
+    usage = body.get("usage")
+    if usage is not None:
+        usage = {"prompt_tokens": usage.get("prompt_tokens"), "completion_tokens": usage.get("completion_tokens")}
+    return idx, (body["choices"][0]["message"].get("content") or "").strip(), usage, None
+
+def ingest_batch_results(requests_path, results_path, test_data, output_path, src_lang, tgt_lang):
+    """
+    Phase 2: joins the Batch results with the request file and the test data and writes the
+    standard output JSONL (idx/query/gold/pred/prompt/source). Failed and missing requests are
+    written with an "error" (so main.py --resume retries them) and reported.
+    Returns (records, failed idx list, missing idx list).
+    """
+    prompts = {int(request["custom_id"]): request["body"]["messages"][-1]["content"] for request in iter_json_records(requests_path)}
+
+    results = {}
+    unknown = []
+    for line in iter_json_records(results_path):
+        idx, pred, usage, error = parse_batch_result(line)
+        if idx not in prompts:
+            unknown.append(idx)
+        elif idx not in results or results[idx][2] is not None:
+            # Keep the first successful result when an id appears more than once
+            results[idx] = (pred, usage, error)
+
+    records, failed, missing = [], [], []
+    for idx, prompt in sorted(prompts.items()):
+        item = test_data[idx]
+        pred, usage, error = results.get(idx, ("", None, "missing from batch results"))
+        record = {
+            "idx": idx,
+            "query": item[src_lang],
+            "gold": item[tgt_lang],
+            "pred": pred,
+            "prompt": prompt,
+            "source": item.get('source', 'n/a'),
+            "usage": usage,
+        }
+        if error:
+            record["error"] = error
+            (missing if idx not in results else failed).append(idx)
+        records.append(record)
+    write_records(output_path, records)
+
+    print(f"Ingested {len(records) - len(failed) - len(missing)} of {len(records)} batch results into {output_path}.")
+    if failed:
+        print(f"{len(failed)} requests failed (marked with 'error' in the output): {failed[:50]}")
+    if missing:
+        print(f"{len(missing)} requests have no result (marked with 'error' in the output): {missing[:50]}")
+    if unknown:
+        print(f"Warning: ignored {len(unknown)} results whose custom_id is not in {requests_path}: {unknown[:20]}")
+    return records, failed, missing
+
+
+class OpenAIBatchSubmitter():
+    """
+    Submits through the OpenAI Batch API: upload the request file, create a batch,
+    and download its output and error files once it has finished.
+    """
+    def __init__(self, client, completion_window="24h"):
+        self.client = client  # synchronous openai.OpenAI
+        self.completion_window = completion_window
+
+    def submit(self, requests_path):
+        with open(requests_path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint=CHAT_COMPLETIONS_URL,
+                                           completion_window=self.completion_window)
+        return batch.id
+
+    def status(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        counts = getattr(batch, 'request_counts', None)
+        progress = f" ({counts.completed + counts.failed}/{counts.total})" if counts else ""
+        return batch.status, progress
+
+    def download(self, batch_id, results_path):
+        batch = self.client.batches.retrieve(batch_id)
+        with open(results_path, 'w', encoding='utf-8') as f:
+            # Failed requests are in a separate error file with the same line format
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    text = self.client.files.content(file_id).text
+                    f.write(text if text.endswith("\n") or not text else text + "\n")
+        return results_path
+
+class LocalBatchSubmitter():
+    """
+    Offline stand-in for the Batch API: processes the request file itself against any
+    OpenAI-compatible chat endpoint (mock_openai.py, a local vLLM server, ...) and writes
+    results in the Batch output format. Requests are not retried, as in the Batch API.
+    """
+    def __init__(self, client, work_dir, concurrency=8):
+        self.client = client  # openai.AsyncOpenAI
+        self.work_dir = work_dir
+        self.concurrency = concurrency
+
+    def result_path(self, batch_id):
+        return os.path.join(self.work_dir, f"{batch_id}.results.jsonl")
+
+    def submit(self, requests_path):
+        with open(requests_path, 'rb') as f:
+            batch_id = "local-" + hashlib.sha1(f.read()).hexdigest()[:16]
+        os.makedirs(self.work_dir, exist_ok=True)
+        lines = asyncio.run(self.process(list(iter_json_records(requests_path))))
+        with open(self.result_path(batch_id), 'w', encoding='utf-8') as f:
+            for line in lines:
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        return batch_id
+
+    async def process(self, requests):
+        slots = asyncio.Semaphore(max(1, self.concurrency))
+
+        async def send(request):
+            async with slots:
+                try:
+                    response = await self.client.chat.completions.create(**request["body"])
+                    result = {"status_code": 200, "request_id": response.id, "body": response.model_dump()}
+                except Exception as e:
+                    status = getattr(e, 'status_code', 500)
+                    result = {"status_code": status, "request_id": None, "body": {"error": {"message": f"{type(e).__name__}: {e}"}}}
+            return {"id": f"batch_req_{request['custom_id']}", "custom_id": request["custom_id"], "response": result, "error": None}
+
+        # Results come back in completion order, like the real Batch API
+        return [await line for line in asyncio.as_completed([send(request) for request in requests])]
+
+    def status(self, batch_id):
+        return ("completed" if os.path.exists(self.result_path(batch_id)) else "failed"), ""
+
+    def download(self, batch_id, results_path):
+        shutil.copyfile(self.result_path(batch_id), results_path)
+        return results_path
+
+def get_submitter(args):
+    import openai
+    api_key = args.api_key or os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("Please provide --api_key or set OPENAI_API_KEY environment variable.")
+    if args.submitter == 'local':
+        client = openai.AsyncOpenAI(api_key=api_key, base_url=args.base_url, max_retries=0, timeout=args.request_timeout)
+        return LocalBatchSubmitter(client, args.batch_dir, concurrency=args.concurrency)
+    return OpenAIBatchSubmitter(openai.OpenAI(api_key=api_key, base_url=args.base_url))
+
+def wait_for_batch(submitter, batch_id, poll_interval=60.0, timeout=None):
+    # Polls until the batch reaches a terminal status and returns that status
+    started = time.time()
+    while True:
+        status, progress = submitter.status(batch_id)
+        print(f"Batch {batch_id}: {status}{progress}")
+        if status in TERMINAL_STATUSES:
+            return status
+        if timeout is not None and time.time() - started > timeout:
+            raise TimeoutError(f"Batch {batch_id} still {status} after {timeout}s; resume with: collect --batch_id {batch_id}")
+        time.sleep(poll_interval)
+
+
+def build_prompts(args):
+    """
+    Phase 1 prompts for every test item (or this shard's items), built exactly as main.py does.
+    Returns (test_data, {idx: prompt}).
+    """
+    from main import load_shared, retrieve_examples
+    from prompts import construct_prompt_mos2en, construct_prompt_en2mos, prefetch_word_explanations, PromptBuilder
+    from shards import shard_indices
+
+    dictionary, parallel_corpus, chargram = load_shared(args)
+    test_data = list(iter_json_records(args.test_data_path))
+    todo = list(shard_indices(len(test_data), args.num_shards, args.shard_id))
+    queries = [test_data[idx][args.src_lang] for idx in todo]
+
+    retrieved = [[] for _ in todo]
+    if args.num_parallel_sent > 0 and todo:
+        print(f"Retrieving {args.num_parallel_sent} examples for {len(todo)} sentences ({args.retriever})...")
+        retrieved = retrieve_examples(parallel_corpus, queries, args, chargram=chargram)
+    if args.prompt_type == 'mos2en':
+        prefetch_word_explanations(queries, 'mos', dictionary, workers=args.fuzzy_workers)
+
+    prompt_func = {'mos2en': construct_prompt_mos2en, 'en2mos': construct_prompt_en2mos}[args.prompt_type]
+    builder = PromptBuilder.from_args(args)
+    prompts = {
+        idx: prompt_func(query, dictionary, parallel_corpus, args, retrieved=examples, builder=builder)
+        for idx, query, examples in zip(todo, queries, retrieved)
+    }
+    return test_data, prompts
+
+
+if __name__ == "__main__":
+    from main import get_parser, default_output_path
+
+    parser = get_parser()
+    parser.description = "Two-phase generation through batch files (OpenAI Batch API or a local stand-in)"
+    parser.add_argument('phase', choices=['write', 'submit', 'collect', 'ingest'],
+                        help="write: request file only; submit: write, submit, wait and ingest; "
+                             "collect: wait for --batch_id and ingest; ingest: --results_path into the output")
+    parser.add_argument('--requests_path', type=str, default=None, help="Batch input JSONL (default: <output_path>.batch_requests.jsonl)")
+    parser.add_argument('--results_path', type=str, default=None, help="Batch output JSONL (default: <output_path>.batch_results.jsonl)")
+    parser.add_argument('--submitter', type=str, default='openai', choices=['openai', 'local'],
+                        help="local: process the file against --base_url (e.g. mock_openai.py) instead of the Batch API")
+    parser.add_argument('--batch_id', type=str, default=None)
+    parser.add_argument('--batch_dir', type=str, default='batches', help="Where the local submitter keeps results")
+    parser.add_argument('--poll_interval', type=float, default=60.0)
+    parser.add_argument('--wait_timeout', type=float, default=None, help="Stop polling after this many seconds (resume with collect)")
+    args = parser.parse_args()
+
+    output_path = args.output_path or default_output_path(args)
+    if args.num_shards > 1:
+        from shards import shard_output_path
+        output_path = shard_output_path(output_path, args.shard_id, args.num_shards)
+    requests_path = args.requests_path or output_path + ".batch_requests.jsonl"
+    results_path = args.results_path or output_path + ".batch_results.jsonl"
+
+    # Phase 1: prompts -> request file (and submission)
+    if args.phase in ('write', 'submit'):
+        test_data, prompts = build_prompts(args)
+        count = write_batch_requests(requests_path, prompts, args)
+        print(f"Wrote {count} batch requests to {requests_path}")
+        if args.phase == 'write':
+            raise SystemExit(0)
+        submitter = get_submitter(args)
+        args.batch_id = submitter.submit(requests_path)
+        print(f"Submitted batch {args.batch_id}")
+    else:
+        test_data = list(iter_json_records(args.test_data_path))
+
+    # Phase 2: results -> standard output JSONL
+    if args.phase in ('submit', 'collect'):
+        if not args.batch_id:
+            raise ValueError("collect needs --batch_id")
+        submitter = submitter if args.phase == 'submit' else get_submitter(args)
+        status = wait_for_batch(submitter, args.batch_id, args.poll_interval, args.wait_timeout)
+        if status != "completed":
+            print(f"Batch {args.batch_id} ended as {status}; downloading whatever results it has.")
+        submitter.download(args.batch_id, results_path)
+    ingest_batch_results(requests_path, results_path, test_data, output_path, args.src_lang, args.tgt_lang)
+    print("Done. You can now run eval.py on the output file.")
@@ -0,0 +1,446 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+from metrics import percentiles
+from prepare_data import assign_difficulty
+
+EN_LETTERS = "etaoinshrdlcumwfgypbvkjxqz"
+MOS_CONSONANTS = ["b", "d", "f", "g", "h", "k", "l", "m", "n", "p", "r", "s", "t", "w", "y", "z", "gʋ", "ng", "ts"]
+MOS_VOWELS = ["a", "e", "i", "o", "u", "ã", "ẽ", "ĩ", "õ", "ũ", "ɛ", "ɩ", "ʋ", "aa", "ee", "oo"]
+# NLLB en-mos: log English length ~ N(1.91, 0.53) words, log(mos/en) length ratio ~ N(log 1.17, 0.35)
+EN_LOG_LEN = (1.91, 0.53)
+MOS_LOG_RATIO = (np.log(1.17), 0.35)
+RESULTS_VERSION = 1
+
+def zipf_cdf(size, a=1.1):
+    weights = 1.0 / np.arange(1, size + 1) ** a
+    return np.cumsum(weights) / weights.sum()
+
+def make_words(rng, count, make_word, reserved=()):
+    words = list(dict.fromkeys(reserved))
+    seen = set(words)
+    while len(words) < count:
+        word = make_word(rng)
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+def en_word(rng):
+    # Frequent letters more often, 1-10 letters
+    probs = zipf_cdf(len(EN_LETTERS), a=0.8)
+    return "".join(EN_LETTERS[i] for i in np.searchsorted(probs, rng.random_sample(rng.randint(1, 11))))
+
+def mos_word(rng):
+    syllables = rng.randint(1, 4)
+    word = "".join(MOS_CONSONANTS[rng.randint(len(MOS_CONSONANTS))] + MOS_VOWELS[rng.randint(len(MOS_VOWELS))] for _ in range(syllables))
+    return word + ("-a" if rng.random_sample() < 0.05 else "")
+
+class SyntheticCorpus():
+    """
+    Deterministic synthetic en-mos pairs for benchmarks: sentence lengths follow the NLLB en-mos
+    distribution and words are Zipf-distributed. The most frequent Mossi words are dictionary
+    headwords (so exact hints fire) and a fraction of tokens carry a one-character typo
+    (so fuzzy matching runs).
+    """
+    def __init__(self, seed=0, en_vocab_size=30000, mos_vocab_size=30000, headwords=(), typo_rate=0.05):
+        rng = np.random.RandomState(seed)
+        self.seed = seed
+        self.typo_rate = typo_rate
+        self.en_vocab = np.array(make_words(rng, en_vocab_size, en_word))
+        headwords = [w for w in headwords if " " not in w and len(w) > 1][:mos_vocab_size // 3]
+        self.mos_vocab = np.array(make_words(rng, mos_vocab_size, mos_word, reserved=headwords))
+        self.en_cdf = zipf_cdf(len(self.en_vocab))
+        self.mos_cdf = zipf_cdf(len(self.mos_vocab))
+
+    def sample_lengths(self, rng, count):
+        en_len = np.clip(np.round(np.exp(rng.normal(*EN_LOG_LEN, size=count))), 1, 200).astype(np.int64)
+        ratio = np.exp(rng.normal(*MOS_LOG_RATIO, size=count))
+        mos_len = np.clip(np.round(en_len * ratio), 1, 250).astype(np.int64)
+        return en_len, mos_len
+
+    def sentences(self, rng, vocab, cdf, lengths, typos=False):
+        words = vocab[np.minimum(np.searchsorted(cdf, rng.random_sample(lengths.sum())), len(vocab) - 1)]
+        if typos:
+            words = words.copy()
+            for i in np.flatnonzero(rng.random_sample(len(words)) < self.typo_rate):
+                word = words[i]
+                pos = rng.randint(len(word))
+                words[i] = word[:pos] + MOS_VOWELS[rng.randint(5)] + word[pos + 1:]
+        ends = np.cumsum(lengths)
+        punct = rng.random_sample(len(lengths))
+        out = []
+        for start, end, p in zip(ends - lengths, ends, punct):
+            text = " ".join(words[start:end])
+            text = text[:1].upper() + text[1:] + ("." if p < 0.6 else "?" if p < 0.7 else "")
+            out.append(text)
+        return out
+
+    def pairs(self, num_pairs, start_id=0, chunk_size=20000, stream=0):
+        # Chunks are seeded by (seed, stream, chunk number), so any prefix is reproducible
+        for chunk_start in range(0, num_pairs, chunk_size):
+            rng = np.random.RandomState([self.seed, stream, chunk_start // chunk_size])
+            count = min(chunk_size, num_pairs - chunk_start)
+            en_len, mos_len = self.sample_lengths(rng, count)
+            en = self.sentences(rng, self.en_vocab, self.en_cdf, en_len)
+            mos = self.sentences(rng, self.mos_vocab, self.mos_cdf, mos_len, typos=True)
+            for i, (en_text, mos_text) in enumerate(zip(en, mos)):
+                yield {"id": start_id + chunk_start + i, "en": en_text, "mos": mos_text}
+
+def load_headwords(dict_path):
+    if not dict_path or not os.path.exists(dict_path):
+        return []
+    with open(dict_path, 'r', encoding='utf-8') as f:
+        return [item.get('word', '').strip() for item in json.load(f) if item.get('word', '').strip()]
+
+def write_jsonl(path, records):
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+def generate_data(data_dir, num_pairs, num_test, seed, dict_path):
+    """
+    Writes data_dir/corpus.jsonl (num_pairs) and data_dir/test.jsonl (num_test, with difficulty levels).
+    Existing files generated with the same settings are reused.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    settings = {"num_pairs": num_pairs, "num_test": num_test, "seed": seed, "dict_path": dict_path}
+    settings_path = os.path.join(data_dir, "settings.json")
+    if os.path.exists(settings_path):
+        with open(settings_path, 'r', encoding='utf-8') as f:
+            if json.load(f) == settings:
+                return data_dir
+    synthetic = SyntheticCorpus(seed=seed, headwords=load_headwords(dict_path))
+    print(f"Generating {num_pairs} synthetic pairs in {data_dir}...")
+    start = time.perf_counter()
+    write_jsonl(os.path.join(data_dir, "corpus.jsonl"), synthetic.pairs(num_pairs))
+    test = assign_difficulty(list(synthetic.pairs(num_test, start_id=num_pairs, stream=1)))
+    write_jsonl(os.path.join(data_dir, "test.jsonl"), test)
+    for stale in ("corpus.jsonl.cols", "corpus.jsonl.bm25", "corpus.jsonl.chargram"):
+        shutil.rmtree(os.path.join(data_dir, stale), ignore_errors=True)
+    with open(settings_path, 'w', encoding='utf-8') as f:
+        json.dump(settings, f)
+    print(f"Generated in {time.perf_counter() - start:.1f}s")
+    return data_dir
+
+def load_queries(data_dir, lang, count):
+    with open(os.path.join(data_dir, "test.jsonl"), 'r', encoding='utf-8') as f:
+        texts = [json.loads(line)[lang] for line in f]
+    return [texts[i % len(texts)] for i in range(count)]
+
+def timed_calls(fn, inputs, repeat=1):
+    """
+    Latency of fn(x) for every input: the inputs are run `repeat` times and each input keeps
+    its fastest time, which filters out scheduler noise on a shared box.
+    """
+    inputs = list(inputs)
+    best = np.full(len(inputs), np.inf)
+    for _ in range(repeat):
+        for i, x in enumerate(inputs):
+            start = time.perf_counter()
+            fn(x)
+            best[i] = min(best[i], time.perf_counter() - start)
+    return percentiles(best)
+
+def timed_once(fn, repeat=1):
+    # Fastest of `repeat` runs (the result of the last run is returned)
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return result, round(best, 4)
+
+
+def run_micro(args):
+    from corpus import ParallelCorpus
+    from dictionary import WordDictionary
+    from prompts import get_word_explanation_prompt, construct_prompt_mos2en, PromptBuilder
+    from tokenizer import get_tokenizer
+
+    corpus_path = os.path.join(args.data_dir, "corpus.jsonl")
+    results = {}
+
+    # 1. Corpus store and BM25 index: fresh build, then load
+    shutil.rmtree(corpus_path + ".cols", ignore_errors=True)
+    shutil.rmtree(corpus_path + ".bm25", ignore_errors=True)
+    corpus, results["store_build_s"] = timed_once(lambda: ParallelCorpus('mos', 'en', corpus_path, construct_bm25=False))
+    _, results["index_build_s"] = timed_once(lambda: corpus.construct_bm25())
+    corpus, results["index_load_s"] = timed_once(lambda: ParallelCorpus('mos', 'en', corpus_path, index_workers=args.index_workers), args.repeat)
+
+    # 2. Retrieval: one query at a time, then batched
+    queries = load_queries(args.data_dir, 'mos', args.num_queries)
+    results["bm25_query"] = timed_calls(lambda q: corpus.search_by_bm25(q, query_lang='mos', top_k=args.top_k), queries, args.repeat)
+    retrieved, batch_s = timed_once(lambda: corpus.search_by_bm25_batch(queries, query_lang='mos', top_k=args.top_k, chunk_size=args.chunk_size), args.repeat)
+    results["bm25_batch"] = {"total_s": batch_s, "per_query_ms": round(batch_s * 1000 / len(queries), 4), "queries_per_s": round(len(queries) / batch_s, 2)}
+
+    # 3. Dictionary: exact scans, fuzzy matching (cold, then memoized) and whole hint sections
+    dictionary, results["dictionary_load_s"] = timed_once(lambda: WordDictionary('mos', 'en', args.dict_path), args.repeat)
+    tokenizer = get_tokenizer('mos')
+    tokenized = [tokenizer.tokenize(q, remove_punc=True) for q in queries]
+    results["dictionary_exact_scan"] = timed_calls(dictionary.scan, tokenized, args.repeat)
+    words = sorted({word for tokens in tokenized for word in tokens})[:args.num_fuzzy_words]
+
+    def fuzzy_cold(word):
+        dictionary.fuzzy_cache.pop((word, 1), None)
+        dictionary.get_meanings_by_fuzzy_match(word, top_k=1)
+    results["dictionary_fuzzy_cold"] = timed_calls(fuzzy_cold, words, args.repeat)
+    results["dictionary_fuzzy_cached"] = timed_calls(lambda w: dictionary.get_meanings_by_fuzzy_match(w, top_k=1), words, args.repeat)
+    results["word_explanation_prompt"] = timed_calls(lambda q: get_word_explanation_prompt(q, 'mos', dictionary), queries, args.repeat)
+
+    # 4. Prompt assembly with precomputed retrieval
+    prompt_args = argparse.Namespace(num_parallel_sent=args.top_k)
+    builder = PromptBuilder()
+    results["prompt_build"] = timed_calls(
+        lambda i: construct_prompt_mos2en(queries[i], dictionary, corpus, prompt_args, retrieved=retrieved[i], builder=builder),
+        range(len(queries)), args.repeat,
+    )
+    return results
+
+def run_checks(args):
+    """
+    Correctness checks on the synthetic data (nothing is timed). Returns the failures.
+    For each language: BM25 resolves a language code ('mos') to the same index as its side ('src');
+    a sentence copied from the corpus retrieves its own pair first with BM25, char n-grams and
+    hybrid; and hybrid results come from the BM25 and char n-gram candidates of that language.
+    """
+    from chargram import CharNgramRetriever
+    from corpus import ParallelCorpus
+    from main import retrieve_examples
+
+    corpus = ParallelCorpus('mos', 'en', os.path.join(args.data_dir, "corpus.jsonl"))
+    chargram = CharNgramRetriever(corpus)
+    rows = range(0, len(corpus), max(1, len(corpus) // args.num_queries))[:args.num_queries]
+    failures = []
+
+    for lang, side, prompt_type in (('mos', 'src', 'mos2en'), ('en', 'tgt', 'en2mos')):
+        queries = [corpus[i][lang] for i in rows]
+        by_code = corpus.search_by_bm25_batch(queries, query_lang=lang, top_k=args.top_k)
+        by_side = corpus.search_by_bm25_batch(queries, query_lang=side, top_k=args.top_k)
+        if [[r["idx"] for r in results] for results in by_code] != [[r["idx"] for r in results] for results in by_side]:
+            failures.append(f"bm25: query_lang '{lang}' and '{side}' search different indexes")
+
+        retrieved = {}
+        for retriever in ('bm25', 'chargram', 'hybrid'):
+            run_args = argparse.Namespace(prompt_type=prompt_type, retriever=retriever, num_parallel_sent=args.top_k,
+                                          retrieval_chunk_size=256, diversify=False)
+            retrieved[retriever] = retrieve_examples(corpus, queries, run_args, chargram=chargram)
+            found = sum(1 for query, results in zip(queries, retrieved[retriever]) if results and results[-1]["pair"][lang] == query)
+            # Char n-gram search is approximate (IVF), so a few misses are allowed
+            if found < 0.95 * len(queries):
+                failures.append(f"{retriever} ({lang}): {found}/{len(queries)} corpus sentences retrieve their own pair first")
+
+        # Hybrid fuses 2 * top_k candidates of each retriever
+        pools = {
+            retriever: retrieve_examples(corpus, queries, argparse.Namespace(
+                prompt_type=prompt_type, retriever=retriever, retrieval_chunk_size=256, diversify=False), top_k=2 * args.top_k, chargram=chargram)
+            for retriever in ('bm25', 'chargram')
+        }
+        for i, results in enumerate(retrieved["hybrid"]):
+            candidates = {r["idx"] for r in pools["bm25"][i]} | {r["idx"] for r in pools["chargram"][i]}
+            if any(r["idx"] not in candidates for r in results):
+                failures.append(f"hybrid ({lang}): results of query {i} are not BM25 or char n-gram candidates")
+                break
+        print(f"Checked {len(queries)} {lang} queries with bm25, chargram and hybrid retrieval")
+    return failures
+
+def run_e2e(args):
+    from mock_openai import make_server
+
+    server = make_server(port=0, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    work_dir = os.path.join(args.data_dir, "e2e")
+    os.makedirs(work_dir, exist_ok=True)
+    test_path = os.path.join(work_dir, "test.jsonl")
+    with open(os.path.join(args.data_dir, "test.jsonl"), 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    with open(test_path, 'w', encoding='utf-8') as f:
+        f.writelines(lines[i % len(lines)] for i in range(args.num_queries))
+    output_path = os.path.join(work_dir, "output.jsonl")
+    metrics_path = os.path.join(work_dir, "metrics.json")
+
+    # main.py runs as its own process, as it would in production
+    command = [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+        "--use_api", "--api_key", "mock", "--base_url", f"http://127.0.0.1:{port}/v1",
+        "--corpus_path", os.path.join(args.data_dir, "corpus.jsonl"), "--test_data_path", test_path,
+        "--dict_path", args.dict_path, "--output_path", output_path, "--metrics_path", metrics_path,
+        "--no_cache", "--concurrency", str(args.concurrency), "--max_retries", str(args.max_retries),
+        "--num_parallel_sent", str(args.top_k),
+    ]
+    start = time.perf_counter()
+    completed = subprocess.run(command, capture_output=True, text=True)
+    wall_s = time.perf_counter() - start
+    server.shutdown()
+    if completed.returncode != 0:
+        print(completed.stdout[-2000:], completed.stderr[-2000:])
+        raise RuntimeError(f"main.py exited with status {completed.returncode}")
+
+    with open(metrics_path, 'r', encoding='utf-8') as f:
+        summary = json.load(f)
+    stages = summary["stages"]
+    return {
+        "wall_s": round(wall_s, 3),
+        "items_per_s": round(args.num_queries / wall_s, 3),
+        "startup_s": round(stages.get("load_resources", {}).get("total_s", 0) + stages.get("load_generator", {}).get("total_s", 0), 3),
+        "generation": stages.get("generation"),
+        "prompt": stages.get("prompt"),
+        "retrieval": stages.get("retrieval"),
+        "requests": summary["counters"].get("requests", 0),
+        "retries": summary["counters"].get("retries", 0),
+        "failed": summary["counters"].get("failed", 0),
+        "mock_server": dict(server.RequestHandlerClass.counts),
+    }
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def higher_is_better(name):
+    return name.endswith("per_s")
+
+def is_timing(name):
+    return name.endswith("_s") or name.endswith("_ms")
+
+def compare_results(baseline, current, tolerance, min_delta_ms=0.05):
+    """
+    Compares timing and throughput metrics of two result files. A metric regresses when it is
+    worse than the baseline by more than `tolerance` (relative) and, for timings, by more than
+    min_delta_ms (so sub-microsecond jitter is not reported). Returns (rows, regressions).
+    """
+    base, cur = flatten(baseline["results"]), flatten(current["results"])
+    rows, regressions = [], []
+    for name in sorted(set(base) & set(cur)):
+        if not (is_timing(name) or higher_is_better(name)) or name.endswith("count"):
+            continue
+        if name.endswith(".total_s") and name[:-len("total_s")] + "mean_ms" in cur:
+            continue  # a latency distribution's total tracks its mean
+        old, new = base[name], cur[name]
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher_is_better(name) else change
+        delta_ms = abs(new - old) * (1 if name.endswith("_ms") else 1000)
+        significant = higher_is_better(name) or delta_ms > min_delta_ms
+        status = ("REGRESSION" if worse > tolerance else "improved" if worse < -tolerance else "") if significant else ""
+        rows.append((name, old, new, change, status))
+        if status == "REGRESSION":
+            regressions.append(name)
+    return rows, regressions
+
+def print_comparison(rows):
+    print(f"{'metric':<44}{'baseline':>12}{'current':>12}{'change':>9}")
+    for name, old, new, change, status in rows:
+        print(f"{name:<44}{old:>12.4g}{new:>12.4g}{change:>+9.1%}  {status}")
+
+def save_results(path, suite, args, results):
+    record = {
+        "version": RESULTS_VERSION,
+        "suite": suite,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("func",)},
+        "environment": environment(),
+        "results": results,
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(record, f, indent=2)
+    print(f"Results written to {path}")
+    return record
+
+def check_baseline(record, baseline_path, tolerance, min_delta_ms=0.05):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    rows, regressions = compare_results(baseline, record, tolerance, min_delta_ms)
+    print_comparison(rows)
+    if regressions:
+        print(f"{len(regressions)} metrics regressed by more than {tolerance:.0%}: {', '.join(regressions)}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline, CPU-only benchmarks on synthetic en-mos data")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--data_dir', type=str, default='bench_data')
+    common.add_argument('--num_pairs', type=int, default=10000, help="Synthetic corpus size (10k to millions)")
+    common.add_argument('--num_test', type=int, default=500)
+    common.add_argument('--seed', type=int, default=0)
+    common.add_argument('--dict_path', type=str, default='dictionary.json')
+
+    run = argparse.ArgumentParser(add_help=False)
+    run.add_argument('--num_queries', type=int, default=200)
+    run.add_argument('--top_k', type=int, default=3)
+    run.add_argument('--out', type=str, default=None, help="Results JSON (default: bench_<suite>.json)")
+    run.add_argument('--baseline', type=str, default=None, help="Compare against a stored results JSON")
+    run.add_argument('--tolerance', type=float, default=0.2, help="Relative slowdown reported as a regression")
+    run.add_argument('--min_delta_ms', type=float, default=0.05, help="Smaller absolute slowdowns are not regressions")
+
+    subparsers.add_parser('generate', parents=[common], help="Write the synthetic corpus and test set")
+    micro = subparsers.add_parser('micro', parents=[common, run], help="Index build/load, retrieval, dictionary and prompt microbenchmarks")
+    micro.add_argument('--chunk_size', type=int, default=256)
+    micro.add_argument('--repeat', type=int, default=3, help="Runs per measurement; the fastest counts")
+    micro.add_argument('--index_workers', type=int, default=-1)
+    micro.add_argument('--num_fuzzy_words', type=int, default=2000)
+    e2e = subparsers.add_parser('e2e', parents=[common, run], help="main.py against a local mock OpenAI server")
+    e2e.add_argument('--latency', type=float, default=0.05)
+    e2e.add_argument('--jitter', type=float, default=0.02)
+    e2e.add_argument('--error_rate', type=float, default=0.0)
+    e2e.add_argument('--concurrency', type=int, default=16)
+    e2e.add_argument('--max_retries', type=int, default=5)
+    check = subparsers.add_parser('check', parents=[common], help="Retrieval correctness checks (no timings)")
+    check.add_argument('--num_queries', type=int, default=200)
+    check.add_argument('--top_k', type=int, default=3)
+    compare = subparsers.add_parser('compare', help="Compare two results files")
+    compare.add_argument('baseline', type=str)
+    compare.add_argument('current', type=str)
+    compare.add_argument('--tolerance', type=float, default=0.2)
+    compare.add_argument('--min_delta_ms', type=float, default=0.05)
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.current, 'r', encoding='utf-8') as f:
+            current = json.load(f)
+        sys.exit(1 if check_baseline(current, args.baseline, args.tolerance, args.min_delta_ms) else 0)
+
+    generate_data(args.data_dir, args.num_pairs, args.num_test, args.seed, args.dict_path)
+    if args.command == 'generate':
+        sys.exit(0)
+    if args.command == 'check':
+        failures = run_checks(args)
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        print(f"{len(failures)} checks failed." if failures else "All checks passed.")
+        sys.exit(1 if failures else 0)
+
+    results = run_micro(args) if args.command == 'micro' else run_e2e(args)
+    record = save_results(args.out or f"bench_{args.command}.json", args.command, args, results)
+    if args.baseline and check_baseline(record, args.baseline, args.tolerance, args.min_delta_ms):
+        sys.exit(1)
@@ -0,0 +1,299 @@
+import json
+import math
+import os
+from array import array
+from collections import Counter
+import numpy as np
+
+# Bump whenever the on-disk layout written by BM25Index.save changes
+INDEX_FORMAT_VERSION = 1
+
+# Flat arrays written by BM25Index.save, one .npy file each
+INDEX_ARRAYS = ['indptr', 'doc_ids', 'tfs', 'impacts', 'doc_len', 'idf']
+
+class BM25Index():
+    """
+    Sparse BM25 (Okapi) index with the same k1/b/epsilon semantics as rank_bm25.BM25Okapi.
+
+    Postings are stored term-major as a CSR matrix (indptr, doc_ids, impacts) where
+    impacts[j] is the precomputed BM25 contribution of that term to that document,
+    so scoring a query only touches the posting lists of its terms.
+    """
+    def __init__(self, vocab, indptr, doc_ids, tfs, impacts, doc_len, idf, k1=1.5, b=0.75, epsilon=0.25):
+        self._vocab = vocab         # term -> row in the CSR matrix (or a path to vocab.json, loaded lazily)
+        self.indptr = indptr        # (num_terms + 1,) offsets into doc_ids / tfs / impacts
+        self.doc_ids = doc_ids      # (nnz,) document ids, ascending within each term
+        self.tfs = tfs              # (nnz,) raw term frequencies
+        self.impacts = impacts      # (nnz,) idf * saturated tf
+        self.doc_len = doc_len      # (num_docs,)
+        self.idf = idf              # (num_terms,)
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self._csr = None
+
+    @property
+    def vocab(self):
+        if isinstance(self._vocab, str):
+            with open(self._vocab, 'r', encoding='utf-8') as f:
+                self._vocab = {term: term_id for term_id, term in enumerate(json.load(f))}
+        return self._vocab
+
+    @property
+    def num_docs(self):
+        return len(self.doc_len)
+
+    @classmethod
+    def from_tokenized(cls, tokenized_corpus, k1=1.5, b=0.75, epsilon=0.25, token_vocab=None):
+        """
+        Documents are lists of string tokens, or of integer token ids from token_vocab
+        (a tokenizer.Vocabulary), which makes the counting below hash small ints instead of strings.
+        """
+        terms, term_ids, doc_ids, tfs, doc_len = count_postings(tokenized_corpus)
+        if token_vocab is not None:
+            terms = token_vocab.decode(terms)
+        return cls.from_shards([(terms, term_ids, doc_ids, tfs, doc_len)], k1=k1, b=b, epsilon=epsilon)
+
+    @classmethod
+    def from_shards(cls, shards, k1=1.5, b=0.75, epsilon=0.25, keep_docs=None):
+        """
+        Merges postings counted separately (see count_postings) for consecutive runs of documents,
+        given in document order. The result is identical to counting the whole corpus at once.
+        keep_docs: optional boolean mask over all documents; only those are indexed, renumbered
+        0..n-1 in order (terms that only occur in dropped documents are left out).
+        """
+        vocab = {}
+        term_ids, doc_ids, tfs, doc_len = [], [], [], []
+        for shard_terms, shard_term_ids, shard_doc_ids, shard_tfs, shard_doc_len in shards:
+            # Shard-local term ids -> global ids; new terms keep first-occurrence order across shards
+            remap = np.fromiter((vocab.setdefault(term, len(vocab)) for term in shard_terms), dtype=np.int64, count=len(shard_terms))
+            term_ids.append(remap[shard_term_ids])
+            doc_ids.append(shard_doc_ids)
+            tfs.append(shard_tfs)
+            doc_len.append(shard_doc_len)
+        term_ids, doc_ids, tfs, doc_len = np.concatenate(term_ids), np.concatenate(doc_ids), np.concatenate(tfs), np.concatenate(doc_len)
+
+        if keep_docs is not None:
+            local_ids = np.cumsum(keep_docs) - 1
+            kept = keep_docs[doc_ids]
+            term_ids, doc_ids, tfs = term_ids[kept], local_ids[doc_ids[kept]], tfs[kept]
+            doc_len = doc_len[keep_docs]
+            used = np.bincount(term_ids, minlength=len(vocab)) > 0
+            if not used.all():
+                vocab = {term: new_id for new_id, term in enumerate(term for term, is_used in zip(vocab, used.tolist()) if is_used)}
+                term_ids = (np.cumsum(used) - 1)[term_ids]
+
+        return cls.from_postings(vocab, term_ids, doc_ids, tfs, doc_len, k1=k1, b=b, epsilon=epsilon)
+
+    @classmethod
+    def from_postings(cls, vocab, term_ids, doc_ids, tfs, doc_len, k1=1.5, b=0.75, epsilon=0.25):
+        # Group postings by term (stable sort keeps doc ids ascending inside each term)
+        order = np.argsort(term_ids, kind='stable')
+        doc_ids = doc_ids[order].astype(np.int32, copy=False)
+        tfs = tfs[order].astype(np.int32, copy=False)
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=indptr[1:])
+
+        doc_len = doc_len.astype(np.int32, copy=False)
+        idf = cls.compute_idf(np.diff(indptr), len(doc_len), epsilon)
+        impacts = cls.compute_impacts(indptr, doc_ids, tfs, doc_len, idf, k1, b)
+        return cls(vocab, indptr, doc_ids, tfs, impacts, doc_len, idf, k1=k1, b=b, epsilon=epsilon)
+
+    def append(self, tokenized_docs):
+        """
+        Adds documents (ids continue after the current last document) without touching the
+        existing documents' tokens: their postings are reused as stored, and only doc_len,
+        IDF and the impacts are recomputed, which is a few vectorized passes over the arrays.
+        The index ends up exactly as if it had been built from the extended corpus.
+        """
+        terms, new_term_ids, new_doc_ids, new_tfs, new_doc_len = count_postings(tokenized_docs, doc_offset=self.num_docs)
+        if not len(new_doc_len):
+            return self
+
+        vocab = dict(self.vocab)
+        remap = np.fromiter((vocab.setdefault(term, len(vocab)) for term in terms), dtype=np.int64, count=len(terms))
+        old_term_ids = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int64), np.diff(self.indptr))
+        merged = self.from_postings(
+            vocab,
+            np.concatenate([old_term_ids, remap[new_term_ids]]),
+            np.concatenate([np.asarray(self.doc_ids), new_doc_ids]),
+            np.concatenate([np.asarray(self.tfs), new_tfs]),
+            np.concatenate([np.asarray(self.doc_len), new_doc_len]),
+            k1=self.k1, b=self.b, epsilon=self.epsilon,
+        )
+        self.__dict__.update(merged.__dict__)
+        return self
+
+    @staticmethod
+    def compute_idf(doc_freqs, num_docs, epsilon):
+        # Mirrors BM25Okapi._calc_idf, including the epsilon * average_idf floor for negative idf
+        idf = np.empty(len(doc_freqs), dtype=np.float64)
+        idf_sum = 0
+        for term_id, freq in enumerate(doc_freqs.tolist()):
+            value = math.log(num_docs - freq + 0.5) - math.log(freq + 0.5)
+            idf[term_id] = value
+            idf_sum += value
+        if len(idf):
+            average_idf = idf_sum / len(idf)
+            idf[idf < 0] = epsilon * average_idf
+        return idf
+
+    @staticmethod
+    def compute_impacts(indptr, doc_ids, tfs, doc_len, idf, k1, b):
+        avgdl = doc_len.sum() / len(doc_len)
+        term_idf = np.repeat(idf, np.diff(indptr))
+        dl = doc_len[doc_ids]
+        return term_idf * (tfs * (k1 + 1) / (tfs + k1 * (1 - b + b * dl / avgdl)))
+
+    def get_sparse_scores(self, query):
+        """
+        Returns (doc_ids, scores) for the documents that contain at least one query term.
+        Every other document has a score of exactly 0.
+        """
+        rows = [self.vocab[q] for q in query if q in self.vocab]
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+        # Repeated query terms are added once per occurrence, in query order, as in BM25Okapi
+        docs = np.concatenate([self.doc_ids[self.indptr[r]:self.indptr[r + 1]] for r in rows])
+        weights = np.concatenate([self.impacts[self.indptr[r]:self.indptr[r + 1]] for r in rows])
+        touched, inverse = np.unique(docs, return_inverse=True)
+        return touched, np.bincount(inverse, weights=weights, minlength=len(touched))
+
+    def get_scores(self, query):
+        # Dense scores over the whole corpus (drop-in for BM25Okapi.get_scores)
+        scores = np.zeros(self.num_docs)
+        touched, sparse_scores = self.get_sparse_scores(query)
+        scores[touched] = sparse_scores
+        return scores
+
+    def top_k(self, query, top_k=5):
+        touched, scores = self.get_sparse_scores(query)
+        return select_top_k(touched, scores, top_k, self.num_docs)
+
+    def to_csr(self):
+        if self._csr is None:
+            from scipy.sparse import csr_matrix
+            self._csr = csr_matrix((self.impacts, self.doc_ids, self.indptr), shape=(len(self.indptr) - 1, self.num_docs))
+        return self._csr
+
+    def query_matrix(self, queries):
+        """
+        Builds the (num_queries x num_terms) query-term matrix.
+        Every query token gets its own entry, in query order, so the sparse product
+        accumulates scores in the same order as get_sparse_scores.
+        """
+        from scipy.sparse import csr_matrix
+        indptr = [0]
+        cols = []
+        for query in queries:
+            cols.extend(self.vocab[q] for q in query if q in self.vocab)
+            indptr.append(len(cols))
+        return csr_matrix(
+            (np.ones(len(cols)), np.asarray(cols, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+            shape=(len(queries), len(self.indptr) - 1),
+        )
+
+    def top_k_batch(self, queries, top_k=5, chunk_size=256):
+        """
+        Scores all queries with one sparse-by-sparse product per chunk of chunk_size queries
+        (the chunk bounds the size of the intermediate score matrix).
+        Returns a list of (doc_ids, scores) pairs, one per query, as top_k would.
+        """
+        term_doc = self.to_csr()
+        results = []
+        for start in range(0, len(queries), chunk_size):
+            scores = (self.query_matrix(queries[start:start + chunk_size]) @ term_doc).tocsr()
+            for row in range(scores.shape[0]):
+                lo, hi = scores.indptr[row], scores.indptr[row + 1]
+                results.append(select_top_k(scores.indices[lo:hi].astype(np.int64), scores.data[lo:hi], top_k, self.num_docs))
+        return results
+
+    def save(self, index_dir):
+        """
+        Writes the index as flat .npy arrays plus vocab.json (terms in row order).
+        No pickle is involved, so loading is safe and can be memory-mapped.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(index_dir, name + '.npy'), np.ascontiguousarray(getattr(self, name)))
+
+        terms = [None] * len(self.vocab)
+        for term, term_id in self.vocab.items():
+            terms[term_id] = term
+        with open(os.path.join(index_dir, 'vocab.json'), 'w', encoding='utf-8') as f:
+            json.dump(terms, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, index_dir, k1=1.5, b=0.75, epsilon=0.25, mmap=True):
+        """
+        Opens an index written by save(). With mmap=True the arrays are mapped read-only,
+        so opening is near instant and processes on one host share the page cache.
+        The vocab is only read on the first query.
+        """
+        mmap_mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(index_dir, name + '.npy'), mmap_mode=mmap_mode) for name in INDEX_ARRAYS}
+        return cls(os.path.join(index_dir, 'vocab.json'), k1=k1, b=b, epsilon=epsilon, **arrays)
+
+
+def count_postings(tokenized_docs, doc_offset=0):
+    """
+    Counts term frequencies for a run of documents whose ids start at doc_offset.
+    Returns (terms, term_ids, doc_ids, tfs, doc_len): the distinct terms in first-occurrence
+    order, and one posting per (document, term) with term_ids indexing into terms.
+    """
+    vocab = {}
+    term_ids, post_docs, post_tfs = array('q'), array('q'), array('q')
+    doc_len = array('q')
+
+    for doc_id, document in enumerate(tokenized_docs, start=doc_offset):
+        doc_len.append(len(document))
+        # Counter keeps first-occurrence order, like BM25Okapi's frequency dicts
+        for word, freq in Counter(document).items():
+            term_id = vocab.get(word)
+            if term_id is None:
+                term_id = vocab[word] = len(vocab)
+            term_ids.append(term_id)
+            post_docs.append(doc_id)
+            post_tfs.append(freq)
+
+    return (
+        list(vocab),
+        np.frombuffer(term_ids, dtype=np.int64),
+        np.frombuffer(post_docs, dtype=np.int64).astype(np.int32),
+        np.frombuffer(post_tfs, dtype=np.int64).astype(np.int32),
+        np.frombuffer(doc_len, dtype=np.int64).astype(np.int32),
+    )
+
+def select_top_k(doc_ids, scores, top_k, num_docs):
+    """
+    Picks the top_k documents given sparse scores (missing docs score 0).
+    Returns (doc_ids, scores) in ascending score order with ties broken by doc id,
+    i.e. exactly what sorted(range(num_docs), key=scores.__getitem__)[-top_k:] would give.
+    """
+    top_k = min(top_k, num_docs)
+    if top_k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    # Untouched docs all score 0; only the highest-id ones can win a tie, so at most top_k are needed
+    touched = set(doc_ids.tolist()) if len(doc_ids) < num_docs else None
+    if touched is not None:
+        filler = []
+        doc_id = num_docs - 1
+        while len(filler) < top_k and doc_id >= 0:
+            if doc_id not in touched:
+                filler.append(doc_id)
+            doc_id -= 1
+        if filler:
+            doc_ids = np.concatenate([doc_ids, np.asarray(filler, dtype=doc_ids.dtype)])
+            scores = np.concatenate([scores, np.zeros(len(filler))])
+
+    if len(scores) > top_k:
+        # argpartition narrows to the candidates at or above the k-th best score,
+        # then every doc tied with the k-th score is kept so tie-breaking stays exact
+        kth = scores[np.argpartition(scores, len(scores) - top_k)[len(scores) - top_k]]
+        keep = scores >= kth
+        doc_ids, scores = doc_ids[keep], scores[keep]
+
+    order = np.lexsort((doc_ids, scores))[-top_k:]
+    return doc_ids[order], scores[order]
@@ -0,0 +1,323 @@
+import json
+import os
+import shutil
+import unicodedata
+import numpy as np
+
+from output_io import write_json_atomic
+
+# Bump whenever the on-disk layout or the vectorization changes
+CHARGRAM_FORMAT_VERSION = 1
+
+# n-grams are hashed into 2^FEATURE_BITS features (IDF is kept per feature), then folded into `dim` signed buckets
+FEATURE_BITS = 20
+_ROLL = np.uint64(0x100000001B3)
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+# Spelling variants seen in Mooré text: open vowels and ʋ/ɩ are often written without the special letter
+ORTHOGRAPHY_FOLD = {'ɛ': 'e', 'ɩ': 'i', 'ʋ': 'u', 'ɔ': 'o', '’': "'", 'ʼ': "'", '‘': "'"}
+
+class _FoldTable(dict):
+    # str.translate table dropping combining marks (tones, nasal tildes after NFD) and folding variant letters
+    def __init__(self):
+        super().__init__({ord(char): value for char, value in ORTHOGRAPHY_FOLD.items()})
+
+    def __missing__(self, codepoint):
+        value = None if unicodedata.combining(chr(codepoint)) else codepoint
+        self[codepoint] = value
+        return value
+
+_fold_table = _FoldTable()
+
+def normalize_text(text, fold=True):
+    text = text.lower()
+    if fold:
+        text = unicodedata.normalize('NFD', text).translate(_fold_table)
+    # Padding with spaces makes word starts and ends their own n-grams
+    return " " + " ".join(text.split()) + " "
+
+def ngram_features(texts, ngram_range):
+    """
+    Hashes every character n-gram of the (already normalized) texts at once.
+    Returns (doc_ids, feature_ids), one entry per n-gram occurrence.
+    """
+    encoded = [np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32) for text in texts]
+    if not encoded:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    codepoints = np.concatenate(encoded).astype(np.uint64)
+    doc_of = np.repeat(np.arange(len(texts)), [len(e) for e in encoded])
+
+    doc_ids, feature_ids = [], []
+    for n in range(ngram_range[0], ngram_range[1] + 1):
+        num_windows = len(codepoints) - n + 1
+        if num_windows <= 0:
+            continue
+        # Polynomial rolling hash over the window (uint64 arithmetic wraps), seeded with n
+        h = np.full(num_windows, n, dtype=np.uint64)
+        for j in range(n):
+            h = h * _ROLL + codepoints[j:j + num_windows]
+        inside = doc_of[:num_windows] == doc_of[n - 1:]  # windows must not span two texts
+        doc_ids.append(doc_of[:num_windows][inside])
+        feature_ids.append(((h[inside] * _MIX) >> np.uint64(64 - FEATURE_BITS)).astype(np.int64))
+    return np.concatenate(doc_ids), np.concatenate(feature_ids)
+
+def feature_counts(texts, settings):
+    # (doc_ids, feature_ids, counts) of the distinct features per text
+    doc_ids, feature_ids = ngram_features([normalize_text(t, settings["fold"]) for t in texts], settings["ngram_range"])
+    keys, counts = np.unique(doc_ids * (1 << FEATURE_BITS) + feature_ids, return_counts=True)
+    return keys >> FEATURE_BITS, keys & ((1 << FEATURE_BITS) - 1), counts
+
+def vectorize(texts, idf, settings):
+    """
+    L2-normalized TF-IDF vectors (sublinear tf) of the texts' character n-grams, folded into
+    settings["dim"] buckets with a hash sign (feature hashing), as a (len(texts), dim) float32 matrix.
+    """
+    dim = settings["dim"]
+    doc_ids, feature_ids, counts = feature_counts(texts, settings)
+    weights = (1 + np.log(counts)) * idf[feature_ids]
+    signs = 1 - 2 * ((feature_ids >> (FEATURE_BITS - 1)) & 1)
+    vectors = np.bincount(doc_ids * dim + feature_ids % dim, weights=signs * weights, minlength=len(texts) * dim)
+    vectors = vectors.reshape(len(texts), dim).astype(np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+def assign_lists(vectors, centroids, chunk_size=8192):
+    # Nearest centroid (by cosine) of every row
+    return np.concatenate([
+        (vectors[start:start + chunk_size] @ centroids.T).argmax(axis=1)
+        for start in range(0, len(vectors), chunk_size)
+    ]) if len(vectors) else np.empty(0, dtype=np.int64)
+
+def train_centroids(sample, num_lists, iterations=10, seed=0):
+    """
+    Spherical k-means on a sample of unit vectors (the IVF coarse quantizer).
+    Empty lists are re-seeded with random sample rows.
+    """
+    rng = np.random.RandomState(seed)
+    centroids = sample[rng.choice(len(sample), num_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assign = assign_lists(sample, centroids)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=num_lists)
+        non_empty = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty]
+        centroids[non_empty] = np.add.reduceat(sample[order], starts, axis=0)
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        np.divide(centroids, norms, out=centroids, where=norms > 0)
+    return centroids
+
+
+class CharNgramIndex():
+    """
+    Inverted-file (IVF) index over hashed character n-gram TF-IDF vectors.
+
+    Layout of the index directory:
+        manifest.json           settings, corpus fingerprint
+        idf.npy                 (2^FEATURE_BITS,) float32 per-feature IDF
+        centroids.npy           (num_lists, dim) float32 k-means centroids
+        vectors.npy             (num_rows, dim) float32, rows grouped by list
+        ids.npy                 (num_rows,) corpus id of every row
+        list_offsets.npy        (num_lists + 1,) row offsets of each list
+
+    A query only scores the rows of its nprobe closest lists; vectors.npy is memory-mapped,
+    so each probed list is one contiguous read.
+    """
+    def __init__(self, settings, idf, centroids, vectors, ids, list_offsets):
+        self.settings = settings
+        self.idf = idf
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.list_offsets = list_offsets
+
+    @classmethod
+    def build(cls, index_dir, get_text, row_ids, settings, chunk_size=8192):
+        """
+        get_text(corpus_id) -> text; row_ids: corpus ids to index.
+        Two streaming passes over the texts (IDF, then vectors), so memory stays at one chunk.
+        """
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        num_rows = len(row_ids)
+        rng = np.random.RandomState(settings["seed"])
+
+        # 1. Document frequency of every hashed feature
+        doc_freq = np.zeros(1 << FEATURE_BITS, dtype=np.int64)
+        for start in range(0, num_rows, chunk_size):
+            _, feature_ids, _ = feature_counts([get_text(i) for i in row_ids[start:start + chunk_size].tolist()], settings)
+            doc_freq += np.bincount(feature_ids, minlength=1 << FEATURE_BITS)
+        idf = (np.log((1 + num_rows) / (1 + doc_freq)) + 1).astype(np.float32)
+
+        # 2. Coarse quantizer trained on a sample
+        num_lists = max(1, min(settings["num_lists"] or int(np.sqrt(num_rows)), num_rows))
+        sample_size = min(num_rows, max(num_lists, settings["train_size"]))
+        sample_rows = np.sort(rng.choice(num_rows, sample_size, replace=False)) if num_rows else row_ids[:0]
+        sample = vectorize([get_text(i) for i in row_ids[sample_rows].tolist()], idf, settings)
+        centroids = train_centroids(sample, num_lists, seed=settings["seed"]) if num_rows else np.zeros((1, settings["dim"]), dtype=np.float32)
+
+        # 3. Vectors in corpus order, then regrouped by list into the final memmap
+        tmp_dir = f"{index_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        unordered = np.lib.format.open_memmap(os.path.join(tmp_dir, 'unordered.npy'), mode='w+', dtype=np.float32, shape=(num_rows, settings["dim"]))
+        lists = np.empty(num_rows, dtype=np.int64)
+        for start in range(0, num_rows, chunk_size):
+            block = vectorize([get_text(i) for i in row_ids[start:start + chunk_size].tolist()], idf, settings)
+            unordered[start:start + len(block)] = block
+            lists[start:start + len(block)] = assign_lists(block, centroids)
+
+        order = np.argsort(lists, kind='stable')
+        vectors = np.lib.format.open_memmap(os.path.join(tmp_dir, 'vectors.npy'), mode='w+', dtype=np.float32, shape=(num_rows, settings["dim"]))
+        for start in range(0, num_rows, chunk_size):
+            vectors[start:start + chunk_size] = unordered[order[start:start + chunk_size]]
+        vectors.flush()
+        del unordered, vectors
+        os.remove(os.path.join(tmp_dir, 'unordered.npy'))
+
+        list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(lists, minlength=len(centroids)), out=list_offsets[1:])
+        np.save(os.path.join(tmp_dir, 'idf.npy'), idf)
+        np.save(os.path.join(tmp_dir, 'centroids.npy'), centroids)
+        np.save(os.path.join(tmp_dir, 'ids.npy'), row_ids[order])
+        np.save(os.path.join(tmp_dir, 'list_offsets.npy'), list_offsets)
+        write_json_atomic(os.path.join(tmp_dir, 'manifest.json'), settings)
+
+        shutil.rmtree(index_dir, ignore_errors=True)
+        os.replace(tmp_dir, index_dir)
+        return cls.load(index_dir)
+
+    @classmethod
+    def load(cls, index_dir):
+        with open(os.path.join(index_dir, 'manifest.json'), 'r', encoding='utf-8') as f:
+            settings = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r' if name in ('vectors', 'ids') else None)
+            for name in ['idf', 'centroids', 'vectors', 'ids', 'list_offsets']
+        }
+        return cls(settings, **arrays)
+
+    def search_batch(self, texts, top_k=5, nprobe=16):
+        """
+        Returns one (corpus_ids, scores) pair per text, ascending by cosine similarity
+        (ties broken by corpus id), like BM25Index.top_k.
+        Queries probing the same list are scored together against its block of rows.
+        """
+        if not texts:
+            return []
+        queries = vectorize(texts, self.idf, self.settings)
+        nprobe = min(nprobe, len(self.centroids))
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+
+        candidates = [[] for _ in texts]
+        query_of = np.repeat(np.arange(len(texts)), nprobe)
+        probe_lists = probes.ravel()
+        order = np.argsort(probe_lists, kind='stable')
+        list_ids, starts = np.unique(probe_lists[order], return_index=True)
+        for list_id, lo, hi in zip(list_ids.tolist(), starts.tolist(), starts[1:].tolist() + [len(order)]):
+            row_lo, row_hi = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+            if row_lo == row_hi:
+                continue
+            members = query_of[order[lo:hi]]
+            scores = queries[members] @ np.asarray(self.vectors[row_lo:row_hi]).T
+            for query_id, row_scores in zip(members.tolist(), scores):
+                candidates[query_id].append((row_lo, row_scores))
+
+        results = []
+        for query_candidates in candidates:
+            if not query_candidates:
+                results.append((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)))
+                continue
+            rows = np.concatenate([np.arange(lo, lo + len(s)) for lo, s in query_candidates])
+            scores = np.concatenate([s for _, s in query_candidates]).astype(np.float64)
+            if len(scores) > top_k:
+                keep = np.argpartition(scores, len(scores) - top_k)[len(scores) - top_k:]
+                rows, scores = rows[keep], scores[keep]
+            ids = np.asarray(self.ids[rows], dtype=np.int64)
+            best = np.lexsort((ids, scores))[-top_k:]
+            results.append((ids[best], scores[best]))
+        return results
+
+
+class CharNgramRetriever():
+    """
+    Character n-gram retriever over a ParallelCorpus, tolerant to spelling variation
+    (diacritics and variant letters are folded before n-grams are taken).
+    Indexes are built per language on first use and cached on disk next to the BM25 index;
+    when the corpus was deduplicated, only cluster representatives are indexed.
+    """
+    def __init__(self, parallel_corpus, index_path=None, dim=1024, ngram_range=(2, 4), num_lists=None,
+                 nprobe=16, fold=True, train_size=65536, seed=0):
+        self.parallel_corpus = parallel_corpus
+        self.index_path = index_path or parallel_corpus.corpus_path + ".chargram"
+        self.nprobe = nprobe
+        self.settings = {
+            "dim": dim, "ngram_range": list(ngram_range), "num_lists": num_lists,
+            "fold": fold, "train_size": train_size, "seed": seed,
+        }
+        self.indexes = {}
+
+    def resolve_lang(self, query_lang):
+        # Same mapping as the BM25 search, so hybrid retrieval fuses rankings over one language
+        return self.parallel_corpus.resolve_lang(query_lang)
+
+    def index_manifest(self, lang):
+        pc = self.parallel_corpus
+        return dict(
+            self.settings,
+            format_version=CHARGRAM_FORMAT_VERSION,
+            lang=lang,
+            corpus={"fingerprint": pc.corpus.fingerprint, "num_docs": len(pc.corpus)},
+            dedup=pc.index_manifest()["dedup"] if pc.doc_map is not None else None,
+        )
+
+    def get_index(self, lang):
+        if lang in self.indexes:
+            return self.indexes[lang]
+        index_dir = os.path.join(self.index_path, lang)
+        manifest = self.index_manifest(lang)
+        index = None
+        try:
+            index = CharNgramIndex.load(index_dir)
+            if index.settings != manifest:
+                print(f"Char n-gram index at {index_dir} is stale. Rebuilding index...")
+                index = None
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Char n-gram index load failed ({e}). Rebuilding index...")
+
+        if index is None:
+            pc = self.parallel_corpus
+            row_ids = pc.doc_map if pc.doc_map is not None else np.arange(len(pc.corpus))
+            print(f"Building char n-gram index for {lang} ({len(row_ids)} rows)...")
+            index = CharNgramIndex.build(index_dir, lambda i: pc.corpus.get_text(lang, i), row_ids, manifest)
+        self.indexes[lang] = index
+        return index
+
+    def search_batch(self, texts, query_lang='src', top_k=5):
+        index = self.get_index(self.resolve_lang(query_lang))
+        return [
+            self.parallel_corpus.format_results(list(zip(ids.tolist(), scores.tolist())))
+            for ids, scores in index.search_batch(texts, top_k=top_k, nprobe=self.nprobe)
+        ]
+
+    def search(self, text, query_lang='src', top_k=5):
+        return self.search_batch([text], query_lang=query_lang, top_k=top_k)[0]
+
+
+def reciprocal_rank_fusion(result_lists, top_k=5, k=60):
+    """
+    Fuses ranked result lists (each ascending by score, as returned by the retrievers) with
+    RRF: every pair scores sum(1 / (k + rank)). Returns the top_k fused results, ascending.
+    """
+    fused, items = {}, {}
+    for results in result_lists:
+        for rank, item in enumerate(reversed(results), start=1):
+            fused[item["idx"]] = fused.get(item["idx"], 0.0) + 1.0 / (k + rank)
+            items.setdefault(item["idx"], item)
+    best = sorted(fused, key=lambda idx: (fused[idx], idx))[-top_k:]
+    return [dict(items[idx], score=fused[idx]) for idx in best]
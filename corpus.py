@@ -1,20 +1,69 @@
 import json
 import os
-import pickle
-from rank_bm25 import BM25Okapi
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from bm25 import BM25Index, INDEX_FORMAT_VERSION, count_postings
+from corpus_store import ColumnarCorpus
+from output_io import write_json_atomic
+from dedup import MinHasher, cluster_signatures, cluster_stats
 from tokenizer import *
 
-lang2tokenizer = {
-    'en': EngTokenizer(),
-    'eng': EngTokenizer(),
-    'mos': MosTokenizer(),
-}
+# Below this many documents per worker a process pool costs more than it saves
+MIN_SHARD_SIZE = 20000
+# Candidates fetched per requested example when diversifying results across duplicate clusters
+DIVERSIFY_OVERFETCH = 4
+
+def tokenize_for_index(text, lang, cache=True):
+    # Index and query side tokenization (must match index_manifest()'s tokenizer settings)
+    tokenizer = get_tokenizer(lang)
+    if lang == 'zh':
+        return tokenizer.tokenize(text, remove_punc=True, cut_for_search=True, cache=cache)
+    return tokenizer.tokenize(text, remove_punc=True, cache=cache)
+
+def postings_signatures(minhasher, lang, postings, doc_offset=0):
+    # MinHash signatures of each document's token set, straight from its postings
+    terms, term_ids, doc_ids, tfs, doc_len = postings
+    term_hashes = minhasher.hash_tokens(terms, prefix=f"{lang}\0")
+    return minhasher.signatures(doc_ids, term_hashes[term_ids], len(doc_len), doc_offset=doc_offset)
+
+def build_postings_shard(store_dir, lang, start, end, minhasher=None):
+    """
+    Worker for the parallel index build: tokenizes rows [start, end) of one column straight
+    from the store (nothing but the row range is sent to the process) and counts their postings.
+    Returns (postings, signatures); signatures is None unless a MinHasher is given.
+    """
+    corpus = ColumnarCorpus(store_dir)
+    vocab = Vocabulary()
+    docs = [vocab.encode(tokenize_for_index(text, lang, cache=False)) for text in corpus.iter_column(lang, start, end)]
+    terms, term_ids, doc_ids, tfs, doc_len = count_postings(docs, doc_offset=start)
+    postings = (vocab.decode(terms), term_ids, doc_ids, tfs, doc_len)
+    signatures = postings_signatures(minhasher, lang, postings, doc_offset=start) if minhasher else None
+    return postings, signatures
 
 class ParallelCorpus():
-    def __init__(self, src_lang, tgt_lang, corpus_path, construct_bm25=True):
+    def __init__(self, src_lang, tgt_lang, corpus_path, construct_bm25=True, index_path=None, store_path=None, k1=1.5, b=0.75, epsilon=0.25, index_workers=-1,
+                 dedup_threshold=None, dedup_num_perm=64, dedup_index=True):
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
         self.corpus_path = corpus_path
+        # Memory-mapped columnar copy of the corpus (converted once from corpus_path)
+        self.store_path = store_path or corpus_path + ".cols"
+        # On-disk BM25 index directory (flat .npy arrays + manifest.json)
+        self.index_path = index_path or corpus_path + ".bm25"
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        # Processes used to build the BM25 index (-1: all cores)
+        self.index_workers = (os.cpu_count() or 1) if index_workers == -1 else index_workers
+        # Near-duplicate pairs (MinHash-LSH over both sides' tokens) are clustered when a Jaccard
+        # threshold is given; with dedup_index only one representative per cluster is indexed
+        self.dedup_threshold = dedup_threshold
+        self.dedup_index = dedup_index
+        self.minhasher = MinHasher(num_perm=dedup_num_perm) if dedup_threshold else None
+        self.rep_of = None      # corpus id -> corpus id of its cluster representative
+        self.signatures = None  # (num_docs, num_perm) MinHash signatures, kept for append()
+        self.doc_map = None     # index doc id -> corpus id, when only representatives are indexed
         self.load_corpus()
         if construct_bm25:
             self.construct_bm25()
@@ -28,69 +77,240 @@ class ParallelCorpus():
     
     def load_corpus(self):
         print(f"Loading corpus from {self.corpus_path}...")
-        self.corpus = []
         try:
-            with open(self.corpus_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-            # Normalize data to list of dicts with known keys
-            for item in data:
-                # Support your structure keys: 'mos', 'en'
-                self.corpus.append({
-                    self.src_lang: item.get(self.src_lang, ""),
-                    self.tgt_lang: item.get(self.tgt_lang, ""),
-                    'source': item.get('source', 'n/a')
-                })
+            # Rows are decoded lazily from the columnar store; the JSON is only parsed when (re)converting
+            self.corpus = ColumnarCorpus.open_or_convert(self.corpus_path, self.store_path, [self.src_lang, self.tgt_lang])
         except Exception as e:
             print(f"Error loading corpus: {e}")
             raise
 
+    def index_manifest(self):
+        """
+        Everything the on-disk BM25 index depends on. A stored manifest that differs
+        from this one means the index is stale and must be rebuilt.
+        """
+        return {
+            "format_version": INDEX_FORMAT_VERSION,
+            "corpus": {"fingerprint": self.corpus.fingerprint, "num_docs": len(self.corpus)},
+            "langs": [self.src_lang, self.tgt_lang],
+            "tokenizers": {
+                lang: dict(get_tokenizer(lang).settings(), remove_punc=True, cut_for_search=(lang == 'zh'))
+                for lang in [self.src_lang, self.tgt_lang]
+            },
+            "bm25": {"k1": self.k1, "b": self.b, "epsilon": self.epsilon},
+            "dedup": {
+                "threshold": self.dedup_threshold, "num_perm": self.minhasher.num_perm,
+                "seed": self.minhasher.seed, "index_representatives_only": self.dedup_index,
+            } if self.minhasher else None,
+        }
+
+    def read_index_manifest(self):
+        # Returns the stored manifest if it is still valid for this corpus and these settings, else None
+        manifest_path = os.path.join(self.index_path, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            stored = json.load(f)
+        return stored if stored == self.index_manifest() else None
+
     def construct_bm25(self):
-        # 1. Define Cache Filename
-        cache_path = self.corpus_path + ".bm25.pkl"
-        
-        # 2. Try Loading Cache
-        if os.path.exists(cache_path):
-            print(f"Loading cached BM25 index from {cache_path}...")
+        # 1. Open the index directory if its manifest still matches
+        try:
+            manifest = self.read_index_manifest()
+        except Exception as e:
+            print(f"Could not read index manifest ({e}). Rebuilding index...")
+            manifest = None
+
+        if manifest is not None:
+            print(f"Loading BM25 index from {self.index_path}...")
             try:
-                with open(cache_path, 'rb') as f:
-                    self.bm25 = pickle.load(f)
+                self.bm25 = {
+                    lang: BM25Index.load(os.path.join(self.index_path, lang), k1=self.k1, b=self.b, epsilon=self.epsilon)
+                    for lang in [self.src_lang, self.tgt_lang]
+                }
+                if self.minhasher:
+                    self.rep_of = np.load(os.path.join(self.index_path, 'rep_of.npy'), mmap_mode='r')
+                    self.signatures = np.load(os.path.join(self.index_path, 'signatures.npy'), mmap_mode='r')
+                    if self.dedup_index:
+                        self.doc_map = np.load(os.path.join(self.index_path, 'doc_map.npy'), mmap_mode='r')
                 return  # Exit function early if successful
             except Exception as e:
-                print(f"Cache load failed ({e}). Rebuilding index...")
+                print(f"Index load failed ({e}). Rebuilding index...")
+        elif os.path.exists(self.index_path):
+            print(f"BM25 index at {self.index_path} is stale. Rebuilding index...")
 
-        # 3. Build Index (If no cache or load failed)
-        self.bm25 = {}
+        # 2. Build Index (If missing, stale or load failed)
+        shards = {}
         for lang in [self.src_lang, self.tgt_lang]:
-            tokenizer = lang2tokenizer.get(lang, Tokenizer())
+            print(f"Tokenizing {lang} for the BM25 index...")
+            shards[lang] = self.count_postings(lang)
+
+        # 3. Cluster near-duplicate pairs (a pair's token set is the union of both sides)
+        keep_docs = None
+        if self.minhasher:
+            print(f"Clustering near-duplicate pairs (Jaccard >= {self.dedup_threshold})...")
+            self.signatures = np.minimum(*[np.concatenate([sig for _, sig in shards[lang]]) for lang in shards])
+            self.rep_of = cluster_signatures(self.signatures, self.dedup_threshold)
+            print("Near-duplicates: {num_docs} pairs, {num_clusters} clusters, {num_duplicates} duplicates".format(**cluster_stats(self.rep_of)))
+            if self.dedup_index:
+                keep_docs = self.rep_of == np.arange(len(self.rep_of))
+                self.doc_map = np.flatnonzero(keep_docs)
+
+        self.bm25 = {}
+        for lang in list(shards):
             print(f"Building BM25 index for {lang}...")
-            
-            # Use cut_for_search only if Chinese
-            if lang == 'zh':
-                tokenized_corpus = [tokenizer.tokenize(doc[lang], remove_punc=True, cut_for_search=True) for doc in self.corpus]
-            else:
-                tokenized_corpus = [tokenizer.tokenize(doc[lang], remove_punc=True) for doc in self.corpus]
-                
-            self.bm25[lang] = BM25Okapi(tokenized_corpus)
-
-        # 4. Save Cache
-        print(f"Saving BM25 index to {cache_path}...")
+            self.bm25[lang] = BM25Index.from_shards(
+                [postings for postings, _ in shards.pop(lang)],
+                k1=self.k1, b=self.b, epsilon=self.epsilon, keep_docs=keep_docs,
+            )
+
+        # 4. Save into a temporary directory and swap it in, so readers never see a half-written index
+        self.save_bm25()
+
+    def count_postings(self, lang):
+        """
+        Splits the column into contiguous shards that are tokenized and counted in a process pool
+        (with their MinHash signatures when deduplicating). Merging the shards in document order
+        gives an index identical to a single-process build.
+        """
+        num_docs = len(self.corpus)
+        workers = max(1, min(self.index_workers, num_docs // MIN_SHARD_SIZE))
+        if workers == 1:
+            return [build_postings_shard(self.store_path, lang, 0, num_docs, self.minhasher)]
+
+        # A few shards per worker evens out uneven sentence lengths
+        num_shards = workers * 4
+        bounds = [num_docs * i // num_shards for i in range(num_shards + 1)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(
+                build_postings_shard,
+                [self.store_path] * num_shards, [lang] * num_shards, bounds[:-1], bounds[1:], [self.minhasher] * num_shards,
+            ))
+
+    def save_bm25(self):
+        print(f"Saving BM25 index to {self.index_path}...")
+        tmp_path = f"{self.index_path}.tmp-{os.getpid()}"
         try:
-            with open(cache_path, 'wb') as f:
-                pickle.dump(self.bm25, f)
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            for lang, index in self.bm25.items():
+                index.save(os.path.join(tmp_path, lang))
+            if self.minhasher:
+                np.save(os.path.join(tmp_path, 'rep_of.npy'), np.asarray(self.rep_of))
+                np.save(os.path.join(tmp_path, 'signatures.npy'), np.asarray(self.signatures))
+                if self.doc_map is not None:
+                    np.save(os.path.join(tmp_path, 'doc_map.npy'), np.asarray(self.doc_map))
+            write_json_atomic(os.path.join(tmp_path, 'manifest.json'), self.index_manifest())
+            shutil.rmtree(self.index_path, ignore_errors=True)
+            os.replace(tmp_path, self.index_path)
         except Exception as e:
-            print(f"Warning: Could not save cache: {e}")
-    
-    def search_by_bm25(self, text, query_lang='src', top_k=5):
-        target_lang = self.src_lang if query_lang == 'src' else self.tgt_lang
-        tokenizer = lang2tokenizer.get(target_lang, Tokenizer())
-
-        if target_lang == 'zh':
-            query = tokenizer.tokenize(text, remove_punc=True, cut_for_search=True)
-        else:
-            query = tokenizer.tokenize(text, remove_punc=True)
-
-        doc_scores = self.bm25[target_lang].get_scores(query)
-        top_k_idx = sorted(range(len(doc_scores)), key=lambda i: doc_scores[i])[-top_k:]
-        
-        return [{"pair": self.corpus[i], "score": doc_scores[i]} for i in top_k_idx]
\ No newline at end of file
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            print(f"Warning: Could not save index: {e}")
+
+    def append(self, pairs):
+        """
+        Adds new pairs (dicts with both languages and optionally 'source') to the corpus store
+        and, if built, to the BM25 indexes. Only the new pairs are tokenized; the indexes are
+        updated in place and saved with a manifest matching the grown store.
+        """
+        pairs = list(pairs)
+        if not pairs:
+            return
+        num_old = len(self.corpus)
+        self.corpus = self.corpus.append(pairs)
+        if not getattr(self, 'bm25', None):
+            return
+
+        tokenized = {lang: [self.tokenize_query(pair.get(lang, ""), lang, cache=False) for pair in pairs] for lang in self.bm25}
+        new_docs = np.arange(num_old, num_old + len(pairs))
+        if self.minhasher:
+            # New pairs join an existing cluster or form new ones; existing clusters keep their representative
+            new_signatures = np.minimum(*[
+                postings_signatures(self.minhasher, lang, count_postings(tokenized[lang], doc_offset=num_old), doc_offset=num_old)
+                for lang in tokenized
+            ])
+            self.signatures = np.concatenate([self.signatures, new_signatures])
+            new_reps = cluster_signatures(self.signatures, self.dedup_threshold)[num_old:]
+            self.rep_of = np.concatenate([self.rep_of, new_reps])
+            if self.doc_map is not None:
+                new_docs = new_docs[new_reps == new_docs]
+                self.doc_map = np.concatenate([self.doc_map, new_docs])
+
+        for lang, index in self.bm25.items():
+            index.append([tokenized[lang][doc_id - num_old] for doc_id in new_docs.tolist()])
+        self.save_bm25()
+
+    def resolve_lang(self, query_lang):
+        # Language of the index a query is scored against: 'src' / 'tgt' or a language code of the corpus
+        if query_lang in (self.src_lang, self.tgt_lang):
+            return query_lang
+        return self.src_lang if query_lang == 'src' else self.tgt_lang
+
+    def tokenize_query(self, text, target_lang, cache=True):
+        return tokenize_for_index(text, target_lang, cache=cache)
+
+    def search_by_bm25(self, text, query_lang='src', top_k=5, diversify=False):
+        """
+        diversify: return at most one pair per near-duplicate cluster (only has an effect when
+        the index also holds duplicates; a representatives-only index is already diverse).
+        """
+        target_lang = self.resolve_lang(query_lang)
+        query = self.tokenize_query(text, target_lang)
+
+        if self.diversifies(diversify):
+            return self.format_results(self.diverse_top_k(self.bm25[target_lang], query, top_k))
+
+        # Only the posting lists of the query terms are scored; results come back ascending by score
+        top_k_idx, top_k_scores = self.bm25[target_lang].top_k(query, top_k=top_k)
+
+        return self.format_results(self.to_corpus_hits(top_k_idx, top_k_scores))
+
+    def search_by_bm25_batch(self, texts, query_lang='src', top_k=5, chunk_size=256, diversify=False):
+        """
+        Same results as calling search_by_bm25 on every text, but all queries are scored
+        together as sparse matrix products (chunk_size queries at a time).
+        """
+        target_lang = self.resolve_lang(query_lang)
+        queries = [self.tokenize_query(text, target_lang) for text in texts]
+        index = self.bm25[target_lang]
+        diversify = self.diversifies(diversify)
+
+        results = []
+        fetch = top_k * DIVERSIFY_OVERFETCH if diversify else top_k
+        for query, (top_k_idx, top_k_scores) in zip(queries, index.top_k_batch(queries, top_k=fetch, chunk_size=chunk_size)):
+            hits = self.to_corpus_hits(top_k_idx, top_k_scores)
+            if diversify:
+                hits = self.diverse_hits(hits, top_k)
+                if len(hits) < top_k and fetch < index.num_docs:
+                    hits = self.diverse_top_k(index, query, top_k)  # rare: the candidates were mostly one cluster
+            results.append(self.format_results(hits))
+        return results
+
+    def diversifies(self, diversify):
+        return diversify and self.rep_of is not None and self.doc_map is None
+
+    def to_corpus_hits(self, top_k_idx, top_k_scores):
+        # Index doc ids -> corpus ids (they differ when only cluster representatives are indexed)
+        corpus_ids = top_k_idx.tolist() if self.doc_map is None else self.doc_map[top_k_idx].tolist()
+        return list(zip(corpus_ids, top_k_scores))
+
+    def diverse_hits(self, hits, top_k):
+        # Best-scoring hit of each cluster, still ascending by score
+        seen, diverse = set(), []
+        for i, score in reversed(hits):
+            rep = int(self.rep_of[i])
+            if rep not in seen:
+                seen.add(rep)
+                diverse.append((i, score))
+        return diverse[:top_k][::-1]
+
+    def diverse_top_k(self, index, query, top_k):
+        # Over-fetch candidates until top_k distinct clusters are found (or the corpus is exhausted)
+        fetch = top_k * DIVERSIFY_OVERFETCH
+        while True:
+            hits = self.diverse_hits(self.to_corpus_hits(*index.top_k(query, top_k=fetch)), top_k)
+            if len(hits) >= top_k or fetch >= index.num_docs:
+                return hits
+            fetch *= DIVERSIFY_OVERFETCH
+
+    def format_results(self, hits):
+        return [{"pair": self.corpus[i], "score": score, "idx": i} for i, score in hits]
@@ -0,0 +1,230 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import shutil
+from array import array
+
+from output_io import existing_data_path, file_sha256, write_json_atomic, iter_json_records
+
+# Bump whenever the on-disk layout written by ColumnarCorpus.convert changes
+STORE_FORMAT_VERSION = 1
+
+def save_npy_atomic(path, values):
+    import numpy as np
+    tmp_path = f"{path}.tmp-{os.getpid()}.npy"
+    np.save(tmp_path, values)
+    os.replace(tmp_path, path)
+
+class ColumnarCorpus():
+    """
+    Read-only, memory-mapped columnar parallel corpus.
+
+    Layout of the store directory:
+        manifest.json          columns, row count, interned source labels, source file fingerprint
+        <lang>.bin             all sentences of that language as one concatenated UTF-8 blob
+        <lang>.offsets.npy     (num_rows + 1,) int64 byte offsets into <lang>.bin
+        source.codes.npy       (num_rows,) int32 index into manifest["labels"]
+
+    Rows are decoded on demand, so resident memory stays at the pages actually touched.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'manifest.json'), 'r', encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        self.columns = self.manifest["columns"]
+        self.labels = self.manifest["labels"]
+        self.fingerprint = self.manifest["fingerprint"]
+
+        import numpy as np
+
+        self.offsets = {}
+        self.blobs = {}
+        for lang in self.columns:
+            self.offsets[lang] = np.load(os.path.join(store_dir, f"{lang}.offsets.npy"), mmap_mode='r')
+            self.blobs[lang] = self._map_blob(os.path.join(store_dir, f"{lang}.bin"))
+        self.codes = np.load(os.path.join(store_dir, 'source.codes.npy'), mmap_mode='r')
+
+    @staticmethod
+    def _map_blob(path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''  # mmap refuses empty files
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        # The manifest is authoritative: arrays may run past it after an interrupted append
+        return self.manifest["num_rows"]
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("corpus index out of range")
+        item = {lang: self.get_text(lang, idx) for lang in self.columns}
+        item['source'] = self.labels[self.codes[idx]]
+        return item
+
+    def get_text(self, lang, idx):
+        offsets = self.offsets[lang]
+        return self.blobs[lang][offsets[idx]:offsets[idx + 1]].decode('utf-8')
+
+    def iter_column(self, lang, start=0, end=None):
+        # Sequential decode of one column, or of rows [start, end) of it (used for index building)
+        offsets = self.offsets[lang][start:(len(self) if end is None else end) + 1].tolist()
+        blob = self.blobs[lang]
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield blob[start:end].decode('utf-8')
+
+    @staticmethod
+    def source_stat(source_path):
+        stat = os.stat(source_path)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    @classmethod
+    def is_fresh(cls, store_dir, source_path, columns):
+        """
+        True if store_dir was converted from the current content of source_path with these columns.
+        The source is only re-hashed when its size or mtime changed.
+        """
+        manifest_path = os.path.join(store_dir, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return False
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get("format_version") != STORE_FORMAT_VERSION or manifest.get("columns") != list(columns):
+            return False
+
+        stat = cls.source_stat(source_path)
+        source = manifest.get("source", {})
+        if source.get("size") == stat["size"] and source.get("mtime_ns") == stat["mtime_ns"]:
+            return True
+        if source.get("sha256") != file_sha256(source_path):
+            return False
+        # Same content with a new mtime (e.g. copied file): refresh the stat fields only
+        manifest["source"] = dict(source, **stat)
+        write_json_atomic(manifest_path, manifest)
+        return True
+
+    @classmethod
+    def convert(cls, source_path, store_dir, columns, records=None):
+        """
+        One-time conversion of a JSON list (or JSONL) corpus into a columnar store.
+        Rows are streamed to the blobs, so only the offsets are kept in memory.
+        `records` can be given to convert from an iterator instead of source_path.
+        """
+        tmp_dir = f"{store_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        blob_files = {lang: open(os.path.join(tmp_dir, f"{lang}.bin"), 'wb') for lang in columns}
+        offsets = {lang: array('q', [0]) for lang in columns}
+        codes = array('i')
+        label_to_code = {}
+        content_sha = hashlib.sha256()
+        try:
+            for item in (records if records is not None else iter_json_records(source_path)):
+                for lang in columns:
+                    data = item.get(lang, "").encode('utf-8')
+                    blob_files[lang].write(data)
+                    offsets[lang].append(offsets[lang][-1] + len(data))
+                    content_sha.update(data + b'\0')
+                label = item.get('source', 'n/a')
+                content_sha.update(label.encode('utf-8') + b'\n')
+                code = label_to_code.get(label)
+                if code is None:
+                    code = label_to_code[label] = len(label_to_code)
+                codes.append(code)
+        finally:
+            for f in blob_files.values():
+                f.close()
+
+        import numpy as np
+        for lang in columns:
+            np.save(os.path.join(tmp_dir, f"{lang}.offsets.npy"), np.frombuffer(offsets[lang], dtype=np.int64))
+        np.save(os.path.join(tmp_dir, 'source.codes.npy'), np.frombuffer(codes, dtype=np.int32))
+
+        manifest = {
+            "format_version": STORE_FORMAT_VERSION,
+            "columns": list(columns),
+            "num_rows": len(codes),
+            "labels": list(label_to_code),
+            "source": dict(cls.source_stat(source_path), sha256=file_sha256(source_path)) if source_path else {},
+            # Hash of the stored rows; derived indexes record it to detect staleness
+            "fingerprint": content_sha.hexdigest(),
+        }
+        write_json_atomic(os.path.join(tmp_dir, 'manifest.json'), manifest)
+
+        shutil.rmtree(store_dir, ignore_errors=True)
+        os.replace(tmp_dir, store_dir)
+        return cls(store_dir)
+
+    def append(self, records):
+        """
+        Appends rows in place and returns the reopened store.
+        Blobs are extended and only the small offset/code arrays are rewritten; manifest.json is
+        replaced last, so an interrupted append leaves the previous rows intact (stray bytes past
+        the recorded row count are dropped on the next append).
+        The appended rows live only in the store: reconverting from the source file discards them.
+        """
+        num_rows = self.manifest["num_rows"]
+        label_to_code = {label: code for code, label in enumerate(self.labels)}
+        offsets = {lang: array('q', self.offsets[lang][:num_rows + 1].tolist()) for lang in self.columns}
+        codes = array('i', self.codes[:num_rows].tolist())
+        content_sha = hashlib.sha256()
+
+        for lang in self.columns:
+            with open(os.path.join(self.store_dir, f"{lang}.bin"), 'r+b') as f:
+                f.truncate(offsets[lang][-1])
+        blob_files = {lang: open(os.path.join(self.store_dir, f"{lang}.bin"), 'ab') for lang in self.columns}
+        try:
+            for item in records:
+                for lang in self.columns:
+                    data = item.get(lang, "").encode('utf-8')
+                    blob_files[lang].write(data)
+                    offsets[lang].append(offsets[lang][-1] + len(data))
+                    content_sha.update(data + b'\0')
+                label = item.get('source', 'n/a')
+                content_sha.update(label.encode('utf-8') + b'\n')
+                code = label_to_code.get(label)
+                if code is None:
+                    code = label_to_code[label] = len(label_to_code)
+                codes.append(code)
+        finally:
+            for f in blob_files.values():
+                f.close()
+
+        import numpy as np
+        for lang in self.columns:
+            save_npy_atomic(os.path.join(self.store_dir, f"{lang}.offsets.npy"), np.frombuffer(offsets[lang], dtype=np.int64))
+        save_npy_atomic(os.path.join(self.store_dir, 'source.codes.npy'), np.frombuffer(codes, dtype=np.int32))
+
+        manifest = dict(
+            self.manifest,
+            num_rows=len(codes),
+            labels=list(label_to_code),
+            # Chained, so it still changes whenever the stored rows do
+            fingerprint=hashlib.sha256(f"{self.fingerprint}:{content_sha.hexdigest()}".encode('utf-8')).hexdigest(),
+        )
+        write_json_atomic(os.path.join(self.store_dir, 'manifest.json'), manifest)
+        return type(self)(self.store_dir)
+
+    @classmethod
+    def open_or_convert(cls, source_path, store_dir, columns):
+        if not cls.is_fresh(store_dir, source_path, columns):
+            print(f"Converting {source_path} to columnar store {store_dir}...")
+            return cls.convert(source_path, store_dir, columns)
+        return cls(store_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert a JSON/JSONL parallel corpus into a columnar store")
+    parser.add_argument('--corpus_path', type=existing_data_path, default='mossi_corpus.jsonl')
+    parser.add_argument('--store_path', type=str, default=None)
+    parser.add_argument('--columns', type=str, nargs='+', default=['mos', 'en'])
+    args = parser.parse_args()
+
+    store_path = args.store_path or args.corpus_path + ".cols"
+    store = ColumnarCorpus.convert(args.corpus_path, store_path, args.columns)
+    print(f"Wrote {len(store)} rows to {store_path}")
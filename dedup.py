@@ -0,0 +1,118 @@
+import zlib
+import numpy as np
+
+# Universal hashing h(x) = (a * x + b) mod p; with p < 2^31 every product fits in uint64
+MERSENNE_PRIME = (1 << 31) - 1
+# Signature value of a document without tokens (larger than any hash)
+EMPTY_HASH = np.uint32(0xFFFFFFFF)
+
+class MinHasher():
+    """
+    MinHash signatures over token sets, computed from flat postings with NumPy.
+    Tokens are hashed with crc32 (salted with a per-column prefix), so signatures are
+    stable across processes and runs and can be computed shard by shard.
+    The signature of a union of sets is the elementwise minimum of their signatures,
+    which is how the two sides of a pair are combined.
+    """
+    def __init__(self, num_perm=64, seed=1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.seed = seed
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+
+    @staticmethod
+    def hash_tokens(tokens, prefix=""):
+        return np.fromiter(
+            (zlib.crc32(f"{prefix}{token}".encode('utf-8')) % MERSENNE_PRIME for token in tokens),
+            dtype=np.uint64, count=len(tokens),
+        )
+
+    def signatures(self, doc_ids, token_hashes, num_docs, doc_offset=0, chunk_size=1 << 15):
+        """
+        doc_ids / token_hashes: one entry per distinct token of each document, doc_ids ascending
+        (the posting order of bm25.count_postings). Returns a (num_docs, num_perm) uint32 array.
+        """
+        signatures = np.full((num_docs, self.num_perm), EMPTY_HASH, dtype=np.uint32)
+        for start in range(0, len(doc_ids), chunk_size):
+            docs = np.asarray(doc_ids[start:start + chunk_size], dtype=np.int64) - doc_offset
+            hashes = np.asarray(token_hashes[start:start + chunk_size], dtype=np.uint64)
+            permuted = (hashes[:, None] * self.a + self.b) % MERSENNE_PRIME
+            # Segment starts of each document inside this chunk (a document may straddle two chunks)
+            starts = np.flatnonzero(np.r_[True, docs[1:] != docs[:-1]])
+            chunk_min = np.minimum.reduceat(permuted, starts, axis=0).astype(np.uint32)
+            rows = docs[starts]
+            signatures[rows] = np.minimum(signatures[rows], chunk_min)
+        return signatures
+
+
+def lsh_params(threshold, num_perm):
+    """
+    Picks (bands, rows) with bands * rows <= num_perm that minimize the summed false positive
+    and false negative probability mass around the Jaccard threshold.
+    """
+    xs = np.linspace(0, 1, 201)
+    best, best_error = (1, num_perm), None
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        p_candidate = 1 - (1 - xs ** rows) ** bands
+        error = p_candidate[xs < threshold].sum() + (1 - p_candidate[xs >= threshold]).sum()
+        if best_error is None or error < best_error:
+            best, best_error = (bands, rows), error
+    return best
+
+def connected_components(num_nodes, u, v):
+    # Label propagation with pointer jumping; every node ends up labelled with the smallest id in its component
+    labels = np.arange(num_nodes, dtype=np.int64)
+    while len(u):
+        low = np.minimum(labels[u], labels[v])
+        if np.array_equal(low, labels[u]) and np.array_equal(low, labels[v]):
+            break
+        np.minimum.at(labels, u, low)
+        np.minimum.at(labels, v, low)
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+    return labels
+
+def cluster_signatures(signatures, threshold, bands=None, rows=None, seed=1):
+    """
+    Groups near-duplicate documents with LSH banding.
+    Within each band bucket every document is compared to the bucket's smallest id; pairs whose
+    estimated Jaccard similarity (fraction of equal signature values) reaches the threshold are
+    linked. Returns rep_of: for every document, the smallest document id of its cluster
+    (the cluster representative, so representatives satisfy rep_of[i] == i).
+    """
+    num_docs, num_perm = signatures.shape
+    if bands is None or rows is None:
+        bands, rows = lsh_params(threshold, num_perm)
+    if num_docs == 0:
+        return np.empty(0, dtype=np.int64)
+
+    # 1. Candidate pairs (leader, member) from every band
+    multipliers = np.random.RandomState(seed).randint(1, 1 << 31, size=rows).astype(np.uint64) * 2 + 1
+    pair_keys = []
+    for band in range(bands):
+        block = signatures[:, band * rows:(band + 1) * rows].astype(np.uint64)
+        keys = (block * multipliers).sum(axis=1)  # wraps modulo 2^64; collisions are filtered in step 2
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        group_start = np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+        leaders = order[np.maximum.accumulate(np.where(group_start, np.arange(num_docs), 0))]
+        members = order[~group_start]
+        pair_keys.append(leaders[~group_start] * num_docs + members)
+    pair_keys = np.unique(np.concatenate(pair_keys))
+    u, v = pair_keys // num_docs, pair_keys % num_docs
+
+    # 2. Keep candidates whose estimated Jaccard similarity reaches the threshold
+    keep = np.empty(len(u), dtype=bool)
+    for start in range(0, len(u), 1 << 16):
+        su, sv = u[start:start + (1 << 16)], v[start:start + (1 << 16)]
+        keep[start:start + len(su)] = (signatures[su] == signatures[sv]).mean(axis=1) >= threshold
+    return connected_components(num_docs, u[keep], v[keep])
+
+def cluster_stats(rep_of):
+    num_clusters = int((rep_of == np.arange(len(rep_of))).sum())
+    return {"num_docs": len(rep_of), "num_clusters": num_clusters, "num_duplicates": len(rep_of) - num_clusters}
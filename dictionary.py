@@ -1,14 +1,255 @@
 import json
-from rapidfuzz import process, fuzz
+import os
+import re
+import shutil
+from collections import OrderedDict, deque
+import numpy as np
+from corpus_store import ColumnarCorpus
+from output_io import file_sha256, write_json_atomic
+from tokenizer import get_tokenizer
+
+# Fuzzy matches must score strictly above this (WRatio, 0-100)
+FUZZY_THRESHOLD = 85
+# Bump whenever the snapshot layout written by WordDictionary.save_snapshot changes
+SNAPSHOT_FORMAT_VERSION = 1
+FUZZY_ARRAYS = ['order', 'lens', 'char_counts', 'multi', 'set_lens']
+
+class FuzzyIndex():
+    """
+    Candidate prefilter for WRatio > FUZZY_THRESHOLD lookups over the dictionary headwords.
+
+    WRatio is built from Indel similarities, which are bounded by the number of characters two
+    strings have in common. Headwords are bucketed by length and stored as a character-count
+    matrix, so for a query we only look at lengths that can reach the threshold (length ratio <= 8)
+    and keep those whose character overlap can still score above it:
+      - length ratio < 1.5 (ratio / token ratios):    2 * common / (len_q + len_c) > 0.85
+      - length ratio >= 1.5 (partial ratios * 0.9):   common > 0.894 * min(len_q, len_c)
+    Multi-word headwords use looser bounds (token-set scores can reach 100 when the query is one
+    of their words). The bounds never reject a headword that could pass the threshold, so scoring
+    the survivors with WRatio gives exactly the same matches as scanning every headword.
+    """
+    def __init__(self, choices, order, lens, char_counts, multi, set_lens, alphabet, token_to_multi):
+        self.choices = choices
+        self.order = order
+        self.lens = lens
+        self.char_counts = char_counts
+        self.multi = multi
+        self.set_lens = set_lens
+        self.alphabet = alphabet
+        self.token_to_multi = token_to_multi
+
+    @classmethod
+    def build(cls, choices):
+        order = np.argsort([len(c) for c in choices], kind='stable')
+        lens = np.array([len(choices[i]) for i in order], dtype=np.int64)
+
+        alphabet = {}
+        for choice in choices:
+            for ch in choice:
+                alphabet.setdefault(ch, len(alphabet))
+        char_counts = np.zeros((len(choices), max(1, len(alphabet))), dtype=np.uint8)
+        multi = np.zeros(len(choices), dtype=bool)
+        set_lens = lens.copy()
+        token_to_multi = {}
+        for row, i in enumerate(order.tolist()):
+            choice = choices[i]
+            for ch in choice:
+                col = alphabet[ch]
+                char_counts[row, col] = min(255, char_counts[row, col] + 1)
+            if any(ch.isspace() for ch in choice):
+                tokens = set(choice.split())
+                multi[row] = True
+                set_lens[row] = len(" ".join(tokens))
+                for token in tokens:
+                    token_to_multi.setdefault(token, []).append(i)
+        return cls(choices, order, lens, char_counts, multi, set_lens, alphabet, token_to_multi)
+
+    def save(self, index_dir):
+        for name in FUZZY_ARRAYS:
+            np.save(os.path.join(index_dir, f"fuzzy.{name}.npy"), getattr(self, name))
+        with open(os.path.join(index_dir, 'fuzzy.json'), 'w', encoding='utf-8') as f:
+            json.dump({"alphabet": self.alphabet, "token_to_multi": self.token_to_multi}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, index_dir, choices):
+        # The arrays are memory-mapped; only the pages of the probed length buckets are read
+        arrays = {name: np.load(os.path.join(index_dir, f"fuzzy.{name}.npy"), mmap_mode='r') for name in FUZZY_ARRAYS}
+        with open(os.path.join(index_dir, 'fuzzy.json'), 'r', encoding='utf-8') as f:
+            tables = json.load(f)
+        return cls(choices, alphabet=tables["alphabet"], token_to_multi=tables["token_to_multi"], **arrays)
+
+    def candidates(self, word):
+        """
+        Indices (into choices, ascending) of every headword that may score above the threshold.
+        Returns None when the bounds do not apply (query contains whitespace) and a full scan is needed.
+        """
+        if any(ch.isspace() for ch in word):
+            return None
+        len_q = len(word)
+
+        # 1. Length buckets: WRatio is capped at 60 once the length ratio exceeds 8
+        lo = np.searchsorted(self.lens, len_q / 8, side='left')
+        hi = np.searchsorted(self.lens, len_q * 8, side='right')
+        lens = self.lens[lo:hi]
+
+        # 2. Character overlap with the query
+        common = np.zeros(hi - lo, dtype=np.int64)
+        query_counts = {}
+        for ch in word:
+            query_counts[ch] = query_counts.get(ch, 0) + 1
+        for ch, count in query_counts.items():
+            col = self.alphabet.get(ch)
+            if col is not None:
+                common += np.minimum(self.char_counts[lo:hi, col], count)
+
+        multi = self.multi[lo:hi]
+        short = np.minimum(lens, len_q)
+        close_lengths = np.maximum(lens, len_q) < 1.5 * short
+        limit = FUZZY_THRESHOLD / 100
+        keep_close = 2 * common > limit * (len_q + np.where(multi, common, lens)) - 1e-9
+        keep_far = (common > 0.894 * short - 1e-9) | (multi & (common >= np.minimum(self.set_lens[lo:hi], len_q)))
+        keep = np.where(close_lengths, keep_close, keep_far)
+
+        found = set(self.order[lo:hi][keep].tolist())
+        # Token-set / partial-token ratios reach 100 when the query is one of a headword's words
+        found.update(self.token_to_multi.get(word, ()))
+        return sorted(found)
+
+
+class HeadwordScanner():
+    """
+    Aho-Corasick automaton over tokenized headwords (tokens are the alphabet), so multi-word
+    headwords such as "a bal" are found in a single linear pass over a sentence.
+
+    Headwords are normalized with the same tokenizer as the sentences; several headwords that
+    normalize to the same token sequence (e.g. "A" and "a") share one pattern and all their senses.
+    Headwords with gaps ("ne ... tɩ") cannot be matched contiguously and are skipped.
+    """
+    TABLES = ['goto', 'fail', 'depth', 'outputs', 'dict_link']
+
+    def __init__(self, headwords=(), tokenize=None):
+        self.goto = [{}]        # node -> {token: child}
+        self.fail = [0]
+        self.depth = [0]
+        self.outputs = [None]   # node -> list of headwords whose pattern ends exactly here
+        self.dict_link = [0]    # node -> nearest proper suffix node with outputs (0 = none)
+
+        for headword in headwords:
+            if '...' in headword or '…' in headword:
+                continue
+            # Drop parenthesised glosses, e.g. "gepeyese (GPS)"
+            tokens = tokenize(re.sub(r'\([^)]*\)', ' ', headword))
+            if tokens:
+                self._insert(tokens, headword)
+        self._build_links()
+
+    def to_json(self):
+        return {name: getattr(self, name) for name in self.TABLES}
+
+    @classmethod
+    def from_json(cls, tables):
+        # A built automaton (from to_json), so no headword has to be tokenized again
+        scanner = cls()
+        for name in cls.TABLES:
+            setattr(scanner, name, tables[name])
+        return scanner
+
+    def _insert(self, tokens, headword):
+        node = 0
+        for token in tokens:
+            child = self.goto[node].get(token)
+            if child is None:
+                child = len(self.goto)
+                self.goto[node][token] = child
+                self.goto.append({})
+                self.fail.append(0)
+                self.depth.append(self.depth[node] + 1)
+                self.outputs.append(None)
+                self.dict_link.append(0)
+            node = child
+        if self.outputs[node] is None:
+            self.outputs[node] = []
+        if headword not in self.outputs[node]:
+            self.outputs[node].append(headword)
+
+    def _build_links(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for token, child in self.goto[node].items():
+                state = self.fail[node]
+                while state and token not in self.goto[state]:
+                    state = self.fail[state]
+                fallback = self.goto[state].get(token, 0)
+                self.fail[child] = fallback if fallback != child else 0
+                self.dict_link[child] = self.fail[child] if self.outputs[self.fail[child]] else self.dict_link[self.fail[child]]
+                queue.append(child)
+
+    def lookup(self, token):
+        # Headwords that are exactly this single token
+        node = self.goto[0].get(token)
+        return self.outputs[node] if node is not None else None
+
+    def scan(self, tokens):
+        """
+        Returns non-overlapping (start, end, headwords) spans over `tokens`, choosing the leftmost
+        and then the longest match (so "a bal" wins over "a").
+        """
+        matches = []
+        state = 0
+        for pos, token in enumerate(tokens):
+            while state and token not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(token, 0)
+            node = state if self.outputs[state] else self.dict_link[state]
+            while node:
+                matches.append((pos + 1 - self.depth[node], pos + 1, node))
+                node = self.dict_link[node]
+
+        spans = []
+        cursor = 0
+        for start, end, node in sorted(matches, key=lambda m: (m[0], m[0] - m[1])):
+            if start >= cursor:
+                spans.append((start, end, self.outputs[node]))
+                cursor = end
+        return spans
+
 
 class WordDictionary():
-    def __init__(self, src_lang, tgt_lang, dict_path):
+    """
+    Headword -> senses lookups: exact, multi-word scanning (HeadwordScanner) and fuzzy (WRatio).
+
+    The normalized entries, the headword automaton and the fuzzy index are rebuilt from dict_path on
+    every load unless a fresh snapshot (save_snapshot, `main.py --prepare`) sits at snapshot_path:
+        manifest.json          format version, tokenizer settings, dictionary file fingerprint
+        entries.json           {headword: [senses]} in dictionary order
+        scanner.json           HeadwordScanner tables
+        fuzzy.json, fuzzy.*.npy   FuzzyIndex tables and arrays (memory-mapped)
+    """
+    def __init__(self, src_lang, tgt_lang, dict_path, fuzzy_cache_size=65536, snapshot_path=None):
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
         self.dict_path = dict_path
+        self.snapshot_path = snapshot_path or dict_path + ".snapshot"
+        # LRU memo of (word, top_k) -> [(match_word, score), ...]
+        self.fuzzy_cache = OrderedDict()
+        self.fuzzy_cache_size = fuzzy_cache_size
+        self.fuzzy_hits = 0
+        self.fuzzy_misses = 0
         self.load_dict()
     
     def load_dict(self):
+        self.fuzzy_cache.clear()
+        # Built (or opened from the snapshot) on the first fuzzy lookup
+        self._fuzzy_index = None
+        self.snapshot_loaded = False
+        try:
+            if self.snapshot_is_fresh():
+                self.load_snapshot()
+                return
+        except Exception as e:
+            print(f"Could not read dictionary snapshot ({e}). Loading {self.dict_path} instead...")
+
         self.word_dict = {}
         print(f"Loading dictionary from {self.dict_path}...")
         
@@ -25,7 +266,8 @@ class WordDictionary():
                     definition = [definition]
                 
                 if headword:
-                    self.word_dict[headword] = definition
+                    # Keep every sense of repeated headwords (e.g. the two "-a" entries)
+                    self.word_dict.setdefault(headword, []).extend(definition)
                     
             self.choices = list(self.word_dict.keys())
             print(f"Dictionary loaded with {len(self.choices)} entries.")
@@ -34,6 +276,86 @@ class WordDictionary():
             print(f"Error loading dictionary: {e}")
             self.word_dict = {}
             self.choices = []
+        tokenizer = get_tokenizer(self.src_lang)
+        self.scanner = HeadwordScanner(self.choices, lambda text: tokenizer.tokenize(text, remove_punc=True, cache=False))
+
+    @property
+    def fuzzy_index(self):
+        if self._fuzzy_index is None:
+            if self.snapshot_loaded:
+                self._fuzzy_index = FuzzyIndex.load(self.snapshot_path, self.choices)
+            else:
+                self._fuzzy_index = FuzzyIndex.build(self.choices)
+        return self._fuzzy_index
+
+    def snapshot_settings(self):
+        # Everything the snapshot depends on besides the content of dict_path
+        return {
+            "format_version": SNAPSHOT_FORMAT_VERSION,
+            "src_lang": self.src_lang,
+            "tokenizer": get_tokenizer(self.src_lang).settings(),
+        }
+
+    def snapshot_is_fresh(self):
+        """
+        True if snapshot_path was written from the current content of dict_path with these settings.
+        The dictionary file is only re-hashed when its size or mtime changed.
+        """
+        manifest_path = os.path.join(self.snapshot_path, 'manifest.json')
+        if not os.path.exists(manifest_path) or not os.path.exists(self.dict_path):
+            return False
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get("settings") != self.snapshot_settings():
+            print(f"Dictionary snapshot at {self.snapshot_path} is stale (settings changed).")
+            return False
+
+        stat = ColumnarCorpus.source_stat(self.dict_path)
+        source = manifest.get("source", {})
+        if source.get("size") == stat["size"] and source.get("mtime_ns") == stat["mtime_ns"]:
+            return True
+        if source.get("sha256") != file_sha256(self.dict_path):
+            print(f"Dictionary snapshot at {self.snapshot_path} is stale ({self.dict_path} changed).")
+            return False
+        # Same content with a new mtime (e.g. copied file): refresh the stat fields only
+        manifest["source"] = dict(source, **stat)
+        write_json_atomic(manifest_path, manifest)
+        return True
+
+    def load_snapshot(self):
+        with open(os.path.join(self.snapshot_path, 'entries.json'), 'r', encoding='utf-8') as f:
+            self.word_dict = json.load(f)
+        with open(os.path.join(self.snapshot_path, 'scanner.json'), 'r', encoding='utf-8') as f:
+            self.scanner = HeadwordScanner.from_json(json.load(f))
+        self.choices = list(self.word_dict.keys())
+        self.snapshot_loaded = True
+        print(f"Dictionary loaded from snapshot {self.snapshot_path} with {len(self.choices)} entries.")
+
+    def save_snapshot(self):
+        """
+        Writes the normalized entries, headword automaton and fuzzy index of the loaded dictionary
+        to snapshot_path, so later loads skip parsing, tokenizing and indexing the headwords.
+        """
+        tmp_dir = f"{self.snapshot_path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        # Compact JSON: these are parsed on every load
+        with open(os.path.join(tmp_dir, 'entries.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.word_dict, f, ensure_ascii=False, separators=(',', ':'))
+        with open(os.path.join(tmp_dir, 'scanner.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.scanner.to_json(), f, ensure_ascii=False, separators=(',', ':'))
+        self.fuzzy_index.save(tmp_dir)
+        write_json_atomic(os.path.join(tmp_dir, 'manifest.json'), {
+            "settings": self.snapshot_settings(),
+            "source": dict(ColumnarCorpus.source_stat(self.dict_path), sha256=file_sha256(self.dict_path)),
+            "num_headwords": len(self.choices),
+            "num_scanner_nodes": len(self.scanner.goto),
+        })
+
+        shutil.rmtree(self.snapshot_path, ignore_errors=True)
+        os.replace(tmp_dir, self.snapshot_path)
+        self.snapshot_loaded = True
+        print(f"Wrote dictionary snapshot to {self.snapshot_path}")
 
     def get_meanings_by_exact_match(self, word, max_num_meanings=None):
         if word in self.word_dict:
@@ -43,27 +365,126 @@ class WordDictionary():
             return meanings
         return None
         
+    def get_meanings_of_headwords(self, headwords, max_num_meanings=None):
+        # All senses of several headwords in dictionary order, without repeats
+        meanings = []
+        for headword in headwords:
+            for meaning in self.word_dict[headword]:
+                if meaning not in meanings:
+                    meanings.append(meaning)
+        return meanings[:max_num_meanings] if max_num_meanings else meanings
+
+    def scan(self, tokens, max_num_meanings=None):
+        """
+        Finds every dictionary entry in a tokenized sentence in one pass (multi-word headwords included,
+        longest match first). Tokens not covered by a match are looked up once more by their hyphenated
+        affixes (e.g. "sõngd-a" -> "-a").
+        Returns spans in sentence order: {"start", "end", "text", "headwords", "meanings"}.
+        """
+        spans = []
+        for start, end, headwords in self.scanner.scan(tokens):
+            spans.append({
+                "start": start,
+                "end": end,
+                "text": " ".join(tokens[start:end]),
+                "headwords": headwords,
+                "meanings": self.get_meanings_of_headwords(headwords, max_num_meanings),
+            })
+
+        covered = {pos for span in spans for pos in range(span["start"], span["end"])}
+        for pos, token in enumerate(tokens):
+            if pos in covered or '-' not in token.strip('-'):
+                continue
+            pieces = token.split('-')
+            for affix in ['-' + piece for piece in pieces[1:] if piece]:
+                headwords = self.scanner.lookup(affix)
+                if headwords:
+                    spans.append({
+                        "start": pos,
+                        "end": pos + 1,
+                        "text": affix,
+                        "headwords": headwords,
+                        "meanings": self.get_meanings_of_headwords(headwords, max_num_meanings),
+                    })
+        spans.sort(key=lambda span: span["start"])
+        return spans
+
+    def _cache_fuzzy(self, key, matches):
+        self.fuzzy_cache[key] = matches
+        self.fuzzy_cache.move_to_end(key)
+        if len(self.fuzzy_cache) > self.fuzzy_cache_size:
+            self.fuzzy_cache.popitem(last=False)
+
+    def _fuzzy_matches(self, word, top_k):
+        key = (word, top_k)
+        if key in self.fuzzy_cache:
+            self.fuzzy_hits += 1
+            self.fuzzy_cache.move_to_end(key)
+            return self.fuzzy_cache[key]
+        self.fuzzy_misses += 1
+
+        from rapidfuzz import process, fuzz
+        candidates = self.fuzzy_index.candidates(word)
+        choices = self.choices if candidates is None else [self.choices[i] for i in candidates]
+        # rapidfuzz returns (match, score, index); candidates keep dictionary order, so ties resolve the same way
+        results = process.extract(word, choices, scorer=fuzz.WRatio, limit=top_k, score_cutoff=FUZZY_THRESHOLD)
+        matches = [(match[0], match[1]) for match in results if match[1] > FUZZY_THRESHOLD]
+        self._cache_fuzzy(key, matches)
+        return matches
+
+    def prefetch_fuzzy_matches(self, words, top_k=1, workers=-1, chunk_size=64):
+        """
+        Resolves the fuzzy matches of many words at once (e.g. every token of a test set) and stores
+        them in the memo, so later get_meanings_by_fuzzy_match calls are lookups.
+        Words are grouped by length; each group is scored with one process.cdist call on `workers`
+        threads against the union of its FuzzyIndex candidates. Gives the same matches as word-by-word calls.
+        """
+        words = sorted({w for w in words if len(w) >= 2 and (w, top_k) not in self.fuzzy_cache}, key=lambda w: (len(w), w))
+        if not self.choices or not words:
+            return
+
+        if ((os.cpu_count() or 1) if workers == -1 else workers) <= 1:
+            # On a single core, extract's early cutoff beats scoring every candidate with cdist
+            for word in words:
+                self._fuzzy_matches(word, top_k)
+            return
+
+        from rapidfuzz import process, fuzz
+        for start in range(0, len(words), chunk_size):
+            chunk = words[start:start + chunk_size]
+            candidate_sets = [self.fuzzy_index.candidates(word) for word in chunk]
+            if any(candidates is None for candidates in candidate_sets):
+                union = list(range(len(self.choices)))
+            else:
+                union = sorted(set().union(*candidate_sets))
+            if not union:
+                for word in chunk:
+                    self._cache_fuzzy((word, top_k), [])
+                continue
+
+            # Every headword outside a word's candidates scores <= threshold, so scoring the union is exact
+            scores = process.cdist(chunk, [self.choices[i] for i in union], scorer=fuzz.WRatio,
+                                   score_cutoff=FUZZY_THRESHOLD, dtype=np.float64, workers=workers)
+            for word, row in zip(chunk, scores):
+                hits = np.flatnonzero(row > FUZZY_THRESHOLD)
+                # Highest score first, ties in dictionary order (as process.extract)
+                hits = hits[np.argsort(-row[hits], kind='stable')][:top_k]
+                self._cache_fuzzy((word, top_k), [(self.choices[union[i]], float(row[i])) for i in hits])
+
     def get_meanings_by_fuzzy_match(self, word, top_k=1, max_num_meanings_per_word=1):
         # Only run fuzzy match if we have choices and word is reasonably long
         if not self.choices or len(word) < 2:
             return []
 
         output = []
-        # rapidfuzz returns (match, score, index)
-        results = process.extract(word, self.choices, scorer=fuzz.WRatio, limit=top_k)
-        
-        for match in results:
-            match_word = match[0]
-            score = match[1]
-            
-            if score > 85: # High threshold to prevent bad noise
-                meanings = self.word_dict[match_word]
-                if max_num_meanings_per_word:
-                    meanings = meanings[:max_num_meanings_per_word]
-                    
-                output.append({
-                    "word": match_word,
-                    "meanings": meanings,
-                    "score": score
-                })
-        return output
\ No newline at end of file
+        for match_word, score in self._fuzzy_matches(word, top_k):
+            meanings = self.word_dict[match_word]
+            if max_num_meanings_per_word:
+                meanings = meanings[:max_num_meanings_per_word]
+
+            output.append({
+                "word": match_word,
+                "meanings": meanings,
+                "score": score
+            })
+        return output
@@ -1,38 +1,196 @@
 import json
 import argparse
+import hashlib
+import os
 import numpy as np
+import sacrebleu
 from sacrebleu.metrics import BLEU, CHRF
 
+LEVELS = ['easy', 'medium', 'hard']
+STATS_VERSION = 1
+# Resample weights are built in blocks of at most this many (resample, sentence) cells
+BLOCK_CELLS = 1 << 24
+
+# Metrics
+bleu = BLEU(lowercase=True)
+chrf = CHRF(word_order=2)
+
+def load_outputs(path):
+    # {idx: record}; records without an "idx" (older outputs) are keyed by line number
+    records = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f):
+            record = json.loads(line)
+            records[record.get("idx", line_no)] = record
+    return records
+
+def stats_fingerprint(preds, golds):
+    digest = hashlib.sha1()
+    settings = (STATS_VERSION, sacrebleu.__version__, bleu.lowercase, bleu.tokenizer.signature(), chrf.char_order, chrf.word_order, chrf.lowercase)
+    digest.update(repr(settings).encode('utf-8'))
+    for pred, gold in zip(preds, golds):
+        digest.update(f"\0{pred}\0{gold}".encode('utf-8'))
+    return digest.hexdigest()
+
+def sentence_stats(preds, golds, cache_path=None):
+    """
+    Per-sentence sufficient statistics as int64 arrays:
+    BLEU (n, 2 + 2 * 4): hyp length, ref length, matching and total n-gram counts;
+    chrF (n, 3 * 8): [hyp, ref, match] counts per char (1-6) and word (1-2) n-gram order.
+    Cached in cache_path (an .npz keyed by a hash of preds, refs and metric signatures).
+    """
+    fingerprint = stats_fingerprint(preds, golds)
+    if cache_path and os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        if str(cached["fingerprint"]) == fingerprint:
+            return cached["bleu"], cached["chrf"]
+
+    refs = [list(golds)]
+    bleu_stats = np.asarray(bleu._extract_corpus_statistics(preds, refs), dtype=np.int64).reshape(len(preds), -1)
+    chrf_stats = np.asarray(chrf._extract_corpus_statistics(preds, refs), dtype=np.int64).reshape(len(preds), -1)
+    if cache_path:
+        tmp_path = cache_path + ".tmp.npz"
+        np.savez(tmp_path, bleu=bleu_stats, chrf=chrf_stats, fingerprint=np.array(fingerprint))
+        os.replace(tmp_path, cache_path)
+    return bleu_stats, chrf_stats
+
+def bleu_from_stats(stats, max_order=4):
+    """
+    Corpus BLEU for every row of summed statistics (..., 2 + 2 * max_order), as
+    sacrebleu's compute_bleu with the default 'exp' smoothing.
+    """
+    stats = np.asarray(stats, dtype=np.float64)
+    sys_len, ref_len = stats[..., 0], stats[..., 1]
+    correct, total = stats[..., 2:2 + max_order], stats[..., 2 + max_order:2 + 2 * max_order]
+    no_match = correct == 0
+    # Each order without matches halves the smoothed precision again
+    smooth = 2.0 ** np.cumsum(no_match, axis=-1)
+    safe_total = np.maximum(total, 1)
+    precisions = np.where(no_match, 100.0 / (smooth * safe_total), 100.0 * correct / safe_total)
+    precisions = np.where(total > 0, precisions, 0.0)
+    log_precisions = np.where(precisions > 0, np.log(np.maximum(precisions, 1e-300)), -9999999999.0)
+
+    safe_sys = np.maximum(sys_len, 1)
+    bp = np.where(sys_len < ref_len, np.where(sys_len > 0, np.exp(1 - ref_len / safe_sys), 0.0), 1.0)
+    score = bp * np.exp(log_precisions.mean(axis=-1))
+    return np.where(correct.any(axis=-1), score, 0.0)
+
+def chrf_from_stats(stats, beta=2):
+    # Corpus chrF(++) for every row of summed statistics (..., 3 * orders), as sacrebleu's _compute_f_score
+    stats = np.asarray(stats, dtype=np.float64)
+    n_hyp, n_ref, n_match = stats[..., 0::3], stats[..., 1::3], stats[..., 2::3]
+    valid = (n_hyp > 0) & (n_ref > 0)
+    prec = np.where(n_hyp > 0, n_match / np.maximum(n_hyp, 1), 1e-16)
+    rec = np.where(n_ref > 0, n_match / np.maximum(n_ref, 1), 1e-16)
+    effective_order = np.maximum(valid.sum(axis=-1), 1)
+    avg_prec = np.where(valid, prec, 0.0).sum(axis=-1) / effective_order
+    avg_rec = np.where(valid, rec, 0.0).sum(axis=-1) / effective_order
+    factor = beta ** 2
+    denom = factor * avg_prec + avg_rec
+    return np.where(denom > 0, 100 * (1 + factor) * avg_prec * avg_rec / np.where(denom > 0, denom, 1), 0.0)
+
+METRICS = {"BLEU": (0, bleu_from_stats), "CHRF": (1, chrf_from_stats)}
+
+def bootstrap_scores(system_stats, rows, num_samples, seed):
+    """
+    Paired bootstrap: the same resamples of `rows` are scored for every system.
+    system_stats: [(bleu_stats, chrf_stats)] per system. Each resample is a row of sentence
+    multiplicities, so summing statistics is one (samples x sentences) @ (sentences x stats) product.
+    Returns {metric: (num_systems, num_samples) scores}.
+    """
+    rng = np.random.RandomState(seed)
+    n = len(rows)
+    scores = {name: np.empty((len(system_stats), num_samples)) for name in METRICS}
+    block = max(1, BLOCK_CELLS // max(1, n))
+    for start in range(0, num_samples, block):
+        size = min(block, num_samples - start)
+        picks = rng.randint(0, n, size=(size, n))
+        weights = np.bincount((picks + np.arange(size)[:, None] * n).ravel(), minlength=size * n).reshape(size, n).astype(np.float64)
+        for s, stats in enumerate(system_stats):
+            for name, (which, score_fn) in METRICS.items():
+                scores[name][s, start:start + size] = score_fn(weights @ stats[which][rows])
+    return scores
+
+def paired_p_value(system, baseline, real_difference):
+    # Probability of a difference at least this large under the null (sacrebleu's paired bootstrap test)
+    diffs = system - baseline
+    null = np.abs(diffs - diffs.mean())
+    return float(((null >= abs(real_difference)).sum() + 1) / (len(diffs) + 1))
+
+def compare(names, system_stats, rows, num_samples, seed):
+    """
+    Scores of every system on `rows`, with 95% bootstrap intervals and paired p-values
+    against the first system (the baseline) when num_samples > 0.
+    """
+    results = {name: {} for name in names}
+    samples = bootstrap_scores(system_stats, rows, num_samples, seed) if num_samples else None
+    for metric, (which, score_fn) in METRICS.items():
+        real = [float(score_fn(stats[which][rows].sum(axis=0))) for stats in system_stats]
+        for s, name in enumerate(names):
+            entry = {"score": real[s]}
+            if samples is not None:
+                low, high = np.percentile(samples[metric][s], [2.5, 97.5])
+                entry.update(ci_low=float(low), ci_high=float(high))
+                if s > 0:
+                    entry["p_value"] = paired_p_value(samples[metric][s], samples[metric][0], real[s] - real[0])
+            results[name][metric] = entry
+    return results
+
+def print_comparison(title, count, results):
+    print(f"\n{title} ({count} items)")
+    for name, metrics in results.items():
+        parts = []
+        for metric, entry in metrics.items():
+            part = f"{metric}: {entry['score']:.2f}"
+            if "ci_low" in entry:
+                part += f" [{entry['ci_low']:.2f}, {entry['ci_high']:.2f}]"
+            if "p_value" in entry:
+                part += f" p={entry['p_value']:.4f}"
+            parts.append(part)
+        print(f"  {name}: " + "  ".join(parts))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--output_path', type=str, required=True)
+    parser.add_argument('--output_path', type=str, nargs='+', required=True,
+                        help="One or more output files; the first is the baseline for paired significance")
     parser.add_argument('--leveled', action='store_true')
+    parser.add_argument('--bootstrap', type=int, default=1000, help="Bootstrap resamples for intervals and p-values (0 = off)")
+    parser.add_argument('--seed', type=int, default=12345)
+    parser.add_argument('--no_stats_cache', action='store_true', help="Don't read or write <output>.stats.npz")
+    parser.add_argument('--json_out', type=str, default=None, help="Also write the results as JSON")
     args = parser.parse_args()
 
-    # Metrics
-    bleu = BLEU(lowercase=True)
-    chrf = CHRF(word_order=2)
+    # 1. Align systems on the items they all have (by idx)
+    outputs = [load_outputs(path) for path in args.output_path]
+    common = sorted(set.intersection(*(set(records) for records in outputs)))
+    for path, records in zip(args.output_path, outputs):
+        if len(records) != len(common):
+            print(f"Warning: {path} has {len(records) - len(common)} items not shared by every system; they are ignored.")
+    data = [outputs[0][idx] for idx in common]
+    golds = [d['gold'] for d in data]
 
-    data = []
-    with open(args.output_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            data.append(json.loads(line))
+    # 2. Per-sentence statistics, once per system (cached next to each output file)
+    system_stats = []
+    for path, records in zip(args.output_path, outputs):
+        if any(records[idx]['gold'] != gold for idx, gold in zip(common, golds)):
+            raise ValueError(f"{path} has different references than {args.output_path[0]}")
+        preds = [records[idx]['pred'] for idx in common]
+        system_stats.append(sentence_stats(preds, golds, cache_path=None if args.no_stats_cache else path + ".stats.npz"))
 
-    refs = [[d['gold'] for d in data]]
-    preds = [d['pred'] for d in data]
+    # 3. Overall and per-level scores (rows grouped in one pass)
+    groups = {"Overall": np.arange(len(data))}
+    if args.leveled:
+        sources = np.array([d.get('source', 'n/a') for d in data])
+        levels = [level for level in LEVELS if level in set(sources)] + sorted(set(sources) - set(LEVELS))
+        for level in levels:
+            groups[f"Level: {level}"] = np.flatnonzero(sources == level)
 
-    print("Overall:")
-    print("BLEU:", bleu.corpus_score(preds, refs).score)
-    print("CHRF:", chrf.corpus_score(preds, refs).score)
+    report = {}
+    for title, rows in groups.items():
+        report[title] = compare(args.output_path, system_stats, rows, args.bootstrap, args.seed)
+        print_comparison(title, len(rows), report[title])
 
-    if args.leveled:
-        for level in ['easy', 'medium', 'hard']:
-            subset = [d for d in data if d['source'] == level]
-            if not subset: continue
-            
-            sub_refs = [[d['gold'] for d in subset]]
-            sub_preds = [d['pred'] for d in subset]
-            
-            print(f"\nLevel: {level} ({len(subset)} items)")
-            print("BLEU:", bleu.corpus_score(sub_preds, sub_refs).score)
-            print("CHRF:", chrf.corpus_score(sub_preds, sub_refs).score)
\ No newline at end of file
+    if args.json_out:
+        with open(args.json_out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
@@ -1,36 +1,48 @@
 import argparse
 import os
 import json
-import random
-import numpy as np
-from tqdm import tqdm
+import time
 
-from dictionary import WordDictionary
-from corpus import ParallelCorpus
-# We don't import load_model if we are in API mode, to save RAM
-from model import get_pred_api
-from prompts import construct_prompt_mos2en, construct_prompt_en2mos
+# Heavy modules (dictionary, corpus and indexes, API client, asyncio, tqdm) are imported where
+# they are used, so runs that don't need them (and --help) start faster
+from output_io import OrderedJSONLWriter, existing_data_path, iter_json_records, load_completed, read_records, write_records
+from metrics import RunMetrics, Profiler, timed
+from shards import shard_indices, shard_output_path, launch_local
+from tokenizer import get_tokenizer
+from prompts import construct_prompt_mos2en, construct_prompt_en2mos, prompt_type_to_query_lang, prefetch_word_explanations, PromptBuilder
 
-if __name__ == "__main__":
+def get_parser():
+    # Shared with server.py, which adds its own options on top
     parser = argparse.ArgumentParser()
     
     # Resources
     parser.add_argument('--src_lang', type=str, default='mos')
     parser.add_argument('--tgt_lang', type=str, default='en')
     parser.add_argument('--dict_path', type=str, default='dictionary.json')
-    parser.add_argument('--corpus_path', type=str, default='mossi_corpus.json')
-    parser.add_argument('--test_data_path', type=str, default='mossi_test.json')
+    parser.add_argument('--corpus_path', type=existing_data_path, default='mossi_corpus.jsonl')
+    parser.add_argument('--test_data_path', type=existing_data_path, default='mossi_test.jsonl')
     
     # API CONFIGURATION (New)
     parser.add_argument('--use_api', action='store_true', help="Use an API instead of local model")
     parser.add_argument('--api_key', type=str, default=None)
     parser.add_argument('--base_url', type=str, default="https://api.openai.com/v1", help="Change this for other providers")
     parser.add_argument('--model_name', type=str, default='gpt-4o-mini') 
+    parser.add_argument('--concurrency', type=int, default=8, help="Max API requests in flight")
+    parser.add_argument('--rpm', type=float, default=None, help="Requests-per-minute limit")
+    parser.add_argument('--tpm', type=float, default=None, help="Tokens-per-minute limit (estimated from prompt length)")
+    parser.add_argument('--max_retries', type=int, default=5, help="Retries on 429/5xx/timeouts, with exponential backoff")
+    parser.add_argument('--request_timeout', type=float, default=60.0, help="Per-request timeout in seconds")
+    parser.add_argument('--unordered_output', action='store_true', help="Write API results as they complete (tagged with idx)")
+    parser.add_argument('--cache_path', type=str, default='response_cache.sqlite', help="SQLite response cache for API calls")
+    parser.add_argument('--no_cache', action='store_true', help="Disable the response cache")
+    parser.add_argument('--cache_max_mb', type=float, default=1024, help="Evict least recently used responses beyond this size")
+    parser.add_argument('--cache_max_age_days', type=float, default=None, help="Ignore and evict responses older than this")
 
     # Local Model Config (Ignored if --use_api is set)
     parser.add_argument('--model_path', type=str, default=None) 
     parser.add_argument('--no_vllm', action='store_true')
     parser.add_argument('--n_gpu', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=8, help="Prompts per generate call for the HF (--no_vllm) path")
 
     # Generation Config
     parser.add_argument('--do_sample', action='store_true')
@@ -41,42 +53,198 @@ if __name__ == "__main__":
     # Prompt Config
     parser.add_argument('--prompt_type', type=str, default='mos2en', choices=['mos2en', 'en2mos'])
     parser.add_argument('--num_parallel_sent', type=int, default=3)
+    parser.add_argument('--retrieval_chunk_size', type=int, default=256, help="Queries scored per sparse matrix product")
+    parser.add_argument('--index_workers', type=int, default=-1, help="Processes for building the BM25 index (-1 = all cores)")
+    parser.add_argument('--retriever', type=str, default='bm25', choices=['bm25', 'chargram', 'hybrid'],
+                        help="Few-shot example retrieval: BM25, char n-gram vectors (IVF), or both fused with RRF")
+    parser.add_argument('--chargram_dim', type=int, default=1024, help="Dimensions of the hashed char n-gram vectors")
+    parser.add_argument('--chargram_nprobe', type=int, default=16, help="IVF lists scanned per query (more = slower, more exact)")
+    parser.add_argument('--dedup_threshold', type=float, default=None, help="Cluster near-duplicate corpus pairs at this MinHash Jaccard similarity (e.g. 0.8)")
+    parser.add_argument('--dedup_num_perm', type=int, default=64, help="MinHash permutations for near-duplicate detection")
+    parser.add_argument('--dedup_keep_all', action='store_true', help="Index duplicates too (use with --diversify) instead of one pair per cluster")
+    parser.add_argument('--diversify', action='store_true', help="Retrieve at most one example per near-duplicate cluster")
+    parser.add_argument('--prompt_budget', type=int, default=None, help="Max prompt tokens; examples and hints that don't fit are left out")
+    parser.add_argument('--max_example_tokens', type=int, default=None, help="Examples longer than this are truncated or dropped (--example_overflow)")
+    parser.add_argument('--example_overflow', type=str, default='drop', choices=['drop', 'truncate'])
+    parser.add_argument('--prompt_tokenizer', type=str, default='chars', choices=['chars', 'tiktoken', 'hf'],
+                        help="Token counts for the prompt budget: ~4 chars/token, tiktoken (API models) or the local HF tokenizer")
+    parser.add_argument('--max_hint_meanings', type=int, default=1, help="Senses listed per dictionary hint (0 = all)")
+    parser.add_argument('--fuzzy_workers', type=int, default=-1, help="Threads for batched fuzzy dictionary matching (-1 = all cores)")
     
     # Output
     parser.add_argument('--output_path', type=str, default=None)
+    parser.add_argument('--resume', action='store_true', help="Skip items already completed in --output_path")
+    parser.add_argument('--num_shards', type=int, default=1, help="Split the test set into this many shards (items idx %% num_shards)")
+    parser.add_argument('--shard_id', type=int, default=0, help="Shard to run; its output goes to <output_path>.shard-<id>-of-<n>.jsonl")
+    parser.add_argument('--workers', type=int, default=1, help="Run all shards here with this many forked processes, then merge (API mode)")
+    parser.add_argument('--metrics_path', type=str, default=None, help="End-of-run timing summary (JSON); defaults to <output_path>.metrics.json")
+    parser.add_argument('--profile', type=str, default=None, help="Run under cProfile and write the stats to this path")
+    parser.add_argument('--prepare', action='store_true',
+                        help="Only build the dictionary snapshot, corpus store and retrieval indexes these options need, then exit")
 
-    args = parser.parse_args()
+    return parser
 
-    # 1. Load Resources (Always Local)
-    dictionary = WordDictionary(args.src_lang, args.tgt_lang, args.dict_path)
-    parallel_corpus = ParallelCorpus(args.src_lang, args.tgt_lang, args.corpus_path)
-    test_data = json.load(open(args.test_data_path, 'r'))
+def load_resources(args, need_dictionary=None, need_corpus=None):
+    """
+    Returns (dictionary, parallel_corpus); either is None when the run doesn't use it.
+    By default the dictionary is only loaded for mos2en hints and the corpus and BM25 index
+    only when examples are retrieved (--num_parallel_sent > 0).
+    """
+    if need_dictionary is None:
+        need_dictionary = args.prompt_type == 'mos2en'
+    if need_corpus is None:
+        need_corpus = args.num_parallel_sent > 0
 
-    # 2. Setup Model (API vs Local)
+    dictionary = None
+    if need_dictionary:
+        from dictionary import WordDictionary
+        dictionary = WordDictionary(args.src_lang, args.tgt_lang, args.dict_path)
+    parallel_corpus = None
+    if need_corpus:
+        from corpus import ParallelCorpus
+        parallel_corpus = ParallelCorpus(
+            args.src_lang, args.tgt_lang, args.corpus_path, index_workers=args.index_workers,
+            dedup_threshold=args.dedup_threshold, dedup_num_perm=args.dedup_num_perm, dedup_index=not args.dedup_keep_all,
+        )
+    return dictionary, parallel_corpus
+
+def load_generator(args):
+    """
+    Returns (client, llm, tokenizer): an AsyncOpenAI client in API mode,
+    otherwise the local model (and its tokenizer when not using vLLM).
+    """
     llm = None
     tokenizer = None
     client = None
 
     if args.use_api:
-        from openai import OpenAI
+        from openai import AsyncOpenAI
         print(f"Connecting to API: {args.base_url}")
         # If api_key is not passed, look for env var
         api_key = args.api_key or os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise ValueError("Please provide --api_key or set OPENAI_API_KEY environment variable.")
             
-        client = OpenAI(api_key=api_key, base_url=args.base_url)
+        # Retries are handled by AsyncAPIRunner (backoff + jitter), not by the client
+        client = AsyncOpenAI(api_key=api_key, base_url=args.base_url, max_retries=0)
     else:
         # Local Loading Logic
         if not args.model_path:
              raise ValueError("You must provide --model_path for local execution")
              
+        from model import load_model
         if args.no_vllm:
             llm, tokenizer = load_model(args.model_name, args.model_path, args.n_gpu, use_vllm=False)
         else:
-            # Import only if needed
-            from vllm import SamplingParams
             llm = load_model(args.model_name, args.model_path, args.n_gpu, use_vllm=True)
+    return client, llm, tokenizer
+
+def load_chargram(parallel_corpus, args):
+    if args.retriever == 'bm25' or parallel_corpus is None:
+        return None
+    from chargram import CharNgramRetriever
+    return CharNgramRetriever(parallel_corpus, dim=args.chargram_dim, nprobe=args.chargram_nprobe)
+
+def load_shared(args):
+    """
+    Everything read-only that forked shard workers can share: dictionary, corpus, indexes.
+    Parts that are otherwise loaded on first use (BM25 vocabularies, the fuzzy index, the
+    char n-gram index of the query language) are loaded here too, so workers inherit them.
+    """
+    dictionary, parallel_corpus = load_resources(args)
+    chargram = load_chargram(parallel_corpus, args)
+    if dictionary is not None:
+        dictionary.fuzzy_index
+    if parallel_corpus is not None:
+        for index in parallel_corpus.bm25.values():
+            index.vocab
+    if chargram is not None:
+        chargram.get_index(chargram.resolve_lang(prompt_type_to_query_lang[args.prompt_type]))
+    return dictionary, parallel_corpus, chargram
+
+def shared_parts(resources):
+    """
+    {name: id(object)} of the lazily loaded parts of load_shared()'s resources. launch_local
+    compares them in every worker after its run: a changed id means the worker loaded its own copy.
+    """
+    dictionary, parallel_corpus, chargram = resources
+    parts = {}
+    if dictionary is not None:
+        parts["fuzzy_index"] = id(dictionary._fuzzy_index)
+    if parallel_corpus is not None:
+        for lang, index in parallel_corpus.bm25.items():
+            parts[f"bm25_vocab.{lang}"] = id(index._vocab)
+    if chargram is not None:
+        for lang in (parallel_corpus.src_lang, parallel_corpus.tgt_lang):
+            parts[f"chargram.{lang}"] = id(chargram.indexes.get(lang))
+    return parts
+
+def prepare(args):
+    """
+    Builds everything later runs with these options open from disk: the dictionary snapshot
+    (normalized entries, headword automaton, fuzzy index), the columnar corpus store and the
+    BM25 / char n-gram indexes. Up-to-date parts are left as they are.
+    """
+    start = time.perf_counter()
+    dictionary, parallel_corpus = load_resources(args, need_dictionary=True, need_corpus=True)
+    if not dictionary.snapshot_loaded:
+        dictionary.save_snapshot()
+    chargram = load_chargram(parallel_corpus, args)
+    if chargram is not None:
+        chargram.get_index(chargram.resolve_lang(prompt_type_to_query_lang[args.prompt_type]))
+    print(f"Prepared {len(dictionary.word_dict)} dictionary entries and {len(parallel_corpus)} corpus pairs "
+          f"in {time.perf_counter() - start:.2f}s")
+
+def default_output_path(args):
+    mode = "api" if args.use_api else "local"
+    return f"output_{args.src_lang}2{args.tgt_lang}_{mode}.jsonl"
+
+def retrieve_examples(parallel_corpus, queries, args, top_k=None, chargram=None):
+    """
+    Few-shot examples for every query with the retriever chosen by --retriever,
+    each list ascending by score. chargram comes from load_chargram().
+    """
+    top_k = top_k or args.num_parallel_sent
+    query_lang = prompt_type_to_query_lang[args.prompt_type]
+    # Hybrid fuses twice as many candidates from each retriever
+    fetch = top_k * (2 if args.retriever == 'hybrid' else 1)
+
+    if args.retriever in ('bm25', 'hybrid'):
+        bm25_retrieved = parallel_corpus.search_by_bm25_batch(
+            queries,
+            query_lang=query_lang,
+            top_k=fetch,
+            chunk_size=args.retrieval_chunk_size,
+            diversify=args.diversify,
+        )
+    if args.retriever in ('chargram', 'hybrid'):
+        chargram_retrieved = chargram.search_batch(queries, query_lang=query_lang, top_k=fetch)
+
+    if args.retriever == 'bm25':
+        return bm25_retrieved
+    if args.retriever == 'chargram':
+        return chargram_retrieved
+    from chargram import reciprocal_rank_fusion
+    return [reciprocal_rank_fusion([b, c], top_k=top_k) for b, c in zip(bm25_retrieved, chargram_retrieved)]
+
+def run(args, resources=None):
+    """
+    Translates the test set (or one shard of it) and writes the output JSONL and metrics.
+    resources: (dictionary, parallel_corpus, chargram) from load_shared(), when already loaded.
+    """
+    metrics = RunMetrics()
+
+    # 1. Load Resources (Always Local)
+    if resources is None:
+        with metrics.time("load_resources"):
+            resources = load_shared(args)
+    dictionary, parallel_corpus, chargram = resources
+    metrics.mark("resources_ready")
+    test_data = list(iter_json_records(args.test_data_path))  # JSON list or JSONL
+
+    # 2. Setup Model (API vs Local)
+    with metrics.time("load_generator"):
+        client, llm, tokenizer = load_generator(args)
 
     # 3. Setup Prompt Function
     prompt_funcs = {
@@ -84,43 +252,165 @@ if __name__ == "__main__":
         'en2mos': construct_prompt_en2mos
     }
     prompt_func = prompt_funcs[args.prompt_type]
+    prompt_builder = PromptBuilder.from_args(args, tokenizer=tokenizer or (llm.get_tokenizer() if llm is not None and not args.no_vllm else None))
 
-    # 4. Output Config
-    if not args.output_path:
-        mode = "api" if args.use_api else "local"
-        args.output_path = f"output_{args.src_lang}2{args.tgt_lang}_{mode}.jsonl"
-    
-    fout = open(args.output_path, 'w', encoding='utf-8')
-    print(f"Writing results to {args.output_path}...")
-
-    # 5. Inference Loop
-    for item in tqdm(test_data):
-        src_sent = item[args.src_lang]
-        
-        # A. Construct Prompt (Happens Locally)
-        prompt = prompt_func(src_sent, dictionary, parallel_corpus, args)
-        
-        # B. Generate (Happens via API or Local)
-        pred = ""
-        if args.use_api:
-            pred = get_pred_api(client, args.model_name, prompt, args)
-        elif args.no_vllm:
-            pred = get_pred_no_vllm(llm, tokenizer, prompt, args)
-        else:
-            # vLLM logic
-            sampling_params = SamplingParams(temperature=args.temperature, max_tokens=args.max_new_tokens)
-            pred = get_pred(llm, sampling_params, prompt)
-            
-        # C. Save
-        output_obj = {
-            "query": src_sent,
+    # 4. Output Config (a shard writes its own file next to the final output)
+    output_path = args.output_path or default_output_path(args)
+    if args.num_shards > 1:
+        output_path = shard_output_path(output_path, args.shard_id, args.num_shards)
+    shard = set(shard_indices(len(test_data), args.num_shards, args.shard_id))
+
+    # Resume: keep finished records (dropping failed or truncated ones) and only run the rest
+    done = {}
+    if args.resume:
+        done = {
+            idx: record for idx, record in load_completed(output_path).items()
+            if idx in shard and record.get("query") == test_data[idx][args.src_lang]
+        }
+        write_records(output_path, done.values())
+        print(f"Resuming: {len(done)} of {len(shard)} items already done.")
+    todo = [idx for idx in sorted(shard) if idx not in done]
+
+    # 4b. Precompute retrieval for the remaining items in one batched pass
+    all_retrieved = {idx: [] for idx in todo}
+    if args.num_parallel_sent > 0 and todo:
+        print(f"Retrieving {args.num_parallel_sent} examples for {len(todo)} sentences ({args.retriever})...")
+        start = time.perf_counter()
+        retrieved = retrieve_examples(parallel_corpus, [test_data[idx][args.src_lang] for idx in todo], args, chargram=chargram)
+        all_retrieved = dict(zip(todo, retrieved))
+        metrics.add_batch(todo, "retrieval", time.perf_counter() - start)
+
+    # Dictionary hints: resolve fuzzy matches for all remaining sentences in one batch
+    if dictionary is not None:
+        start = time.perf_counter()
+        prefetch_word_explanations([test_data[idx][args.src_lang] for idx in todo], 'mos', dictionary, workers=args.fuzzy_workers)
+        metrics.add_batch(todo, "hints_prefetch", time.perf_counter() - start)
+
+    fout = open(output_path, 'a' if args.resume else 'w', encoding='utf-8')
+    print(f"Writing results to {output_path}...")
+
+    def make_output(idx, item, prompt, pred):
+        return {
+            "idx": idx,
+            "query": item[args.src_lang],
             "gold": item[args.tgt_lang],
             "pred": pred,
             "prompt": prompt,
-            "source": item.get('source', 'n/a')
+            "source": item.get('source', 'n/a'),
+            "timings": metrics.item_timings(idx),
         }
-        fout.write(json.dumps(output_obj, ensure_ascii=False) + "\n")
+
+    def build_prompt(idx):
+        # Prompt time includes the dictionary hint stages timed inside it
+        with metrics.track(idx), timed("prompt"):
+            return prompt_func(test_data[idx][args.src_lang], dictionary, parallel_corpus, args, retrieved=all_retrieved[idx], builder=prompt_builder)
+
+    # 5. Inference
+    if args.use_api:
+        import asyncio
+        from tqdm import tqdm
+        from api_runner import AsyncAPIRunner
+        from response_cache import ResponseCache
+
+        # A. Construct all prompts (Happens Locally, retrieval is already done)
+        prompts = {idx: build_prompt(idx) for idx in todo}
+
+        # B. Generate concurrently; results are written in input order unless --unordered_output
+        cache = None
+        if not args.no_cache:
+            cache = ResponseCache(
+                args.cache_path,
+                max_bytes=int(args.cache_max_mb * 2**20) if args.cache_max_mb else None,
+                max_age_days=args.cache_max_age_days,
+            )
+        runner = AsyncAPIRunner(
+            client, args.model_name, args,
+            concurrency=args.concurrency, rpm=args.rpm, tpm=args.tpm,
+            max_retries=args.max_retries, request_timeout=args.request_timeout, cache=cache,
+        )
+        # Items outside this shard are never written either
+        writer = OrderedJSONLWriter(fout, ordered=not args.unordered_output, skip=set(range(len(test_data))) - set(todo))
+        progress = tqdm(total=len(prompts))
+        failed = []
+
+        def on_result(idx, result):
+            metrics.add(idx, "generation", result["latency"])
+            metrics.add_usage(result["usage"])
+            output_obj = make_output(idx, test_data[idx], prompts[idx], result["pred"])
+            output_obj.update(usage=result["usage"], attempts=result["attempts"], cached=result["cached"])
+            if result["error"]:
+                output_obj["error"] = result["error"]
+                failed.append(idx)
+            with metrics.time("write"):
+                writer.write(idx, output_obj)
+            progress.update(1)
+
+        asyncio.run(runner.run(prompts.items(), on_result))
+        progress.close()
+        if runner.first_request_at is not None:
+            metrics.mark("first_request", runner.first_request_at)
+        metrics.counters.update(runner.stats)
+        if cache is not None:
+            metrics.set_cache_stats("responses", cache.hits, cache.misses)
+            cache.close()
+        if failed:
+            print(f"{len(failed)} requests failed after retries (marked with 'error' in the output): {sorted(failed)}")
+    else:
+        # A. Construct all prompts up front (Happens Locally, retrieval is already done)
+        prompts = [build_prompt(idx) for idx in todo]
+
+        # B. Generate the whole set at once (one llm.generate call, or length-sorted HF batches)
+        print(f"Generating {len(prompts)} predictions locally...")
+        from model import get_preds_hf, get_preds_vllm
+        start = time.perf_counter()
+        metrics.mark("first_request", start)
+        if args.no_vllm:
+            preds = get_preds_hf(llm, tokenizer, prompts, args, batch_size=args.batch_size)
+        else:
+            preds = get_preds_vllm(llm, prompts, args)
+        metrics.add_batch(todo, "generation", time.perf_counter() - start)
+
+        # C. Save
+        for idx, prompt, pred in zip(todo, prompts, preds):
+            with metrics.time("write"):
+                fout.write(json.dumps(make_output(idx, test_data[idx], prompt, pred), ensure_ascii=False) + "\n")
         fout.flush()
 
     fout.close()
-    print("Done. You can now run eval.py on the output file.")
\ No newline at end of file
+    if args.resume:
+        # Resumed items were appended after the earlier ones; restore input order
+        write_records(output_path, read_records(output_path))
+
+    # 6. Run summary: stage percentiles, throughput, errors/retries, cache hit rates and prompt tokens saved
+    prompt_stats = prompt_builder.summary()
+    metrics.counters.update({f"prompt_{key}": value for key, value in prompt_stats.items()})
+    if prompt_stats.get("prompts"):
+        print(f"Prompt tokens ({args.prompt_tokenizer}): {prompt_stats['tokens']} sent, {prompt_stats['tokens_saved']} saved "
+              f"({prompt_stats['tokens_saved'] / max(1, prompt_stats['tokens_full']):.1%} of {prompt_stats['tokens_full']})")
+    src_cache = get_tokenizer(args.src_lang).cache_info()
+    metrics.set_cache_stats("tokenizer", src_cache.hits, src_cache.misses)
+    if dictionary is not None:
+        metrics.set_cache_stats("fuzzy_matches", dictionary.fuzzy_hits, dictionary.fuzzy_misses)
+    summary = metrics.summary()
+    metrics.print_summary(summary)
+    metrics_path = args.metrics_path or output_path + ".metrics.json"
+    with open(metrics_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+    print(f"Metrics written to {metrics_path}")
+    return output_path
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    args.output_path = args.output_path or default_output_path(args)
+    profiler = Profiler(args.profile).start()
+    if args.prepare:
+        prepare(args)
+    elif args.workers > 1:
+        launch_local(args, run, load_shared, shared_parts)
+    else:
+        run(args)
+        if args.num_shards > 1:
+            print(f"Shard {args.shard_id} done. Merge all shards with: python shards.py --output_path {args.output_path} "
+                  f"--num_shards {args.num_shards} --test_data_path {args.test_data_path}")
+    profiler.stop()
+    print("Done." if args.prepare else "Done. You can now run eval.py on the output file.")
\ No newline at end of file
@@ -0,0 +1,172 @@
+import contextvars
+import os
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+PERCENTILES = (50, 95, 99)
+
+def _process_start():
+    # perf_counter() reading at process start (from /proc on Linux), else at this import
+    now = time.perf_counter()
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        return now - (uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return now
+
+# Origin of RunMetrics milestones, so they include interpreter startup and imports
+PROCESS_START = _process_start()
+
+# Stage timings of the item currently being processed (None outside RunMetrics.track)
+_current_timings = contextvars.ContextVar('current_timings', default=None)
+
+@contextmanager
+def timed(stage):
+    """
+    Adds the time spent in the block to `stage` of the current item, e.g. dictionary hints
+    inside prompt construction. Does nothing (beyond one lookup) when no item is tracked.
+    """
+    timings = _current_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+def percentiles(values):
+    import numpy as np
+    values = np.asarray(values, dtype=np.float64) * 1000
+    summary = {"count": len(values), "total_s": round(float(values.sum()) / 1000, 3), "mean_ms": round(float(values.mean()), 3)}
+    for q, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        summary[f"p{q}_ms"] = round(float(value), 3)
+    return summary
+
+
+class RunMetrics():
+    """
+    Collects per-item stage timings (seconds), run-level stage timings (e.g. each JSONL write),
+    counters (errors, retries, ...) and token usage, and summarizes them at the end of a run.
+    Batched stages (retrieval, fuzzy prefetch, local generation) are recorded per item as
+    their amortized share of the batch.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.items = defaultdict(dict)
+        self.stage_times = defaultdict(list)
+        self.counters = Counter()
+        self.usage = Counter()
+        self.cache_stats = {}
+        self.milestones = {}
+
+    @contextmanager
+    def track(self, idx):
+        # Everything timed (with `timed`) inside the block is attributed to item idx
+        token = _current_timings.set(self.items[idx])
+        try:
+            yield self.items[idx]
+        finally:
+            _current_timings.reset(token)
+
+    def add(self, idx, stage, seconds):
+        timings = self.items[idx]
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+    def add_batch(self, indices, stage, seconds):
+        share = seconds / max(1, len(indices))
+        for idx in indices:
+            self.add(idx, stage, share)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_times[stage].append(time.perf_counter() - start)
+
+    def mark(self, name, at=None):
+        # Seconds from process start to `at` (a perf_counter() reading, default now); the first mark wins
+        self.milestones.setdefault(name, round((at or time.perf_counter()) - PROCESS_START, 3))
+
+    def add_usage(self, usage):
+        if usage:
+            self.usage.update({key: value or 0 for key, value in usage.items()})
+
+    def set_cache_stats(self, name, hits, misses):
+        self.cache_stats[name] = {"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None}
+
+    def item_timings(self, idx):
+        # For the output JSONL: milliseconds per stage
+        return {f"{stage}_ms": round(seconds * 1000, 3) for stage, seconds in self.items.get(idx, {}).items()}
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        values = defaultdict(list)
+        for timings in self.items.values():
+            for stage, seconds in timings.items():
+                values[stage].append(seconds)
+        for stage, times in self.stage_times.items():
+            values[stage].extend(times)
+
+        num_items = len(self.items)
+        return {
+            "num_items": num_items,
+            "elapsed_s": round(elapsed, 3),
+            "items_per_s": round(num_items / elapsed, 3) if elapsed else None,
+            "stages": {stage: percentiles(times) for stage, times in values.items()},
+            "counters": dict(self.counters),
+            "usage": dict(self.usage),
+            "caches": self.cache_stats,
+            "milestones_s": self.milestones,
+        }
+
+    def print_summary(self, summary=None):
+        summary = summary or self.summary()
+        print(f"Processed {summary['num_items']} items in {summary['elapsed_s']:.2f}s ({summary['items_per_s']} items/s)")
+        if summary["milestones_s"]:
+            print("Since process start: " + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in summary["milestones_s"].items()))
+        print(f"{'stage':<16}{'count':>8}{'total s':>10}" + "".join(f"{f'p{q} ms':>11}" for q in PERCENTILES))
+        for stage, stats in summary["stages"].items():
+            print(f"{stage:<16}{stats['count']:>8}{stats['total_s']:>10.2f}" + "".join(f"{stats[f'p{q}_ms']:>11.2f}" for q in PERCENTILES))
+        if summary["counters"]:
+            print("Counters: " + ", ".join(f"{key}={value}" for key, value in sorted(summary["counters"].items())))
+        if summary["usage"]:
+            print("Token usage: " + ", ".join(f"{key}={value}" for key, value in sorted(summary["usage"].items())))
+        for name, stats in summary["caches"].items():
+            rate = "n/a" if stats["hit_rate"] is None else f"{stats['hit_rate']:.1%}"
+            print(f"Cache {name}: {stats['hits']} hits, {stats['misses']} misses ({rate})")
+
+
+class Profiler():
+    """
+    Optional cProfile hook: when path is set, stop() dumps the stats to path (for snakeviz,
+    pstats, ...) and prints the top functions by cumulative time.
+    """
+    def __init__(self, path, top=25):
+        self.path = path
+        self.top = top
+        self.profiler = None
+
+    def start(self):
+        if self.path:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        import pstats
+        self.profiler.disable()
+        self.profiler.dump_stats(self.path)
+        print(f"Profile written to {self.path}")
+        pstats.Stats(self.profiler).sort_stats('cumulative').print_stats(self.top)
+        self.profiler = None
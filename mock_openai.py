@@ -0,0 +1,95 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Minimal OpenAI-compatible /chat/completions endpoint for offline benchmarks.
+    Every request sleeps latency (+ uniform jitter) seconds, then fails with one of the
+    error statuses with probability error_rate, or echoes the last prompt line as the completion.
+    """
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    error_statuses = (429, 500, 503)
+    rng = random.Random(0)
+    lock = threading.Lock()
+    counts = {"requests": 0, "errors": 0}
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            self.send_json(200, self.counts)
+        else:
+            self.send_json(404, {"error": {"message": f"no route for {self.path}"}})
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {"error": {"message": f"no route for {self.path}"}})
+            return
+
+        with self.lock:
+            self.counts["requests"] += 1
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            failed = self.rng.random() < self.error_rate
+            status = self.rng.choice(self.error_statuses)
+        time.sleep(delay)
+        if failed:
+            with self.lock:
+                self.counts["errors"] += 1
+            self.send_json(status, {"error": {"message": "injected error", "type": "mock"}})
+            return
+
+        prompt = request["messages"][-1]["content"]
+        lines = [line for line in prompt.split("\n") if line.strip()]
+        completion = lines[-2].split(":", 1)[-1].strip() if len(lines) > 1 else ""
+        prompt_tokens = sum(len(m["content"]) for m in request["messages"]) // 4
+        completion_tokens = len(completion) // 4 + 1
+        self.send_json(200, {
+            "id": f"mock-{self.counts['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": completion}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+def make_server(host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_statuses=(429, 500, 503), seed=0):
+    # A handler class per server, so settings and counters are not shared between servers
+    handler = type('Handler', (MockOpenAIHandler,), {
+        "latency": latency, "jitter": jitter, "error_rate": error_rate, "error_statuses": tuple(error_statuses),
+        "rng": random.Random(seed), "lock": threading.Lock(), "counts": {"requests": 0, "errors": 0},
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible mock server with latency and error injection")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18081)
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds per request")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Extra uniform random seconds per request")
+    parser.add_argument('--error_rate', type=float, default=0.0, help="Fraction of requests answered with an error status")
+    parser.add_argument('--error_statuses', type=int, nargs='+', default=[429, 500, 503])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.latency, args.jitter, args.error_rate, args.error_statuses, args.seed)
+    print(f"Mock OpenAI server on http://{args.host}:{server.server_address[1]}/v1")
+    server.serve_forever()
@@ -2,6 +2,19 @@ import time
 # We import OpenAI inside the function so it doesn't crash if you don't have it installed
 # for local-only runs.
 
+SYSTEM_PROMPT = "You are a helpful translator. Please provide only what you believe the translation of the given sentance to be and NOTHING else"
+
+def build_messages(prompt):
+    # Chat messages sent for every API request (shared by the sync and async paths)
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+def sampling_params(args):
+    # Chat-completions sampling parameters (shared by the sync, async and batch paths)
+    return {"temperature": args.temperature, "max_tokens": args.max_new_tokens, "top_p": args.top_p}
+
 def get_pred_api(client, model_name, prompt, args):
     """
     Sends the constructed prompt to an API.
@@ -9,16 +22,97 @@ def get_pred_api(client, model_name, prompt, args):
     try:
         response = client.chat.completions.create(
             model=model_name,
-            messages=[
-                {"role": "system", "content": "You are a helpful translator. Please provide only what you believe the translation of the given sentance to be and NOTHING else"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=args.temperature,
-            max_tokens=args.max_new_tokens,
-            top_p=args.top_p,
+            messages=build_messages(prompt),
+            **sampling_params(args),
         )
         return response.choices[0].message.content.strip()
     except Exception as e:
         print(f"API Error: {e}")
         time.sleep(2) # Wait a bit before retrying if you want to add retry logic
-        return ""
\ No newline at end of file
+        return ""
+
+def get_chat_template(model_name):
+    # Match a template from prompts.model_to_chat_template by substring of the model name (e.g. 'qwen')
+    from prompts import model_to_chat_template
+    for key, template in model_to_chat_template.items():
+        if key in model_name.lower():
+            return template
+    return None
+
+def apply_chat_template(prompt, model_name, tokenizer=None):
+    """
+    Wraps a raw prompt for a local chat model: a known template from prompts.model_to_chat_template first,
+    then the tokenizer's own chat template, else the prompt is used as-is (base models).
+    """
+    template = get_chat_template(model_name)
+    if template:
+        return template.format(prompt=prompt)
+    if tokenizer is not None and getattr(tokenizer, 'chat_template', None):
+        return tokenizer.apply_chat_template(build_messages(prompt), tokenize=False, add_generation_prompt=True)
+    return prompt
+
+def load_model(model_name, model_path, n_gpu, use_vllm=True):
+    """
+    vLLM: returns an LLM. HF transformers: returns (model, tokenizer), on GPU if one is available
+    and n_gpu > 0, otherwise on CPU.
+    """
+    if use_vllm:
+        from vllm import LLM
+        return LLM(model=model_path, tensor_parallel_size=n_gpu, trust_remote_code=True)
+
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    # Left padding so every row of a batch ends at the generation position
+    tokenizer = AutoTokenizer.from_pretrained(model_path, padding_side='left', trust_remote_code=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    device = 'cuda' if n_gpu > 0 and torch.cuda.is_available() else 'cpu'
+    model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype='auto', trust_remote_code=True).to(device)
+    model.eval()
+    return model, tokenizer
+
+def get_preds_vllm(llm, prompts, args):
+    """
+    Generates all prompts with a single llm.generate call, so vLLM schedules the whole set with continuous batching.
+    """
+    from vllm import SamplingParams
+    params = SamplingParams(temperature=args.temperature, max_tokens=args.max_new_tokens)
+    model_name = getattr(args, 'model_name', '')
+    texts = [apply_chat_template(prompt, model_name, llm.get_tokenizer()) for prompt in prompts]
+    outputs = llm.generate(texts, params)
+    return [output.outputs[0].text.strip() for output in outputs]
+
+def get_pred(llm, params, prompt):
+    outputs = llm.generate([prompt], params)
+    return outputs[0].outputs[0].text.strip()
+
+def get_preds_hf(model, tokenizer, prompts, args, batch_size=8):
+    """
+    Batched HF generation. Prompts are tokenized once and sorted by token length, so each batch
+    is padded only to its own longest prompt; predictions are returned in the original order.
+    """
+    import torch
+    model_name = getattr(args, 'model_name', '')
+    texts = [apply_chat_template(prompt, model_name, tokenizer) for prompt in prompts]
+    # The ids that are sorted are the ids that are generated from (same special tokens)
+    input_ids = tokenizer(texts)['input_ids']
+    order = sorted(range(len(texts)), key=lambda i: len(input_ids[i]), reverse=True)
+
+    gen_kwargs = {"max_new_tokens": args.max_new_tokens, "do_sample": args.do_sample, "pad_token_id": tokenizer.pad_token_id}
+    if args.do_sample:
+        gen_kwargs.update(temperature=args.temperature, top_p=args.top_p)
+
+    preds = [""] * len(texts)
+    for start in range(0, len(order), batch_size):
+        batch_idx = order[start:start + batch_size]
+        inputs = tokenizer.pad([{"input_ids": input_ids[i]} for i in batch_idx], padding=True, return_tensors='pt').to(model.device)
+        with torch.no_grad():
+            output_ids = model.generate(**inputs, **gen_kwargs)
+        # Keep only the newly generated tokens
+        new_tokens = output_ids[:, inputs['input_ids'].shape[1]:]
+        for i, text in zip(batch_idx, tokenizer.batch_decode(new_tokens, skip_special_tokens=True)):
+            preds[i] = text.strip()
+    return preds
+
+def get_pred_no_vllm(model, tokenizer, prompt, args):
+    return get_preds_hf(model, tokenizer, [prompt], args, batch_size=1)[0]
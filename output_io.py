@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+
+def file_sha256(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def write_json_atomic(path, obj):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def existing_data_path(path):
+    """
+    path, or the same name with the other extension (.json <-> .jsonl) when only that file exists,
+    so old .json paths and the .jsonl files prepare_data.py writes both work. Used as an argparse type.
+    """
+    if os.path.exists(path):
+        return path
+    root, ext = os.path.splitext(path)
+    other = root + {'.json': '.jsonl', '.jsonl': '.json'}.get(ext, ext)
+    return other if os.path.exists(other) else path
+
+def iter_json_records(path):
+    # .jsonl is streamed line by line; anything else is read as one JSON list
+    if path.endswith('.jsonl'):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            yield from json.load(f)
+
+
+class OrderedJSONLWriter():
+    """
+    Writes records to a JSONL file as they complete. With ordered=True, records are buffered
+    until every lower index has been written, so the file stays in input order.
+    """
+    def __init__(self, fout, ordered=True, skip=()):
+        self.fout = fout
+        self.ordered = ordered
+        self.skip = set(skip)  # indices that will never be written (e.g. already done when resuming)
+        self.next_idx = 0
+        self.pending = {}
+        self._advance()
+
+    def write(self, idx, obj):
+        if not self.ordered:
+            self._write(obj)
+            return
+        self.pending[idx] = obj
+        while self.next_idx in self.pending:
+            self._write(self.pending.pop(self.next_idx))
+            self.next_idx += 1
+            self._advance()
+
+    def _advance(self):
+        while self.next_idx in self.skip:
+            self.next_idx += 1
+
+    def _write(self, obj):
+        self.fout.write(json.dumps(obj, ensure_ascii=False) + "\n")
+        self.fout.flush()
+
+
+def load_completed(output_path):
+    """
+    Reads an existing output JSONL and returns {idx: record} for items that finished without error.
+    Records without an "idx" (older outputs) are keyed by line number; truncated last lines are ignored.
+    """
+    completed = {}
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            idx = record.setdefault("idx", line_no)
+            if record.get("error"):
+                completed.pop(idx, None)
+            else:
+                completed[idx] = record
+    return completed
+
+def read_records(output_path):
+    with open(output_path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def write_records(output_path, records):
+    # Atomically replace output_path with records sorted by idx
+    tmp_path = f"{output_path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for record in sorted(records, key=lambda r: r["idx"]):
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, output_path)
@@ -0,0 +1,122 @@
+import argparse
+import hashlib
+import json
+import random
+
+from corpus_store import ColumnarCorpus
+
+DIFFICULTY_LEVELS = ['easy', 'medium', 'hard']
+
+def read_pairs(en_file, mos_file):
+    """
+    Streams (id, en, mos) by zipping the two line-aligned files.
+    Warns if one file has more lines than the other (the extra lines are ignored).
+    """
+    with open(en_file, 'r', encoding='utf-8') as f_en, open(mos_file, 'r', encoding='utf-8') as f_mos:
+        for i, (en_line, mos_line) in enumerate(zip(f_en, f_mos)):
+            yield {"id": i, "en": en_line.strip(), "mos": mos_line.strip()}
+        if next(f_en, None) is not None or next(f_mos, None) is not None:
+            print(f"Warning: {en_file} and {mos_file} have different line counts; extra lines were skipped.")
+
+def hash_fraction(seed, pair_id):
+    # Deterministic value in [0, 1) per (seed, pair id), independent of file order or process
+    digest = hashlib.blake2b(f"{seed}:{pair_id}".encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+def split_by_hash(pairs, test_fraction, seed):
+    """
+    Yields ('train' | 'test', pair); a pair is a test pair iff its seeded hash falls below test_fraction.
+    Pairs keep their input order and the test set grows with the data.
+    """
+    for pair in pairs:
+        yield ('test' if hash_fraction(seed, pair["id"]) < test_fraction else 'train'), pair
+
+def split_by_reservoir(pairs, test_size, seed):
+    """
+    Yields ('train' | 'test', pair) with exactly test_size test pairs drawn uniformly (reservoir sampling).
+    Only the reservoir is held in memory: a pair is emitted as train as soon as it is
+    rejected or evicted, and the test pairs are emitted at the end.
+    """
+    rng = random.Random(seed)
+    reservoir = []
+    for i, pair in enumerate(pairs):
+        if i < test_size:
+            reservoir.append(pair)
+            continue
+        j = rng.randrange(i + 1)
+        if j < test_size:
+            reservoir[j], pair = pair, reservoir[j]
+        yield 'train', pair
+    for pair in reservoir:
+        yield 'test', pair
+
+def stream_corpus(labelled, corpus_out, test_data):
+    """
+    Writes train pairs to corpus_out as JSONL and yields them (so a store can be built from the
+    same stream); test pairs are collected into test_data.
+    """
+    with open(corpus_out, 'w', encoding='utf-8') as f_out:
+        for split, pair in labelled:
+            if split == 'test':
+                test_data.append(pair)
+                continue
+            f_out.write(json.dumps(pair, ensure_ascii=False) + "\n")
+            yield pair
+
+def assign_difficulty(test_data):
+    # Thirds of the test sample by Mossi sentence length (sorted, as before)
+    test_data.sort(key=lambda x: len(x['mos']))
+    third = len(test_data) // 3
+    for i, item in enumerate(test_data):
+        item['source'] = DIFFICULTY_LEVELS[min(i // third, 2)] if third else 'hard'
+    return test_data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Zip NLLB .en/.mos files into a corpus and a test set in one streaming pass")
+    parser.add_argument('--en_file', type=str, default='NLLB.en-mos.en')
+    parser.add_argument('--mos_file', type=str, default='NLLB.en-mos.mos')
+    parser.add_argument('--corpus_out', type=str, default='mossi_corpus.jsonl', help="Corpus (train) pairs, one JSON object per line")
+    parser.add_argument('--test_out', type=str, default='mossi_test.jsonl')
+    parser.add_argument('--split', type=str, default='reservoir', choices=['reservoir', 'hash'],
+                        help="reservoir: exactly --test_size test pairs; hash: --test_fraction of pairs by seeded hash of the id")
+    parser.add_argument('--test_size', type=int, default=200)
+    parser.add_argument('--test_fraction', type=float, default=0.0001)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--build_store', action='store_true', help="Also build the columnar corpus store in the same pass")
+    parser.add_argument('--build_index', action='store_true', help="Build the store and the BM25 index for the corpus")
+    parser.add_argument('--store_path', type=str, default=None)
+    parser.add_argument('--index_workers', type=int, default=-1)
+    args = parser.parse_args()
+
+    pairs = read_pairs(args.en_file, args.mos_file)
+    if args.split == 'hash':
+        labelled = split_by_hash(pairs, args.test_fraction, args.seed)
+    else:
+        labelled = split_by_reservoir(pairs, args.test_size, args.seed)
+
+    # 1. Stream corpus pairs to JSONL; test pairs are the only thing kept in memory
+    test_data = []
+    print(f"Streaming {args.en_file} / {args.mos_file} to {args.corpus_out}...")
+    store_path = args.store_path or args.corpus_out + ".cols"
+    if args.build_store or args.build_index:
+        # The store is filled from the same stream; its manifest records the finished JSONL as the source
+        store = ColumnarCorpus.convert(args.corpus_out, store_path, ['mos', 'en'], records=stream_corpus(labelled, args.corpus_out, test_data))
+        num_corpus = len(store)
+    else:
+        num_corpus = sum(1 for _ in stream_corpus(labelled, args.corpus_out, test_data))
+    print(f"Saved {num_corpus} corpus pairs.")
+
+    # 2. Difficulty buckets come from the test sample only
+    assign_difficulty(test_data)
+    with open(args.test_out, 'w', encoding='utf-8') as f_out:
+        for item in test_data:
+            f_out.write(json.dumps(item, ensure_ascii=False) + "\n")
+    print(f"Saved {len(test_data)} test pairs to {args.test_out}.")
+
+    # 3. BM25 index over the fresh store (no second pass over the text files)
+    if args.build_index:
+        from corpus import ParallelCorpus
+        ParallelCorpus('mos', 'en', args.corpus_out, store_path=store_path, index_workers=args.index_workers)
+
+    print("Success")
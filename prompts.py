@@ -1,89 +1,281 @@
-from corpus import lang2tokenizer
+from collections import Counter
+
+from metrics import timed
+from tokenizer import lang2tokenizer
+
+LANG_NAMES = {'mos': 'Mossi', 'en': 'English'}
+HINTS_HEADER = "## Vocabulary Hints:\n"
 
 model_to_chat_template = {
     'qwen': "<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n<|im_start|>user\n{prompt}<|im_end|>\n<|im_start|>assistant\n",
 }
 
-def get_word_explanation_prompt(text, src_lang, dictionary):
+def clean_definition(definition):
+    # Dictionary definitions carry citation markers such as "[cite: 4]"
+    return definition.split('[cite')[0].strip()
+
+def get_word_explanations(text, src_lang, dictionary, max_num_meanings=1):
     """
-    Generates vocabulary hints using the dictionary.
+    Vocabulary hint lines for a sentence, using the dictionary.
     Only works if the dictionary matches the source language (e.g., Mossi -> English).
+    Each entry lists at most max_num_meanings senses (None or 0: all of them).
     """
     # If no dictionary or the source language isn't Mossi (since your dict is Mos->En), skip hints
     if dictionary is None or src_lang != 'mos':
-        return ""
+        return []
 
     tokenizer = lang2tokenizer.get(src_lang, None)
-    if not tokenizer: return ""
+    if not tokenizer: return []
 
     tokens = tokenizer.tokenize(text, remove_punc=True)
-    prompt = "## Vocabulary Hints:\n"
-    found = False
-
-    for word in tokens:
-        # 1. Exact Match
-        exact = dictionary.get_meanings_by_exact_match(word, max_num_meanings=1)
-        if exact:
-            # Clean up citation text if present in the definition
-            defn = exact[0].split('[cite')[0].strip()
-            prompt += f"- '{word}' means: {defn}\n"
-            found = True
-            continue # Skip fuzzy if exact match is found
-
-        # 2. Fuzzy Match (Optional fallback)
-        fuzzy = dictionary.get_meanings_by_fuzzy_match(word, top_k=1)
+    hints = []
+
+    # 1. Dictionary entries (single- and multi-word) found in one pass over the sentence
+    with timed("hints_exact"):
+        spans = dictionary.scan(tokens, max_num_meanings=max_num_meanings)
+    span_starts = {}
+    for span in spans:
+        span_starts.setdefault(span["start"], []).append(span)
+
+    pos = 0
+    while pos < len(tokens):
+        if pos in span_starts:
+            for span in span_starts[pos]:
+                # Clean up citation text if present in the definitions
+                defn = "; ".join(clean_definition(meaning) for meaning in span["meanings"])
+                hints.append(f"- '{span['text']}' means: {defn}")
+            pos = max(span["end"] for span in span_starts[pos])
+            continue
+
+        # 2. Fuzzy Match (fallback for tokens no entry covers)
+        word = tokens[pos]
+        with timed("hints_fuzzy"):
+            fuzzy = dictionary.get_meanings_by_fuzzy_match(word, top_k=1)
         if fuzzy:
             match_word = fuzzy[0]['word']
-            defn = fuzzy[0]['meanings'][0].split('[cite')[0].strip()
-            prompt += f"- '{word}' (similar to '{match_word}') means: {defn}\n"
-            found = True
+            defn = clean_definition(fuzzy[0]['meanings'][0])
+            hints.append(f"- '{word}' (similar to '{match_word}') means: {defn}")
+        pos += 1
 
-    return (prompt + "\n") if found else ""
+    return hints
 
+def get_word_explanation_prompt(text, src_lang, dictionary, max_num_meanings=1):
+    # Hints as a prompt section ("" when there are none)
+    hints = get_word_explanations(text, src_lang, dictionary, max_num_meanings)
+    if not hints:
+        return ""
+    return HINTS_HEADER + "".join(hint + "\n" for hint in hints) + "\n"
 
-def construct_prompt_mos2en(src_sent, dictionary, parallel_corpus, args):
-    # 1. Retrieve similar sentences from the corpus
-    retrieved = []
-    if args.num_parallel_sent > 0:
-        retrieved = parallel_corpus.search_by_bm25(src_sent, query_lang='mos', top_k=args.num_parallel_sent)
 
-    prompt = ""
-    
-    # 2. Add Few-Shot Context (Examples)
-    if retrieved:
-        prompt += "Translate the following Mossi sentences into English.\n\n"
-        for item in retrieved:
-            pair = item['pair']
-            prompt += f"Mossi: {pair['mos']}\n"
-            prompt += f"English: {pair['en']}\n\n"
-
-    # 3. Add the Target Sentence to translate
-    prompt += f"Mossi: {src_sent}\n"
-    
-    # 4. Add Dictionary Hints (if any found)
-    prompt += get_word_explanation_prompt(src_sent, 'mos', dictionary)
-    
-    prompt += "English:"
-    
-    return prompt
-
-def construct_prompt_en2mos(src_sent, dictionary, parallel_corpus, args):
-    # 1. Retrieve similar sentences
-    retrieved = []
-    if args.num_parallel_sent > 0:
-        retrieved = parallel_corpus.search_by_bm25(src_sent, query_lang='en', top_k=args.num_parallel_sent)
-
-    prompt = ""
-    
-    # 2. Add Few-Shot Context
-    if retrieved:
-        prompt += "Translate the following English sentences into Mossi.\n\n"
-        for item in retrieved:
+# Language of the query passed to search_by_bm25 for each prompt type
+prompt_type_to_query_lang = {
+    'mos2en': 'mos',
+    'en2mos': 'en',
+}
+
+def prefetch_word_explanations(texts, src_lang, dictionary, workers=-1):
+    """
+    Resolves the fuzzy dictionary matches of every token in `texts` in one batched call,
+    so get_word_explanation_prompt only hits the dictionary's memo afterwards.
+    """
+    if dictionary is None or src_lang != 'mos':
+        return
+
+    tokenizer = lang2tokenizer.get(src_lang, None)
+    if not tokenizer: return
+
+    # Only tokens that no dictionary entry covers fall back to fuzzy matching
+    words = set()
+    for text in texts:
+        tokens = tokenizer.tokenize(text, remove_punc=True)
+        covered = {pos for span in dictionary.scan(tokens) for pos in range(span["start"], span["end"])}
+        words.update(word for pos, word in enumerate(tokens) if pos not in covered)
+    dictionary.prefetch_fuzzy_matches(words, top_k=1, workers=workers)
+
+
+class CharTokenCounter():
+    # Tokenizer-free estimate (~4 characters per token, as for the API rate limiter)
+    def __init__(self, chars_per_token=4):
+        self.chars_per_token = chars_per_token
+
+    def count(self, text):
+        return -(-len(text) // self.chars_per_token)
+
+    def truncate(self, text, max_tokens):
+        return text[:max_tokens * self.chars_per_token]
+
+class TiktokenCounter():
+    # OpenAI BPE token counts; tiktoken is only imported when this counter is used
+    def __init__(self, model_name):
+        import tiktoken
+        try:
+            self.encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("o200k_base")
+
+    def count(self, text):
+        return len(self.encoding.encode(text))
+
+    def truncate(self, text, max_tokens):
+        return self.encoding.decode(self.encoding.encode(text)[:max_tokens])
+
+class HFTokenCounter():
+    # Token counts of a local (transformers / vLLM) tokenizer
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def count(self, text):
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def truncate(self, text, max_tokens):
+        return self.tokenizer.decode(self.tokenizer.encode(text, add_special_tokens=False)[:max_tokens])
+
+def get_token_counter(name, model_name=None, tokenizer=None):
+    if name == 'tiktoken':
+        return TiktokenCounter(model_name)
+    if name == 'hf':
+        if tokenizer is None:
+            raise ValueError("--prompt_tokenizer hf needs a local model tokenizer")
+        return HFTokenCounter(tokenizer)
+    return CharTokenCounter()
+
+
+class PromptBuilder():
+    """
+    Assembles translation prompts within an optional token budget.
+    Layout (most stable first, so provider / vLLM prefix caching hits across the test set):
+      1. the fixed instruction, identical for every sentence of a direction
+      2. few-shot examples (best match closest to the query)
+      3. vocabulary hints
+      4. the sentence to translate and the answer cue
+    Identical examples and hint lines are kept once. Examples over max_example_tokens are
+    truncated (both sides by the same fraction) or dropped. With a budget, the instruction and
+    query are always kept; the best examples, then hints, fill what is left.
+    self.stats counts tokens before ("tokens_full") and after ("tokens") assembly.
+    """
+    def __init__(self, token_counter=None, budget=None, max_example_tokens=None, overflow='drop'):
+        self.token_counter = token_counter or CharTokenCounter()
+        self.budget = budget
+        self.max_example_tokens = max_example_tokens
+        self.overflow = overflow
+        self.stats = Counter()
+
+    def count(self, text):
+        return self.token_counter.count(text)
+
+    def format_example(self, pair, src_lang, tgt_lang):
+        return f"{LANG_NAMES[src_lang]}: {pair[src_lang]}\n{LANG_NAMES[tgt_lang]}: {pair[tgt_lang]}\n\n"
+
+    def fit_example(self, pair, src_lang, tgt_lang):
+        # Returns (text, tokens), or None when an over-long example is dropped
+        text = self.format_example(pair, src_lang, tgt_lang)
+        tokens = self.count(text)
+        if not self.max_example_tokens or tokens <= self.max_example_tokens:
+            return text, tokens
+        if self.overflow == 'drop':
+            self.stats["examples_too_long"] += 1
+            return None
+        self.stats["examples_truncated"] += 1
+        ratio = self.max_example_tokens / tokens
+        truncated = {}
+        for lang in (src_lang, tgt_lang):
+            keep = max(1, int(self.count(pair[lang]) * ratio) - 1)
+            truncated[lang] = self.token_counter.truncate(pair[lang], keep).rstrip() + " ..."
+        text = self.format_example(truncated, src_lang, tgt_lang)
+        return text, self.count(text)
+
+    def build(self, src_sent, src_lang, tgt_lang, retrieved=(), hints=()):
+        prefix = f"Translate the following {LANG_NAMES[src_lang]} sentences into {LANG_NAMES[tgt_lang]}.\n\n"
+        query = f"{LANG_NAMES[src_lang]}: {src_sent}\n{LANG_NAMES[tgt_lang]}:"
+        tokens = self.count(prefix) + self.count(query)
+        remaining = float('inf') if self.budget is None else self.budget - tokens
+        header_tokens = self.count(HINTS_HEADER) + 1  # header and the blank line closing the section
+        full = tokens + (header_tokens if hints else 0)
+
+        # 1. Examples, best first (retrieved is ascending by score), identical pairs once
+        examples = {}
+        seen = set()
+        for rank, item in reversed(list(enumerate(retrieved))):
             pair = item['pair']
-            prompt += f"English: {pair['en']}\n"
-            prompt += f"Mossi: {pair['mos']}\n\n"
+            full += self.count(self.format_example(pair, src_lang, tgt_lang))
+            key = (pair[src_lang].strip(), pair[tgt_lang].strip())
+            if key in seen:
+                self.stats["examples_deduplicated"] += 1
+                continue
+            seen.add(key)
+            fitted = self.fit_example(pair, src_lang, tgt_lang)
+            if fitted is None:
+                continue
+            if fitted[1] > remaining:
+                self.stats["examples_over_budget"] += 1
+                continue
+            examples[rank] = fitted[0]
+            remaining -= fitted[1]
+            tokens += fitted[1]
+
+        # 2. Hints in sentence order, each line once
+        kept_hints = []
+        seen = set()
+        for hint in hints:
+            hint_tokens = self.count(hint + "\n")
+            full += hint_tokens
+            if hint in seen:
+                self.stats["hints_deduplicated"] += 1
+                continue
+            seen.add(hint)
+            needed = hint_tokens + (0 if kept_hints else header_tokens)
+            if needed > remaining:
+                self.stats["hints_over_budget"] += 1
+                continue
+            kept_hints.append(hint)
+            remaining -= needed
+            tokens += needed
+
+        prompt = prefix + "".join(examples[rank] for rank in sorted(examples))
+        if kept_hints:
+            prompt += HINTS_HEADER + "".join(hint + "\n" for hint in kept_hints) + "\n"
+        prompt += query
+
+        self.stats["prompts"] += 1
+        self.stats["tokens_full"] += full
+        self.stats["tokens"] += tokens
+        return prompt
+
+    def summary(self):
+        stats = dict(self.stats)
+        stats["tokens_saved"] = self.stats["tokens_full"] - self.stats["tokens"]
+        return stats
+
+    @classmethod
+    def from_args(cls, args, tokenizer=None):
+        counter = get_token_counter(getattr(args, 'prompt_tokenizer', 'chars'), getattr(args, 'model_name', None), tokenizer)
+        return cls(counter, budget=getattr(args, 'prompt_budget', None),
+                   max_example_tokens=getattr(args, 'max_example_tokens', None),
+                   overflow=getattr(args, 'example_overflow', 'drop'))
+
+# Used when callers don't pass their own builder (no budget, character estimates)
+_default_builder = PromptBuilder()
+
+
+def construct_prompt_mos2en(src_sent, dictionary, parallel_corpus, args, retrieved=None, builder=None):
+    # 1. Retrieve similar sentences from the corpus (unless precomputed with search_by_bm25_batch)
+    if retrieved is None:
+        retrieved = []
+        if args.num_parallel_sent > 0:
+            with timed("retrieval"):
+                retrieved = parallel_corpus.search_by_bm25(src_sent, query_lang='mos', top_k=args.num_parallel_sent, diversify=getattr(args, 'diversify', False))
+
+    # 2. Dictionary hints, then assembly (instruction, examples, hints, query) within the token budget
+    hints = get_word_explanations(src_sent, 'mos', dictionary, max_num_meanings=getattr(args, 'max_hint_meanings', 1))
+    return (builder or _default_builder).build(src_sent, 'mos', 'en', retrieved, hints)
+
+def construct_prompt_en2mos(src_sent, dictionary, parallel_corpus, args, retrieved=None, builder=None):
+    # 1. Retrieve similar sentences (unless precomputed with search_by_bm25_batch)
+    if retrieved is None:
+        retrieved = []
+        if args.num_parallel_sent > 0:
+            with timed("retrieval"):
+                retrieved = parallel_corpus.search_by_bm25(src_sent, query_lang='en', top_k=args.num_parallel_sent, diversify=getattr(args, 'diversify', False))
 
-    # 3. Add Target
-    prompt += f"English: {src_sent}\n"
-    prompt += "Mossi:"
-    return prompt
\ No newline at end of file
+    # 2. Assembly (the dictionary is Mossi -> English, so there are no hints in this direction)
+    return (builder or _default_builder).build(src_sent, 'en', 'mos', retrieved)
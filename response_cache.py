@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+class ResponseCache():
+    """
+    Persistent SQLite cache of model responses, keyed on everything that determines the output:
+    model name, base URL, the full message list and the sampling parameters.
+
+    Entries older than max_age_days are dropped, and when the cache grows past max_entries or
+    max_bytes the least recently used entries are evicted.
+    """
+    def __init__(self, path, max_entries=None, max_bytes=None, max_age_days=None, evict_every=256):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.evict_every = evict_every
+        self.puts_since_evict = 0
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, response TEXT NOT NULL,"
+            " created REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model_name, base_url, messages, params):
+        payload = json.dumps(
+            {"model": model_name, "base_url": base_url, "messages": messages, "params": params},
+            ensure_ascii=False, sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        row = self.conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or (self.max_age and now - row[1] > self.max_age):
+            self.misses += 1
+            return None
+        self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        self.conn.commit()
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, response):
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response, created, accessed, size) VALUES (?, ?, ?, ?, ?)",
+            (key, response, now, now, len(response.encode('utf-8'))),
+        )
+        self.conn.commit()
+        self.puts_since_evict += 1
+        if self.puts_since_evict >= self.evict_every:
+            self.evict()
+
+    def evict(self):
+        self.puts_since_evict = 0
+        if self.max_age:
+            self.conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+        if self.max_entries:
+            self.conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+        if self.max_bytes:
+            # Keep the most recently used entries whose cumulative size fits in max_bytes
+            self.conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed DESC) AS total FROM responses)"
+                " WHERE total > ?)",
+                (self.max_bytes,),
+            )
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,380 @@
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from api_runner import AsyncAPIRunner
+from main import get_parser, load_resources, load_generator, load_chargram, retrieve_examples
+from prompts import construct_prompt_mos2en, construct_prompt_en2mos, prefetch_word_explanations, PromptBuilder
+from response_cache import ResponseCache
+
+# Default for --max_body_kb
+MAX_BODY_BYTES = 1 << 20
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+class Overloaded(Exception):
+    pass
+
+class BadRequest(Exception):
+    pass
+
+def parse_content_length(value):
+    # Body size from a Content-Length header (missing or empty = no body); digits only, so no signs
+    if not value:
+        return 0
+    if not (value.isascii() and value.isdigit()):
+        raise BadRequest(f"invalid Content-Length: {value!r}")
+    return int(value)
+
+
+class MicroBatcher():
+    """
+    Collects items submitted concurrently and hands them to process(items) -> results in batches.
+    A batch is closed when max_batch_size items are waiting or window seconds have passed
+    since its first item. process runs in a worker thread, one batch at a time, so the event
+    loop keeps accepting requests. At most max_queue items may wait; beyond that submit()
+    raises Overloaded instead of queueing unbounded work.
+    """
+    def __init__(self, name, process, window=0.01, max_batch_size=64, max_queue=1024, executor=None):
+        self.name = name
+        self.process = process
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.executor = executor
+        self.batches = 0
+        self.items = 0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((item, future))
+        except asyncio.QueueFull:
+            raise Overloaded(f"{self.name} queue is full")
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            items = [item for item, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.process, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
+
+
+class TranslationService():
+    """
+    Keeps the dictionary, corpus/indexes and generator loaded for the lifetime of the process.
+    Retrieval + prompt building and (local) generation each go through a MicroBatcher;
+    API generation goes through AsyncAPIRunner with at most --concurrency requests in flight.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.started = time.time()
+        # Requests may ask for examples even when --num_parallel_sent is 0
+        self.dictionary, self.parallel_corpus = load_resources(args, need_corpus=True)
+        self.chargram = load_chargram(self.parallel_corpus, args)
+        self.client, self.llm, self.tokenizer = load_generator(args)
+        self.prompt_func = {'mos2en': construct_prompt_mos2en, 'en2mos': construct_prompt_en2mos}[args.prompt_type]
+        local_tokenizer = self.tokenizer or (self.llm.get_tokenizer() if self.llm is not None and not args.no_vllm else None)
+        self.prompt_builder = PromptBuilder.from_args(args, tokenizer=local_tokenizer)
+
+        self.cache = None
+        self.runner = None
+        if args.use_api:
+            if not args.no_cache:
+                self.cache = ResponseCache(
+                    args.cache_path,
+                    max_bytes=int(args.cache_max_mb * 2**20) if args.cache_max_mb else None,
+                    max_age_days=args.cache_max_age_days,
+                )
+            self.runner = AsyncAPIRunner(
+                self.client, args.model_name, args,
+                rpm=args.rpm, tpm=args.tpm, max_retries=args.max_retries,
+                request_timeout=args.request_timeout, cache=self.cache,
+            )
+
+        self.pending = 0
+        self.counters = {"requests": 0, "errors": 0, "rejected": 0, "sentences": 0, "generation_errors": 0}
+        self.latencies = {}  # endpoint -> recent request latencies (seconds)
+
+    def start(self):
+        # Called inside the running event loop
+        args = self.args
+        window = args.batch_window_ms / 1000.0
+        # One thread for CPU-side preparation and one for the local model, so they overlap
+        self.prepare_batcher = MicroBatcher(
+            "prepare", self.prepare_batch, window=window, max_batch_size=args.max_batch_size,
+            max_queue=args.max_queue, executor=ThreadPoolExecutor(max_workers=1),
+        )
+        self.prepare_batcher.start()
+        self.generate_batcher = None
+        self.api_slots = asyncio.Semaphore(max(1, args.concurrency))
+        if not args.use_api:
+            self.generate_batcher = MicroBatcher(
+                "generate", self.generate_batch, window=window, max_batch_size=args.batch_size,
+                max_queue=args.max_queue, executor=ThreadPoolExecutor(max_workers=1),
+            )
+            self.generate_batcher.start()
+
+    # ---- batched work (runs in worker threads) ----
+
+    def prepare_batch(self, items):
+        """
+        items: (text, top_k, build_prompt). Retrieval is one batched call per distinct top_k;
+        dictionary fuzzy matches for the whole batch are resolved together.
+        """
+        retrieved = [[] for _ in items]
+        by_top_k = {}
+        for i, (text, top_k, _) in enumerate(items):
+            if top_k > 0:
+                by_top_k.setdefault(top_k, []).append(i)
+        for top_k, positions in by_top_k.items():
+            results = retrieve_examples(self.parallel_corpus, [items[i][0] for i in positions], self.args, top_k=top_k, chargram=self.chargram)
+            for i, result in zip(positions, results):
+                retrieved[i] = result
+
+        to_prompt = [i for i, item in enumerate(items) if item[2]]
+        if to_prompt and self.args.prompt_type == 'mos2en':
+            prefetch_word_explanations([items[i][0] for i in to_prompt], 'mos', self.dictionary, workers=self.args.fuzzy_workers)
+        prompts = [None] * len(items)
+        for i in to_prompt:
+            prompts[i] = self.prompt_func(items[i][0], self.dictionary, self.parallel_corpus, self.args, retrieved=retrieved[i], builder=self.prompt_builder)
+        return [{"retrieved": r, "prompt": p} for r, p in zip(retrieved, prompts)]
+
+    def generate_batch(self, prompts):
+        from model import get_preds_hf, get_preds_vllm
+        if self.args.no_vllm:
+            return get_preds_hf(self.llm, self.tokenizer, prompts, self.args, batch_size=self.args.batch_size)
+        return get_preds_vllm(self.llm, prompts, self.args)
+
+    # ---- request handlers ----
+
+    @staticmethod
+    def request_texts(body):
+        texts = body.get("texts", [body["text"]] if "text" in body else None)
+        if not isinstance(texts, list) or not texts or not all(isinstance(t, str) for t in texts):
+            raise BadRequest('expected "text" (string) or "texts" (non-empty list of strings)')
+        return texts
+
+    def admit(self, count):
+        # Backpressure: refuse new work once --max_pending sentences are in progress
+        if self.pending + count > self.args.max_pending:
+            raise Overloaded(f"{self.pending} sentences in progress")
+        self.pending += count
+
+    async def retrieve(self, body):
+        texts = self.request_texts(body)
+        top_k = int(body.get("top_k", self.args.num_parallel_sent))
+        self.admit(len(texts))
+        try:
+            prepared = await asyncio.gather(*(self.prepare_batcher.submit((text, top_k, False)) for text in texts))
+        finally:
+            self.pending -= len(texts)
+        return {"results": [p["retrieved"] for p in prepared]}
+
+    async def translate_one(self, text, return_prompt):
+        prepared = await self.prepare_batcher.submit((text, self.args.num_parallel_sent, True))
+        prompt = prepared["prompt"]
+        result = {"text": text, "pred": "", "error": None}
+        if self.runner is not None:
+            async with self.api_slots:
+                generated = await self.runner.generate(prompt)
+            result.update(pred=generated["pred"], error=generated["error"], cached=generated["cached"])
+        else:
+            result["pred"] = await self.generate_batcher.submit(prompt)
+        if result["error"]:
+            self.counters["generation_errors"] += 1
+        if return_prompt:
+            result["prompt"] = prompt
+        return result
+
+    async def translate(self, body):
+        texts = self.request_texts(body)
+        self.admit(len(texts))
+        try:
+            translations = await asyncio.gather(*(self.translate_one(text, bool(body.get("return_prompt"))) for text in texts))
+        finally:
+            self.pending -= len(texts)
+        self.counters["sentences"] += len(texts)
+        return {"translations": translations}
+
+    def health(self):
+        return {
+            "status": "ok",
+            "uptime_s": round(time.time() - self.started, 1),
+            "corpus_size": len(self.parallel_corpus),
+            "dictionary_size": len(self.dictionary.word_dict) if self.dictionary is not None else 0,
+            "mode": "api" if self.args.use_api else "local",
+        }
+
+    def metrics(self):
+        latency = {}
+        for endpoint, values in self.latencies.items():
+            p50, p95, p99 = np.percentile(np.asarray(values), [50, 95, 99]).tolist()
+            latency[endpoint] = {"count": len(values), "p50_ms": p50 * 1000, "p95_ms": p95 * 1000, "p99_ms": p99 * 1000}
+        metrics = dict(self.counters, pending=self.pending, latency=latency, prepare=self.prepare_batcher.stats())
+        if self.generate_batcher is not None:
+            metrics["generate"] = self.generate_batcher.stats()
+        if self.cache is not None:
+            metrics["cache"] = {"hits": self.cache.hits, "misses": self.cache.misses}
+        metrics["prompt_tokens"] = self.prompt_builder.summary()
+        return metrics
+
+    def record_latency(self, endpoint, seconds):
+        self.latencies.setdefault(endpoint, deque(maxlen=1000)).append(seconds)
+
+    # ---- HTTP ----
+
+    async def dispatch(self, method, path, body):
+        routes = {
+            ("GET", "/health"): lambda: self.health(),
+            ("GET", "/metrics"): lambda: self.metrics(),
+            ("POST", "/retrieve"): lambda: self.retrieve(body),
+            ("POST", "/translate"): lambda: self.translate(body),
+        }
+        handler = routes.get((method, path))
+        if handler is None:
+            return (405 if any(p == path for _, p in routes) else 404), {"error": f"no route for {method} {path}"}
+        result = handler()
+        if asyncio.iscoroutine(result):
+            result = await result
+        return 200, result
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.send(writer, 400, {"error": "malformed request line"}, keep_alive=False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+                # The body can't be skipped reliably after a bad length, so the connection is closed after the reply
+                try:
+                    length = parse_content_length(headers.get('content-length'))
+                except BadRequest as e:
+                    await self.reject(writer, 400, str(e))
+                    break
+                if length > self.args.max_body_kb * 1024:
+                    await self.reject(writer, 413, f"request body larger than {self.args.max_body_kb} KB")
+                    break
+                raw = await reader.readexactly(length) if length else b''
+
+                start = time.perf_counter()
+                path = target.split('?', 1)[0]
+                self.counters["requests"] += 1
+                try:
+                    body = json.loads(raw) if raw else {}
+                    if not isinstance(body, dict):
+                        raise BadRequest("request body must be a JSON object")
+                    status, payload = await self.dispatch(method, path, body)
+                except (BadRequest, ValueError) as e:
+                    status, payload = 400, {"error": str(e)}
+                except Overloaded as e:
+                    self.counters["rejected"] += 1
+                    status, payload = 503, {"error": f"overloaded: {e}"}
+                except Exception as e:
+                    status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+                if status >= 400:
+                    self.counters["errors"] += 1
+                if status == 200 and method == "POST":
+                    self.record_latency(path, time.perf_counter() - start)
+                await self.send(writer, status, payload, keep_alive=keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def reject(self, writer, status, message):
+        # Error reply sent before the request is dispatched; the connection is closed
+        self.counters["requests"] += 1
+        self.counters["errors"] += 1
+        await self.send(writer, status, {"error": message}, keep_alive=False)
+
+    @staticmethod
+    async def send(writer, status, payload, keep_alive=True):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        head = [
+            f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}",
+            "Content-Type: application/json; charset=utf-8",
+            f"Content-Length: {len(data)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        if status == 503:
+            head.append("Retry-After: 1")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + data)
+        await writer.drain()
+
+
+async def serve(args):
+    service = TranslationService(args)
+    service.start()
+    server = await asyncio.start_server(service.handle_connection, args.host, args.port)
+    print(f"Serving on http://{args.host}:{args.port} (POST /translate, POST /retrieve, GET /health, GET /metrics)")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.description = "HTTP translation server: loads the dictionary, corpus indexes and model once"
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--batch_window_ms', type=float, default=10.0, help="How long a micro-batch waits for more requests")
+    parser.add_argument('--max_batch_size', type=int, default=64, help="Sentences per retrieval/prompt micro-batch")
+    parser.add_argument('--max_queue', type=int, default=1024, help="Sentences allowed to wait for a batch")
+    parser.add_argument('--max_pending', type=int, default=512, help="Sentences in progress before new requests get 503")
+    parser.add_argument('--max_body_kb', type=int, default=MAX_BODY_BYTES // 1024, help="Larger request bodies get 413")
+    args = parser.parse_args()
+
+    asyncio.run(serve(args))
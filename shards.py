@@ -0,0 +1,115 @@
+import argparse
+import copy
+import gc
+import multiprocessing
+import os
+import time
+
+from output_io import existing_data_path, iter_json_records, write_records
+
+def shard_indices(num_items, num_shards, shard_id):
+    # Round-robin, so every shard gets a similar mix of easy / medium / hard items
+    return range(shard_id, num_items, num_shards)
+
+def shard_output_path(output_path, shard_id, num_shards):
+    root, ext = os.path.splitext(output_path)
+    return f"{root}.shard-{shard_id:03d}-of-{num_shards:03d}{ext or '.jsonl'}"
+
+def merge_shards(output_path, num_shards, num_items, remove=False):
+    """
+    Reassembles shard outputs into output_path in input order. Raises ValueError (and writes
+    nothing) if a shard file is missing, an item is missing or duplicated, or an item is
+    found in the wrong shard.
+    """
+    records = {}
+    problems = []
+    for shard_id in range(num_shards):
+        path = shard_output_path(output_path, shard_id, num_shards)
+        if not os.path.exists(path):
+            problems.append(f"missing shard file {path}")
+            continue
+        for record in iter_json_records(path):
+            idx = record["idx"]
+            if idx in records:
+                problems.append(f"duplicate idx {idx} in {path}")
+            elif idx % num_shards != shard_id or not 0 <= idx < num_items:
+                problems.append(f"idx {idx} does not belong in {path}")
+            records[idx] = record
+
+    missing = sorted(set(range(num_items)) - set(records))
+    if missing:
+        problems.append(f"{len(missing)} items missing: {missing[:20]}{' ...' if len(missing) > 20 else ''}")
+    if problems:
+        raise ValueError("Cannot merge shards:\n  " + "\n  ".join(problems))
+
+    write_records(output_path, records.values())
+    if remove:
+        for shard_id in range(num_shards):
+            os.remove(shard_output_path(output_path, shard_id, num_shards))
+    failed = sum(1 for record in records.values() if record.get("error"))
+    print(f"Merged {len(records)} items from {num_shards} shards into {output_path}" + (f" ({failed} with errors)" if failed else ""))
+    return len(records)
+
+
+# Set in the launcher before forking; workers inherit them instead of loading their own copies
+_shared = {}
+
+def _run_shard(shard_id):
+    args = copy.copy(_shared["args"])
+    args.shard_id = shard_id
+    _shared["run"](args, resources=_shared["resources"])
+    # Parts of the shared resources this worker had to load itself
+    parts = _shared["shared_parts"](_shared["resources"]) if _shared["shared_parts"] else {}
+    return shard_id, sorted(name for name, part in parts.items() if part != _shared["parts"][name])
+
+def launch_local(args, run, load_shared, shared_parts=None):
+    """
+    Runs all shards on this machine with `args.workers` forked processes.
+    load_shared(args) is called once in the parent (dictionary, memory-mapped corpus and indexes);
+    forked workers share those pages instead of each loading a copy. API clients and caches are
+    opened inside each worker. shared_parts(resources) -> {name: id} is compared before the fork
+    and after each shard, to report anything a worker loaded again. The shard outputs are merged
+    and verified at the end.
+    """
+    if not args.use_api:
+        raise ValueError("--workers needs --use_api; a local model would be loaded once per worker")
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise RuntimeError("--workers needs the fork start method (Linux / macOS)")
+
+    num_shards = args.num_shards if args.num_shards > 1 else args.workers
+    start = time.perf_counter()
+    resources = load_shared(args)
+    # Import the API client once here too; each worker still opens its own connection
+    import openai  # noqa: F401
+    print(f"Loaded shared resources in {time.perf_counter() - start:.2f}s; running {num_shards} shards on {args.workers} workers...")
+
+    shard_args = copy.copy(args)
+    shard_args.num_shards = num_shards
+    shard_args.workers = 1
+    _shared.update(args=shard_args, run=run, resources=resources, shared_parts=shared_parts,
+                   parts=shared_parts(resources) if shared_parts else {})
+    # Keep the loaded objects out of the collector's reach so forked workers don't copy their pages
+    gc.freeze()
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(min(args.workers, num_shards)) as pool:
+        for shard_id, reloaded in pool.imap_unordered(_run_shard, range(num_shards)):
+            print(f"Shard {shard_id + 1}/{num_shards} finished.")
+            if reloaded:
+                print(f"Warning: shard {shard_id + 1} loaded its own copy of {', '.join(reloaded)} instead of sharing the parent's")
+    gc.unfreeze()
+
+    num_items = sum(1 for _ in iter_json_records(args.test_data_path))
+    merge_shards(args.output_path, num_shards, num_items)
+    print(f"All shards done in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    # Merge step for shards run on several machines (main.py --num_shards N --shard_id k on each)
+    parser = argparse.ArgumentParser(description="Merge and verify main.py shard outputs")
+    parser.add_argument('--output_path', type=str, required=True, help="The --output_path every shard was run with")
+    parser.add_argument('--num_shards', type=int, required=True)
+    parser.add_argument('--test_data_path', type=existing_data_path, required=True)
+    parser.add_argument('--remove_shards', action='store_true', help="Delete the shard files after a successful merge")
+    args = parser.parse_args()
+
+    merge_shards(args.output_path, args.num_shards, sum(1 for _ in iter_json_records(args.test_data_path)), remove=args.remove_shards)
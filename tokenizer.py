@@ -1,26 +1,99 @@
 import re
-import jieba
+from functools import lru_cache
+
+# Bump whenever tokenize() output changes, so on-disk BM25 indexes get rebuilt
+TOKENIZER_VERSION = 1
+
+REMOVED_PUNC = "，。、；！？「」『』【】（）《》“”…,.;?!"
+ZH_REMOVED_PUNC = "，。、；！？「」『』【】（）《》“”…"
+SPACED_PUNC = ",.;?!"
+
+# Whitespace other than a plain space: only then does split(" ") + strip() differ from split()
+_OTHER_WHITESPACE = re.compile(r'[^\S ]')
+
+class _TranslationTable(dict):
+    """
+    str.translate table that also deletes every decimal digit (exactly what re's \\d matches).
+    Characters are classified the first time they are seen, so the table stays small.
+    """
+    def __init__(self, mapping, remove_digits=True):
+        super().__init__({ord(char): value for char, value in mapping.items()})
+        self.remove_digits = remove_digits
+
+    def __missing__(self, codepoint):
+        value = None if self.remove_digits and chr(codepoint).isdecimal() else codepoint
+        self[codepoint] = value
+        return value
+
+def split_tokens(text):
+    # Same tokens as [w.strip() for w in text.split(" ") if w.strip() != ""]
+    if _OTHER_WHITESPACE.search(text) is None:
+        return text.split()
+    return [word.strip() for word in text.split(" ") if word.strip() != ""]
+
+
+class Vocabulary():
+    """
+    Shared token -> integer id table. Ids are assigned in first-seen order and never change,
+    so id sequences from different tokenize_ids calls can be mixed freely.
+    """
+    def __init__(self, tokens=()):
+        self.token_to_id = {}
+        self.tokens = []
+        for token in tokens:
+            self.add(token)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, token):
+        return token in self.token_to_id
+
+    def add(self, token):
+        token_id = self.token_to_id.get(token)
+        if token_id is None:
+            token_id = self.token_to_id[token] = len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+    def encode(self, tokens, add=True):
+        # Unknown tokens are added, or dropped when add=False
+        if add:
+            return [self.add(token) for token in tokens]
+        token_to_id = self.token_to_id
+        return [token_to_id[token] for token in tokens if token in token_to_id]
+
+    def decode(self, token_ids):
+        return [self.tokens[token_id] for token_id in token_ids]
+
 
 class Tokenizer():
-    def __init__(self):
-        pass
+    def __init__(self, cache_size=65536):
+        self.remove_punc_table = _TranslationTable({punc: " " for punc in REMOVED_PUNC})
+        self.spaced_punc_table = _TranslationTable({punc: f" {punc} " for punc in SPACED_PUNC}, remove_digits=False)
+        # Per-text cache; tokens are stored as tuples so callers can't mutate a cached entry
+        self._cached_tokenize = lru_cache(maxsize=cache_size)(self._tokenize)
 
-    def tokenize(self, text, remove_punc=False):
-        text = text.lower()    
-        if remove_punc:
-            # Common punctuation removal
-            for punc in "，。、；！？「」『』【】（）《》“”…,.;?!":
-                text = text.replace(punc, " ")
-            text = re.sub(r'\d+', '', text)
-        else:
-            # Add spaces around punctuation
-            for punc in ",.;?!":
-                text = text.replace(punc, " " + punc + " ")
-        
-        # Split by whitespace
-        tokenized_text = text.split(" ")
-        tokenized_text = [word.strip() for word in tokenized_text if word.strip() != ""]
-        return tokenized_text
+    def settings(self):
+        # Recorded in index manifests to detect stale indexes
+        return {"name": type(self).__name__, "version": TOKENIZER_VERSION}
+
+    def _tokenize(self, text, remove_punc=False):
+        # Punctuation (and digits, when removing punctuation) are handled in one translate pass
+        table = self.remove_punc_table if remove_punc else self.spaced_punc_table
+        return tuple(split_tokens(text.lower().translate(table)))
+
+    def tokenize(self, text, remove_punc=False, cache=True):
+        # cache=False for one-off texts (e.g. index building) that would only churn the cache
+        if cache:
+            return list(self._cached_tokenize(text, remove_punc))
+        return list(self._tokenize(text, remove_punc))
+
+    def tokenize_ids(self, text, vocab, add=True, **kwargs):
+        return vocab.encode(self.tokenize(text, **kwargs), add=add)
+
+    def cache_info(self):
+        return self._cached_tokenize.cache_info()
 
 class EngTokenizer(Tokenizer):
     def __init__(self):
@@ -29,24 +102,43 @@ class EngTokenizer(Tokenizer):
 class MosTokenizer(Tokenizer):
     def __init__(self):
         super().__init__()
-    
+
     # Mossi specific characters (like ã, õ, ɛ, ɩ) are handled fine by python strings
     pass
 
 class ZhTokenizer(Tokenizer):
     def __init__(self):
         super().__init__()
+        self.remove_punc_table = _TranslationTable({punc: None for punc in ZH_REMOVED_PUNC})
+
+    def _tokenize(self, text, remove_punc=False, do_cut_all=False, cut_for_search=False):
+        # jieba is slow to import and only needed here
+        import jieba
 
-    def tokenize(self, text, remove_punc=False, do_cut_all=False, cut_for_search=False):
         text = text.lower()
         if remove_punc:
-            for punc in "，。、；！？「」『』【】（）《》“”…":
-                text = text.replace(punc, "")
-            text = re.sub(r'\d+', '', text)
-        
+            text = text.translate(self.remove_punc_table)
+
         if cut_for_search:
             tokenized_text = jieba.lcut_for_search(text)
         else:
             tokenized_text = jieba.lcut(text, cut_all=do_cut_all)
-        tokenized_text = [word.strip() for word in tokenized_text if word.strip() != ""]
-        return tokenized_text
\ No newline at end of file
+        return tuple(word.strip() for word in tokenized_text if word.strip() != "")
+
+    def tokenize(self, text, remove_punc=False, do_cut_all=False, cut_for_search=False, cache=True):
+        if cache:
+            return list(self._cached_tokenize(text, remove_punc, do_cut_all, cut_for_search))
+        return list(self._tokenize(text, remove_punc, do_cut_all, cut_for_search))
+
+# Shared tokenizer instances (also re-exported by corpus.py)
+lang2tokenizer = {
+    'en': EngTokenizer(),
+    'eng': EngTokenizer(),
+    'mos': MosTokenizer(),
+}
+
+_default_tokenizer = Tokenizer()
+
+def get_tokenizer(lang):
+    # Shared instance per language, so every caller hits the same per-text cache
+    return lang2tokenizer.get(lang, _default_tokenizer)